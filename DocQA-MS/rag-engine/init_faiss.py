@@ -1,24 +1,10 @@
-import os
-import faiss
-import numpy as np
-from pathlib import Path
-from dotenv import load_dotenv
+from config import FAISS_INDEX_PATH, FAISS_INDEX_FACTORY, FAISS_NUM_SHARDS, EMBEDDING_DIMENSION
+# Built exactly as the rag-engine builds it: HNSW wrapped in IndexIDMap2 with efConstruction applied,
+# IVF with nprobe and its id hashtable, the refinement index and the shard layout
+from faiss_index import faiss_index
 
-load_dotenv()
-
-faiss_index_path = os.getenv("FAISS_INDEX_PATH", "/app/faiss_index")
-dimension = 768
-nlist = 100
-
-index_dir = Path(faiss_index_path)
-index_dir.mkdir(parents=True, exist_ok=True)
-
-index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist)
-index.nprobe = 10
-
-index_file = index_dir / "faiss_index.idx"
-faiss.write_index(index, str(index_file))
-
-print(f"FAISS index initialized at {index_file}")
-print(f"Dimension: {dimension}, nlist: {nlist}")
+faiss_index.initialize_index()
+faiss_index.save_index()
 
+print(f"FAISS index initialized at {FAISS_INDEX_PATH}")
+print(f"Factory: {FAISS_INDEX_FACTORY}, shards: {FAISS_NUM_SHARDS}, dimension: {EMBEDDING_DIMENSION}, metric: inner product")
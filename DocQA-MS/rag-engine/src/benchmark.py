@@ -1,7 +1,48 @@
+import os
+import re
+import sys
+import json
 import time
+import types
+import faiss
+import tempfile
+import subprocess
+import numpy as np
 from typing import List, Dict, Any
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, Text, JSON, select
+from sqlalchemy.orm import Session, registry
 from indexer_service import indexer_service
+from faiss_index import FAISSIndex
+from sharded_index import ShardedFAISSIndex
 from hybrid_search import hybrid_search
+from rabbitmq_consumer import RabbitMQConsumer
+from embedding_backends import BACKENDS, create_backend, parity_check, token_budget_batches
+from chunk_store import chunk_table, ensure_schema, encode_embeddings, stored_embeddings, insert_chunks
+from config import EMBED_MAX_BATCH_TOKENS
+
+# Runs in a fresh interpreter so each worker's startup and memory are measured in isolation
+_SERVING_WORKER = """
+import sys, json, time
+import numpy as np
+started = time.perf_counter()
+from faiss_index import FAISSIndex
+index = FAISSIndex(index_path=sys.argv[1], auto_retrain=False)
+if sys.argv[2] == "mmap":
+    index.open_read_only()
+else:
+    index.load_index()
+load_seconds = time.perf_counter() - started
+for query in np.load(sys.argv[3]):
+    index.search(query, k=10)
+memory = {}
+with open("/proc/self/smaps_rollup") as f:
+    for line in f:
+        name, _, value = line.partition(":")
+        if name in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+            memory[name] = int(value.split()[0]) / 1024
+print(json.dumps({"load_seconds": load_seconds, "memory_mb": memory}), flush=True)
+sys.stdin.readline()
+"""
 
 class Benchmark:
     def __init__(self):
@@ -77,6 +118,663 @@ class Benchmark:
             "correct_results": correct_results,
             "recall": recall
         }
+    
+    def _synthetic_corpus(self, num_vectors: int, dimension: int = 768, num_clusters: int = 256, seed: int = 0) -> np.ndarray:
+        rng = np.random.default_rng(seed)
+        centers = rng.standard_normal((num_clusters, dimension)).astype('float32')
+        vectors = centers[rng.integers(0, num_clusters, num_vectors)] + 0.5 * rng.standard_normal((num_vectors, dimension)).astype('float32')
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+    
+    def _synthetic_queries(self, vectors: np.ndarray, num_queries: int, seed: int = 3) -> np.ndarray:
+        rng = np.random.default_rng(seed)
+        queries = vectors[rng.integers(0, len(vectors), num_queries)] + 0.05 * rng.standard_normal((num_queries, vectors.shape[1])).astype('float32')
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        return queries
+    
+    def benchmark_filtered_search(
+        self,
+        num_vectors: int = 200000,
+        chunks_per_document: int = 20,
+        num_queries: int = 200,
+        k: int = 10
+    ) -> Dict[str, Any]:
+        
+        sections = ["anamnese", "examen_clinique", "diagnostic", "traitement", "conclusion", "general"]
+        vectors = self._synthetic_corpus(num_vectors)
+        document_ids = np.arange(num_vectors) // chunks_per_document
+        section_ids = np.random.default_rng(1).integers(0, len(sections), num_vectors)
+        metadata = [
+            {"document_id": int(d), "section_type": sections[s]}
+            for d, s in zip(document_ids.tolist(), section_ids.tolist())
+        ]
+        
+        index = FAISSIndex(index_path=tempfile.mkdtemp(prefix="faiss-bench-"), auto_retrain=False)
+        index.initialize_index()
+        index.train_index(vectors[:50000])
+        index.add_vectors(vectors, np.arange(num_vectors), metadata, save=False)
+        
+        rng = np.random.default_rng(2)
+        queries = self._synthetic_queries(vectors, num_queries)
+        filter_sets = {
+            "document_id": [{"document_id": int(d)} for d in rng.integers(0, document_ids[-1] + 1, num_queries)],
+            "section_type": [{"section_type": sections[s]} for s in rng.integers(0, len(sections), num_queries)],
+            "document_ids+section_type": [
+                {"document_ids": rng.integers(0, document_ids[-1] + 1, 50).tolist(), "section_type": sections[s]}
+                for s in rng.integers(0, len(sections), num_queries)
+            ]
+        }
+        
+        def allowed_mask(filters):
+            mask = np.ones(num_vectors, dtype=bool)
+            if "document_id" in filters:
+                mask &= document_ids == filters["document_id"]
+            if "document_ids" in filters:
+                mask &= np.isin(document_ids, filters["document_ids"])
+            if "section_type" in filters:
+                mask &= section_ids == sections.index(filters["section_type"])
+            return mask
+        
+        def post_filter(query, filters):
+            # Previous behaviour: fetch k * 2 candidates, then drop those whose metadata does not match
+            results = index.search(query, k=k * 2)
+            allowed_documents = set(filters.get("document_ids", [filters.get("document_id")]))
+            return [
+                r for r in results
+                if ("document_id" not in filters and "document_ids" not in filters or r["metadata"]["document_id"] in allowed_documents)
+                and ("section_type" not in filters or r["metadata"]["section_type"] == filters["section_type"])
+            ][:k]
+        
+        def pushdown(query, filters):
+            return index.search(query, k=k, filters=filters)
+        
+        report = {"num_vectors": num_vectors, "k": k, "filters": {}}
+        for name, filters_list in filter_sets.items():
+            truths = []
+            for query, filters in zip(queries, filters_list):
+                candidates = np.flatnonzero(allowed_mask(filters))
+                scores = vectors[candidates] @ query
+                truths.append(set(candidates[np.argsort(-scores)[:k]].tolist()))
+            
+            report["filters"][name] = {}
+            for mode, search in (("post_filter", post_filter), ("pushdown", pushdown)):
+                latencies, recalls, counts = [], [], []
+                for query, filters, truth in zip(queries, filters_list, truths):
+                    start_time = time.perf_counter()
+                    results = search(query, filters)
+                    latencies.append(time.perf_counter() - start_time)
+                    counts.append(len(results))
+                    recalls.append(len(truth & {r["chunk_id"] for r in results}) / len(truth) if truth else 1.0)
+                
+                report["filters"][name][mode] = {
+                    f"recall@{k}": float(np.mean(recalls)),
+                    "avg_results": float(np.mean(counts)),
+                    "p50_ms": 1000.0 * float(np.percentile(latencies, 50)),
+                    "p99_ms": 1000.0 * float(np.percentile(latencies, 99))
+                }
+        
+        return report
+    
+    def benchmark_delete_document(
+        self,
+        num_vectors: int = 2000000,
+        dimension: int = 64,
+        chunks_per_document: int = 20,
+        num_deletes: int = 200,
+        batch_size: int = 100000
+    ) -> Dict[str, Any]:
+        
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory(prefix="faiss-bench-") as index_path:
+            index = FAISSIndex(index_path=index_path, dimension=dimension, auto_retrain=False)
+            index.initialize_index()
+            
+            start_time = time.perf_counter()
+            for start in range(0, num_vectors, batch_size):
+                end = min(start + batch_size, num_vectors)
+                vectors = rng.standard_normal((end - start, dimension)).astype('float32')
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                metadata = [{"document_id": i // chunks_per_document, "section_type": "general"} for i in range(start, end)]
+                index.train_index(vectors)
+                index.add_vectors(vectors, np.arange(start, end), metadata, save=False)
+            build_time = time.perf_counter() - start_time
+            
+            num_documents = num_vectors // chunks_per_document
+            targets = rng.choice(num_documents, size=2 * num_deletes, replace=False).tolist()
+            
+            latencies = []
+            for document_id in targets[:num_deletes]:
+                start_time = time.perf_counter()
+                index.delete_document(document_id)
+                latencies.append(time.perf_counter() - start_time)
+            
+            # Previous behaviour: scan every chunk's metadata, then scan every inverted list
+            faiss.extract_index_ivf(index.index).set_direct_map_type(faiss.DirectMap.NoMap)
+            document_column = index.metadata_store.columns["document_id"][:index.metadata_store.size]
+            chunk_column = index.metadata_store.columns["chunk_id"][:index.metadata_store.size]
+            scan_latencies = []
+            for document_id in targets[num_deletes:num_deletes + min(num_deletes, 20)]:
+                start_time = time.perf_counter()
+                chunk_ids = chunk_column[document_column == document_id]
+                index.index.remove_ids(chunk_ids)
+                scan_latencies.append(time.perf_counter() - start_time)
+            
+            total_vectors = index.index.ntotal
+            index.wal.close()
+        
+        return {
+            "num_vectors": num_vectors,
+            "dimension": dimension,
+            "chunks_per_document": chunks_per_document,
+            "build_seconds": build_time,
+            "remaining_vectors": total_vectors,
+            "reverse_index": {
+                "deletes": len(latencies),
+                "p50_ms": 1000.0 * float(np.percentile(latencies, 50)),
+                "p99_ms": 1000.0 * float(np.percentile(latencies, 99)),
+                "mean_ms": 1000.0 * float(np.mean(latencies))
+            },
+            "full_scan": {
+                "deletes": len(scan_latencies),
+                "p50_ms": 1000.0 * float(np.percentile(scan_latencies, 50)),
+                "mean_ms": 1000.0 * float(np.mean(scan_latencies))
+            }
+        }
+    
+    def benchmark_index_types(
+        self,
+        num_vectors: int = 200000,
+        factories: List[str] = None,
+        nlist: int = 1024,
+        num_queries: int = 200,
+        k: int = 10,
+        num_clusters: int = 256
+    ) -> Dict[str, Any]:
+        
+        factories = factories or ["IVF{nlist},Flat", "IVF{nlist},SQ8", "IVF{nlist},PQ96", "IVF{nlist},PQ96,Refine(SQ8)"]
+        vectors = self._synthetic_corpus(num_vectors, num_clusters=num_clusters)
+        queries = self._synthetic_queries(vectors, num_queries)
+        truths = [set(np.argsort(-(vectors @ query))[:k].tolist()) for query in queries]
+        metadata = [{"document_id": i // 20, "section_type": "general"} for i in range(num_vectors)]
+        
+        report = {"num_vectors": num_vectors, "dimension": vectors.shape[1], "nlist": nlist, "k": k, "index_types": {}}
+        for factory in factories:
+            with tempfile.TemporaryDirectory(prefix="faiss-bench-") as index_path:
+                index = FAISSIndex(index_path=index_path, auto_retrain=False, factory=factory)
+                index.index, index.refine_index = index._build_index(nlist)
+                index._built_factory = factory
+                
+                start_time = time.perf_counter()
+                index.train_index(vectors[:50000])
+                train_time = time.perf_counter() - start_time
+                start_time = time.perf_counter()
+                index.add_vectors(vectors, np.arange(num_vectors), metadata, save=False)
+                add_time = time.perf_counter() - start_time
+                
+                latencies, recalls = [], []
+                for query, truth in zip(queries, truths):
+                    start_time = time.perf_counter()
+                    results = index.search(query, k=k)
+                    latencies.append(time.perf_counter() - start_time)
+                    recalls.append(len(truth & {r["chunk_id"] for r in results}) / k)
+                
+                stats = index.get_stats()
+            
+            report["index_types"][factory] = {
+                "bytes_per_vector": stats["bytes_per_vector"],
+                "index_mb": stats["bytes_per_vector"] * num_vectors / 2 ** 20,
+                "train_seconds": train_time,
+                "add_seconds": add_time,
+                f"recall@{k}": float(np.mean(recalls)),
+                "p50_ms": 1000.0 * float(np.percentile(latencies, 50)),
+                "p99_ms": 1000.0 * float(np.percentile(latencies, 99))
+            }
+        
+        return report
+    
+    def benchmark_hnsw_vs_ivf(self, num_vectors: int = 200000, num_clusters: int = 4096, **kwargs) -> Dict[str, Any]:
+        # Many small clusters spread neighbours over several IVF lists, which is where nprobe=10 loses recall
+        return self.benchmark_index_types(
+            num_vectors=num_vectors,
+            factories=["IVF{nlist},Flat", "HNSW{M},Flat"],
+            num_clusters=num_clusters,
+            **kwargs
+        )
+    
+    def _synthetic_clinical_document(self, num_pages: int, lines_per_page: int = 45, seed: int = 0) -> str:
+        rng = np.random.default_rng(seed)
+        headers = [
+            "ANAMNÈSE", "Motif de consultation", "Antécédents", "EXAMEN CLINIQUE", "Observations",
+            "DIAGNOSTIC", "Conclusion", "TRAITEMENT", "Plan de traitement", "ÉVOLUTION", "Suivi"
+        ]
+        words = (
+            "le patient présente une douleur thoracique irradiant au bras gauche depuis trois jours avec dyspnée "
+            "tension artérielle fréquence cardiaque saturation normale bilan biologique créatinine hémoglobine "
+            "pas de fièvre ni de toux état général conservé auscultation pulmonaire claire abdomen souple "
+            "traitement poursuivi surveillance évolution favorable contrôle prévu"
+        ).split()
+        lines = []
+        for _ in range(num_pages * lines_per_page):
+            if rng.random() < 0.04:
+                lines.append(headers[rng.integers(len(headers))])
+            else:
+                lines.append(" ".join(rng.choice(words, rng.integers(6, 16))).capitalize() + ".")
+        return "\n".join(lines)
+    
+    def benchmark_section_detection(self, num_pages: int = 200, num_documents: int = 5, repeats: int = 3) -> Dict[str, Any]:
+        chunker = indexer_service.chunker
+        documents = [self._synthetic_clinical_document(num_pages, seed=seed) for seed in range(num_documents)]
+        
+        # Previous behaviour: lowercase each line, then re.search the pattern table. It had three patterns per
+        # type where this has one, so the baseline is slightly flattered
+        patterns = {
+            section_type: "(?:" + "|".join(map(re.escape, keywords)) + ")"
+            for section_type, keywords in chunker.section_keywords.items()
+        }
+        
+        def line_by_line(text):
+            types = []
+            for line in text.split('\n'):
+                line_lower = line.lower().strip()
+                types.append(next((t for t, pattern in patterns.items() if re.search(pattern, line_lower, re.IGNORECASE)), None))
+            return types
+        
+        report = {"num_pages": num_pages, "num_documents": num_documents, "chars_per_document": float(np.mean([len(d) for d in documents])), "modes": {}}
+        for mode, detect in (("line_by_line", line_by_line), ("single_pass", chunker.detect_sections)):
+            timings = []
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                for document in documents:
+                    detect(document)
+                timings.append((time.perf_counter() - start_time) / num_documents)
+            report["modes"][mode] = {
+                "ms_per_document": 1000.0 * min(timings),
+                "mb_per_second": report["chars_per_document"] / min(timings) / 2 ** 20
+            }
+        report["speedup"] = report["modes"]["line_by_line"]["ms_per_document"] / report["modes"]["single_pass"]["ms_per_document"]
+        report["sections_per_document"] = float(np.mean([len(chunker.detect_sections(d)) for d in documents]))
+        
+        return report
+    
+    def benchmark_chunking(self, num_documents: int = 2000, max_pages: int = 4, batch_size: int = 32, workers: int = None) -> Dict[str, Any]:
+        chunker = indexer_service.chunker
+        workers = workers or os.cpu_count()
+        documents = [
+            {"document_id": i, "content": self._synthetic_clinical_document(1 + i % max_pages, seed=i), "metadata": {}}
+            for i in range(num_documents)
+        ]
+        
+        def per_section():
+            # Previous behaviour: encode each section on its own, then decode every window back to text
+            start_time = time.perf_counter()
+            num_chunks = 0
+            for document in documents:
+                for section in chunker.detect_sections(document["content"]):
+                    tokens = chunker.tokenizer.encode(section["text"], add_special_tokens=False)
+                    start = 0
+                    while True:
+                        end = min(start + chunker.chunk_size, len(tokens))
+                        chunker.tokenizer.decode(tokens[start:end], skip_special_tokens=True)
+                        num_chunks += 1
+                        if end >= len(tokens):
+                            break
+                        start = end - chunker.chunk_overlap
+            return {"documents": num_documents, "chunks": num_chunks, "seconds": time.perf_counter() - start_time}
+        
+        def per_document():
+            start_time = time.perf_counter()
+            num_chunks = sum(len(chunker.chunk_text(d["content"], d["metadata"])) for d in documents)
+            return {"documents": num_documents, "chunks": num_chunks, "seconds": time.perf_counter() - start_time}
+        
+        def streamed(num_workers):
+            stream = chunker.chunk_documents(iter(documents), batch_size=batch_size, workers=num_workers)
+            for _ in stream:
+                pass
+            return stream.get_stats()
+        
+        report = {"num_documents": num_documents, "batch_size": batch_size, "cpu_count": os.cpu_count(), "modes": {}}
+        modes = {
+            "per_section_decode": per_section,
+            "chunk_text_per_document": per_document,
+            "chunk_documents": lambda: streamed(0),
+            f"chunk_documents_{workers}_processes": lambda: streamed(workers)
+        }
+        for mode, run in modes.items():
+            stats = run()
+            report["modes"][mode] = {
+                "seconds": stats["seconds"],
+                "chunks": stats["chunks"],
+                "docs_per_second": stats["documents"] / stats["seconds"]
+            }
+            if "tokens_per_second" in stats:
+                report["modes"][mode]["tokens_per_second"] = stats["tokens_per_second"]
+        
+        return report
+    
+    def benchmark_embedding_backends(
+        self,
+        backends: List[str] = None,
+        num_chunks: int = 512,
+        num_queries: int = 200,
+        batch_size: int = 32
+    ) -> Dict[str, Any]:
+        chunker = indexer_service.chunker
+        documents = (
+            {"content": self._synthetic_clinical_document(2, seed=seed), "metadata": {}}
+            for seed in range(num_chunks)
+        )
+        chunks = []
+        for chunk in chunker.chunk_documents(documents):
+            chunks.append(chunk["text"][:1500])
+            if len(chunks) >= num_chunks:
+                break
+        rng = np.random.default_rng(0)
+        queries = [" ".join(chunks[i].split()[:rng.integers(4, 12)]) for i in rng.integers(len(chunks), size=num_queries)]
+        
+        reference = create_backend("torch")
+        report = {"num_chunks": len(chunks), "num_queries": num_queries, "batch_size": batch_size, "backends": {}}
+        for name in backends or BACKENDS:
+            backend = reference if name == "torch" else create_backend(name)
+            backend.encode(chunks[:batch_size], batch_size)
+            
+            start_time = time.perf_counter()
+            backend.encode(chunks, batch_size)
+            chunk_seconds = time.perf_counter() - start_time
+            
+            latencies = []
+            for query in queries:
+                start_time = time.perf_counter()
+                backend.encode([query], 1)
+                latencies.append(time.perf_counter() - start_time)
+            
+            parity = parity_check(backend, reference, chunks[:128] + queries[:128], batch_size)
+            report["backends"][name] = {
+                "chunks_per_second": len(chunks) / chunk_seconds,
+                "query_p50_ms": 1000.0 * float(np.percentile(latencies, 50)),
+                "query_p99_ms": 1000.0 * float(np.percentile(latencies, 99)),
+                "mean_cosine": parity["mean_cosine"],
+                "min_cosine": parity["min_cosine"]
+            }
+        
+        return report
+    
+    def benchmark_embed_batching(self, num_documents: int = 100, max_batch_tokens: int = EMBED_MAX_BATCH_TOKENS) -> Dict[str, Any]:
+        embedder = indexer_service.embedder
+        documents = (
+            {"content": self._synthetic_clinical_document(1 + seed % 4, seed=seed), "metadata": {}}
+            for seed in range(num_documents)
+        )
+        # Sections run from a header line and a sentence to whole pages, as in real reports
+        texts = [chunk["text"] for chunk in indexer_service.chunker.chunk_documents(documents)]
+        backend = embedder.load_model()
+        lengths = [len(ids) for ids in backend.tokenize(texts)]
+        
+        def fixed_batches():
+            # Previous behaviour: 1500-character cut, then batches of 32 in arrival order
+            return backend.encode([t[:1500] if len(t) > 1500 else t for t in texts], 32)
+        
+        plans = {
+            "fixed_32_arrival_order": (fixed_batches, [list(range(start, min(start + 32, len(texts)))) for start in range(0, len(texts), 32)]),
+            "token_budget_sorted": (lambda: embedder.embed_batch(texts, max_batch_tokens), token_budget_batches(lengths, max_batch_tokens))
+        }
+        
+        backend.encode(texts[:32], 32)
+        report = {"num_chunks": len(texts), "max_batch_tokens": max_batch_tokens, "real_tokens": sum(lengths), "modes": {}}
+        embeddings = {}
+        for mode, (run, batches) in plans.items():
+            start_time = time.perf_counter()
+            embeddings[mode] = run()
+            seconds = time.perf_counter() - start_time
+            # The torch backend's encode also sorts each call by character length, so its real padding is lower
+            padded_tokens = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+            report["modes"][mode] = {
+                "seconds": seconds,
+                "chunks_per_second": len(texts) / seconds,
+                "batches": len(batches),
+                "padded_tokens": padded_tokens,
+                "padding_efficiency": sum(lengths) / padded_tokens
+            }
+        report["speedup"] = report["modes"]["fixed_32_arrival_order"]["seconds"] / report["modes"]["token_budget_sorted"]["seconds"]
+        report["min_cosine"] = float(np.min(np.sum(embeddings["fixed_32_arrival_order"] * embeddings["token_budget_sorted"], axis=1)))
+        
+        return report
+    
+    def benchmark_chunk_writes(
+        self,
+        num_documents: int = 50,
+        chunks_per_document: int = 40,
+        database_url: str = None
+    ) -> Dict[str, Any]:
+        """Chunk persistence on a stand-in chunks table, a temporary SQLite file unless database_url is given."""
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((num_documents * chunks_per_document, 768)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        text = self._synthetic_clinical_document(1)[:1500]
+        metadata = {"section_type": "examen", "chunk_index": 0, "token_start": 0, "token_end": 512, "char_start": 0, "char_end": 1500}
+        
+        def rows_of(document):
+            start = document * chunks_per_document
+            return range(start, start + chunks_per_document)
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(database_url or f"sqlite:///{tmp}/chunks.db")
+            
+            def fresh_table():
+                table = Table(
+                    "bench_chunks", MetaData(),
+                    Column("id", Integer, primary_key=True),
+                    Column("document_id", Integer),
+                    Column("texte", Text),
+                    Column("position", Integer),
+                    Column("chunk_metadata", JSON),
+                    Column("embedding_vector", JSON)
+                )
+                table.drop(engine, checkfirst=True)
+                table.create(engine)
+                table = chunk_table(types.SimpleNamespace(__table__=table))
+                ensure_schema(engine, table)
+                return table
+            
+            def per_row_flush(table):
+                # Previous behaviour: one ORM object and flush per chunk, embedding as a JSON list of floats
+                chunk_class = type("BenchChunk", (), {})
+                registry().map_imperatively(chunk_class, table)
+                for document in range(num_documents):
+                    with Session(engine) as db:
+                        chunk_ids = []
+                        for i in rows_of(document):
+                            chunk = chunk_class()
+                            chunk.document_id, chunk.texte, chunk.position = document, text, i
+                            chunk.chunk_metadata, chunk.embedding_vector = metadata, embeddings[i].tolist()
+                            db.add(chunk)
+                            db.flush()
+                            chunk_ids.append(chunk.id)
+                        db.commit()
+            
+            def bulk_insert(table, dtype):
+                for document in range(num_documents):
+                    with Session(engine) as db:
+                        rows = rows_of(document)
+                        insert_chunks(db, table, [
+                            {"document_id": document, "texte": text, "position": i, "chunk_metadata": metadata, "embedding_bytes": blob}
+                            for i, blob in zip(rows, encode_embeddings(embeddings[rows.start:rows.stop], dtype))
+                        ])
+                        db.commit()
+            
+            modes = {
+                "per_row_flush_json": (per_row_flush, lambda: len(json.dumps(embeddings[0].tolist()))),
+                "bulk_insert_float32": (lambda table: bulk_insert(table, "float32"), lambda: 768 * 4),
+                "bulk_insert_float16": (lambda table: bulk_insert(table, "float16"), lambda: 768 * 2)
+            }
+            report = {"database": engine.dialect.name, "num_chunks": len(embeddings), "chunks_per_document": chunks_per_document, "modes": {}}
+            for mode, (write, embedding_bytes) in modes.items():
+                table = fresh_table()
+                start_time = time.perf_counter()
+                write(table)
+                write_seconds = time.perf_counter() - start_time
+                
+                start_time = time.perf_counter()
+                with engine.connect() as connection:
+                    rows = connection.execute(select(table.c.embedding_bytes, table.c.embedding_vector).order_by(table.c.id)).all()
+                loaded = stored_embeddings([row.embedding_bytes for row in rows], [row.embedding_vector for row in rows])
+                read_seconds = time.perf_counter() - start_time
+                
+                report["modes"][mode] = {
+                    "write_seconds": write_seconds,
+                    "chunks_per_second": len(embeddings) / write_seconds,
+                    "embedding_bytes_per_chunk": embedding_bytes(),
+                    "read_chunks_per_second": len(embeddings) / read_seconds,
+                    "max_abs_error": float(np.abs(loaded - embeddings).max())
+                }
+                table.drop(engine)
+            engine.dispose()
+        
+        report["speedup"] = report["modes"]["per_row_flush_json"]["write_seconds"] / report["modes"]["bulk_insert_float32"]["write_seconds"]
+        return report
+    
+    def benchmark_indexing_consumer(
+        self,
+        documents: List[Dict[str, Any]],
+        queue: str = "indexer_benchmark",
+        timeout_seconds: float = 600.0
+    ) -> Dict[str, Any]:
+        """A burst of indexing messages through the RabbitMQ consumer, one per batch and then batched.
+        
+        documents ({"document_id", "content"}, small ones for a realistic burst) must exist in the database;
+        each mode edits their content so that none of it is skipped as an unchanged resubmission.
+        """
+        modes = {
+            # Previous behaviour: prefetch_count=1 and one document indexed per message
+            "one_per_message": {"prefetch_count": 1, "batch_max_chunks": 1},
+            "batched": {}
+        }
+        report = {"num_messages": len(documents), "modes": {}}
+        for mode, settings in modes.items():
+            consumer = RabbitMQConsumer(queue=queue, **settings)
+            for document in documents:
+                consumer.publish({
+                    "document_id": document["document_id"],
+                    "content": f"{document['content']}\n{mode}",
+                    "metadata": document.get("metadata", {})
+                })
+            
+            start_time = time.perf_counter()
+            consumer.start()
+            while consumer.get_stats()["documents"] < len(documents) and time.perf_counter() - start_time < timeout_seconds:
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - start_time
+            consumer.stop_consuming()
+            
+            stats = consumer.get_stats()
+            report["modes"][mode] = {
+                "seconds": elapsed,
+                "documents": stats["documents"],
+                "documents_per_second": stats["documents"] / elapsed,
+                "batches": stats["batches"],
+                "average_batch_size": stats["average_batch_size"]
+            }
+        report["speedup"] = report["modes"]["batched"]["documents_per_second"] / report["modes"]["one_per_message"]["documents_per_second"]
+        
+        return report
+    
+    def benchmark_sharded_search(
+        self,
+        num_vectors: int = 200000,
+        shard_counts: List[int] = None,
+        nlist: int = 1024,
+        num_queries: int = 200,
+        k: int = 10
+    ) -> Dict[str, Any]:
+        
+        shard_counts = shard_counts or [1, 2, 4]
+        vectors = self._synthetic_corpus(num_vectors)
+        queries = self._synthetic_queries(vectors, num_queries)
+        truths = [set(np.argsort(-(vectors @ query))[:k].tolist()) for query in queries]
+        metadata = [{"document_id": i // 20, "section_type": "general"} for i in range(num_vectors)]
+        
+        report = {"num_vectors": num_vectors, "nlist": nlist, "k": k, "cpu_count": os.cpu_count(), "shards": {}}
+        for num_shards in shard_counts:
+            with tempfile.TemporaryDirectory(prefix="faiss-bench-") as index_path:
+                index = ShardedFAISSIndex(index_path=index_path, num_shards=num_shards, auto_retrain=False)
+                owners = index.shard_of([meta["document_id"] for meta in metadata])
+                # Each shard gets its share of the lists, so the total number of centroids stays the same
+                for shard_id, shard in enumerate(index.shards):
+                    shard.index, shard.refine_index = shard._build_index(max(nlist // num_shards, 1))
+                    shard._built_factory = shard.factory
+                    shard.train_index(vectors[owners == shard_id][:50000 // num_shards])
+                index.add_vectors(vectors, np.arange(num_vectors), metadata, save=False)
+                
+                latencies, recalls = [], []
+                for query, truth in zip(queries, truths):
+                    start_time = time.perf_counter()
+                    results = index.search(query, k=k)
+                    latencies.append(time.perf_counter() - start_time)
+                    recalls.append(len(truth & {r["chunk_id"] for r in results}) / k)
+                
+                save_times = []
+                for shard in index.shards:
+                    start_time = time.perf_counter()
+                    shard.save_index()
+                    save_times.append(time.perf_counter() - start_time)
+            
+            report["shards"][num_shards] = {
+                f"recall@{k}": float(np.mean(recalls)),
+                "p50_ms": 1000.0 * float(np.percentile(latencies, 50)),
+                "p99_ms": 1000.0 * float(np.percentile(latencies, 99)),
+                "save_seconds_total": float(sum(save_times)),
+                "save_seconds_per_shard": float(np.mean(save_times))
+            }
+        
+        return report
+    
+    def benchmark_shared_serving(
+        self,
+        num_vectors: int = 200000,
+        workers: int = 4,
+        nlist: int = 1024,
+        num_queries: int = 200
+    ) -> Dict[str, Any]:
+        
+        vectors = self._synthetic_corpus(num_vectors)
+        metadata = [{"document_id": i // 20, "section_type": "general"} for i in range(num_vectors)]
+        report = {"num_vectors": num_vectors, "workers": workers, "modes": {}}
+        
+        with tempfile.TemporaryDirectory(prefix="faiss-bench-") as index_path:
+            index = FAISSIndex(index_path=index_path, auto_retrain=False)
+            index.index, index.refine_index = index._build_index(nlist)
+            index._built_factory = index.factory
+            index.train_index(vectors[:50000])
+            index.add_vectors(vectors, np.arange(num_vectors), metadata, save=False)
+            index.save_index()
+            report["index_file_mb"] = index.index_file.stat().st_size / 2 ** 20
+            
+            queries_file = os.path.join(index_path, "queries.npy")
+            np.save(queries_file, self._synthetic_queries(vectors, num_queries))
+            del index, vectors
+            
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            for mode in ("heap", "mmap"):
+                # Workers stay alive until all have reported, so shared pages are split between them
+                processes = [
+                    subprocess.Popen(
+                        [sys.executable, "-c", _SERVING_WORKER, index_path, mode, queries_file],
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, text=True
+                    )
+                    for _ in range(workers)
+                ]
+                results = [json.loads(process.stdout.readline()) for process in processes]
+                for process in processes:
+                    process.communicate("\n")
+                
+                report["modes"][mode] = {
+                    "load_seconds_mean": float(np.mean([r["load_seconds"] for r in results])),
+                    "rss_mb_per_worker": float(np.mean([r["memory_mb"]["Rss"] for r in results])),
+                    "pss_mb_per_worker": float(np.mean([r["memory_mb"]["Pss"] for r in results])),
+                    "private_mb_per_worker": float(np.mean([r["memory_mb"]["Private_Clean"] + r["memory_mb"]["Private_Dirty"] for r in results])),
+                    "total_pss_mb": float(sum(r["memory_mb"]["Pss"] for r in results))
+                }
+        
+        return report
 
 benchmark = Benchmark()
 
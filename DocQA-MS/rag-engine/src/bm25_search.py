@@ -1,47 +1,349 @@
-from rank_bm25 import BM25Okapi
-from typing import List, Dict, Any
 import re
+import json
+import time
+import threading
+import numpy as np
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Any, Iterable
+from config import FAISS_INDEX_PATH, BM25_REFRESH_SECONDS
+from metadata_store import parse_filters
+
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array), 1024), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
 
 class BM25Search:
-    def __init__(self):
-        self.bm25_index = None
-        self.chunks = []
-        self.chunk_ids = []
+    def __init__(self, k1: float = 1.5, b: float = 0.75, refresh_seconds: float = BM25_REFRESH_SECONDS):
+        self.k1 = k1
+        self.b = b
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        self.index_path = Path(FAISS_INDEX_PATH)
+        self.index_file = self.index_path / "bm25_index.npz"
+        self._loaded_mtime = None
+        # FAISS generation the file on disk was saved with, so a restart can tell whether it missed writes
+        self.generation = None
+        self._reset()
     
-    def build_index(self, chunks: List[Dict[str, Any]]):
-        self.chunks = chunks
-        self.chunk_ids = [chunk["chunk_id"] for chunk in chunks]
+    def _reset(self):
+        self.vocabulary: Dict[str, int] = {}
+        self.section_codes: Dict[str, int] = {}
+        self.chunk_columns: Dict[int, int] = {}
+        self.document_chunks: Dict[int, set] = {}
+        
+        # One column per chunk, one posting (term, column, tf) per distinct term of a chunk
+        self.num_columns = 0
+        self.col_chunk_ids = np.zeros(0, dtype=np.int64)
+        self.col_document_ids = np.zeros(0, dtype=np.int64)
+        self.col_sections = np.zeros(0, dtype=np.int16)
+        self.col_lengths = np.zeros(0, dtype=np.float32)
+        self.col_alive = np.zeros(0, dtype=bool)
         
-        tokenized_corpus = [
-            self._tokenize(chunk["text"]) for chunk in chunks
-        ]
+        self.num_postings = 0
+        self.post_terms = np.zeros(0, dtype=np.int32)
+        self.post_cols = np.zeros(0, dtype=np.int32)
+        self.post_tfs = np.zeros(0, dtype=np.float32)
         
-        self.bm25_index = BM25Okapi(tokenized_corpus)
+        # CSR term -> (columns, precomputed BM25 weights), rebuilt by _compile
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=np.int32)
+        self._weights = np.zeros(0, dtype=np.float32)
+        self._dirty = False
+        self._compiled_at = 0.0
+    
+    def build_index(self, chunks: Iterable[Dict[str, Any]]):
+        with self._lock:
+            self._reset()
+            self.add_chunks(chunks)
+            self._compile()
+    
+    def add_chunks(self, chunks: Iterable[Dict[str, Any]]):
+        with self._lock:
+            for chunk in chunks:
+                chunk_id = chunk["chunk_id"]
+                if chunk_id in self.chunk_columns:
+                    self.remove_chunks([chunk_id])
+                
+                tokens = self._tokenize(chunk["text"])
+                term_counts = Counter(tokens)
+                metadata = chunk.get("metadata") or {}
+                document_id = metadata.get("document_id")
+                section_type = metadata.get("section_type")
+                
+                col = self.num_columns
+                self.num_columns += 1
+                self.col_chunk_ids = _grow(self.col_chunk_ids, self.num_columns)
+                self.col_document_ids = _grow(self.col_document_ids, self.num_columns)
+                self.col_sections = _grow(self.col_sections, self.num_columns)
+                self.col_lengths = _grow(self.col_lengths, self.num_columns)
+                self.col_alive = _grow(self.col_alive, self.num_columns)
+                
+                self.col_chunk_ids[col] = chunk_id
+                self.col_document_ids[col] = document_id if document_id is not None else -1
+                self.col_sections[col] = self.section_codes.setdefault(section_type, len(self.section_codes))
+                self.col_lengths[col] = len(tokens)
+                self.col_alive[col] = True
+                
+                start = self.num_postings
+                self.num_postings += len(term_counts)
+                self.post_terms = _grow(self.post_terms, self.num_postings)
+                self.post_cols = _grow(self.post_cols, self.num_postings)
+                self.post_tfs = _grow(self.post_tfs, self.num_postings)
+                
+                self.post_terms[start:self.num_postings] = [
+                    self.vocabulary.setdefault(term, len(self.vocabulary)) for term in term_counts
+                ]
+                self.post_cols[start:self.num_postings] = col
+                self.post_tfs[start:self.num_postings] = list(term_counts.values())
+                
+                self.chunk_columns[chunk_id] = col
+                self.document_chunks.setdefault(document_id, set()).add(chunk_id)
+                self._dirty = True
+    
+    def remove_chunks(self, chunk_ids: Iterable[int]):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                col = self.chunk_columns.pop(chunk_id, None)
+                if col is None:
+                    continue
+                self.col_alive[col] = False
+                
+                document_id = int(self.col_document_ids[col])
+                document_id = document_id if document_id != -1 else None
+                document_chunks = self.document_chunks.get(document_id)
+                if document_chunks is not None:
+                    document_chunks.discard(chunk_id)
+                    if not document_chunks:
+                        del self.document_chunks[document_id]
+                self._dirty = True
+    
+    def delete_document(self, document_id: int):
+        with self._lock:
+            chunk_ids = self.document_chunks.get(document_id)
+            if chunk_ids:
+                self.remove_chunks(list(chunk_ids))
+    
+    def chunk_ids_for_document(self, document_id: int) -> set:
+        with self._lock:
+            return set(self.document_chunks.get(document_id, ()))
     
     def _tokenize(self, text: str) -> List[str]:
         text_lower = text.lower()
         tokens = re.findall(r'\b\w+\b', text_lower)
         return tokens
     
-    def search(self, query: str, top_k: int = 10) -> List[Dict[str, Any]]:
-        if self.bm25_index is None:
-            return []
+    def _compact(self):
+        alive = self.col_alive[:self.num_columns]
+        remap = np.cumsum(alive, dtype=np.int64) - 1
+        keep = alive[self.post_cols[:self.num_postings]]
+        
+        self.post_terms = self.post_terms[:self.num_postings][keep]
+        self.post_cols = remap[self.post_cols[:self.num_postings][keep]].astype(np.int32)
+        self.post_tfs = self.post_tfs[:self.num_postings][keep]
+        self.num_postings = len(self.post_terms)
+        
+        self.col_chunk_ids = self.col_chunk_ids[:self.num_columns][alive]
+        self.col_document_ids = self.col_document_ids[:self.num_columns][alive]
+        self.col_sections = self.col_sections[:self.num_columns][alive]
+        self.col_lengths = self.col_lengths[:self.num_columns][alive]
+        self.num_columns = len(self.col_chunk_ids)
+        self.col_alive = np.ones(self.num_columns, dtype=bool)
+        self.chunk_columns = dict(zip(self.col_chunk_ids.tolist(), range(self.num_columns)))
+    
+    def _compile(self):
+        alive = self.col_alive[:self.num_columns]
+        if self.num_columns and alive.sum() < 0.75 * self.num_columns:
+            self._compact()
+            alive = self.col_alive[:self.num_columns]
+        
+        terms = self.post_terms[:self.num_postings]
+        cols = self.post_cols[:self.num_postings]
+        tfs = self.post_tfs[:self.num_postings]
+        
+        live = alive[cols]
+        terms, cols, tfs = terms[live], cols[live], tfs[live]
+        
+        corpus_size = int(alive.sum())
+        avgdl = float(self.col_lengths[:self.num_columns][alive].mean()) if corpus_size else 1.0
+        df = np.bincount(terms, minlength=len(self.vocabulary))
+        idf = np.log1p((corpus_size - df + 0.5) / (df + 0.5))
+        
+        norm = self.k1 * (1 - self.b + self.b * self.col_lengths[cols] / max(avgdl, 1e-9))
+        weights = idf[terms] * tfs * (self.k1 + 1) / (tfs + norm)
+        
+        order = np.argsort(terms, kind="stable")
+        self._indptr = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+        self._indices = cols[order]
+        self._weights = weights[order].astype(np.float32)
+        self._dirty = False
+        self._compiled_at = time.monotonic()
+    
+    def _refresh(self):
+        if self._dirty and time.monotonic() - self._compiled_at >= self.refresh_seconds:
+            self._compile()
+    
+    def search(self, query: str, top_k: int = 10, filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        query_terms = Counter(self._tokenize(query))
+        
+        with self._lock:
+            self._refresh()
+            
+            cols_parts = []
+            weight_parts = []
+            num_terms = len(self._indptr) - 1
+            for term, count in query_terms.items():
+                term_id = self.vocabulary.get(term)
+                if term_id is None or term_id >= num_terms:
+                    continue
+                start, end = self._indptr[term_id], self._indptr[term_id + 1]
+                if start == end:
+                    continue
+                cols_parts.append(self._indices[start:end])
+                weight_parts.append(self._weights[start:end] * count)
+            
+            if not cols_parts:
+                return []
+            
+            cols = np.concatenate(cols_parts)
+            weights = np.concatenate(weight_parts)
+            if len(cols) * 8 > self.num_columns:
+                dense = np.bincount(cols, weights=weights, minlength=self.num_columns)
+                candidates = np.flatnonzero(dense)
+                scores = dense[candidates]
+            else:
+                candidates, inverse = np.unique(cols, return_inverse=True)
+                scores = np.bincount(inverse, weights=weights)
+            
+            live = self.col_alive[candidates]
+            if filters:
+                document_ids, section_types = parse_filters(filters)
+                if document_ids is not None:
+                    live &= np.isin(self.col_document_ids[candidates], document_ids)
+                if section_types is not None:
+                    codes = [self.section_codes[s] for s in section_types if s in self.section_codes]
+                    live &= np.isin(self.col_sections[candidates], codes)
+            if not live.all():
+                candidates, scores = candidates[live], scores[live]
+            
+            if len(scores) > top_k:
+                top = np.argpartition(-scores, top_k - 1)[:top_k]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            
+            sections = {code: section for section, code in self.section_codes.items()}
+            results = []
+            for i in top:
+                col = candidates[i]
+                document_id = int(self.col_document_ids[col])
+                results.append({
+                    "chunk_id": int(self.col_chunk_ids[col]),
+                    "bm25_score": float(scores[i]),
+                    "metadata": {
+                        "document_id": document_id if document_id != -1 else None,
+                        "section_type": sections[int(self.col_sections[col])]
+                    }
+                })
+            
+            return results
+    
+    def save_index(self, generation=None):
+        """Write the whole index; called at FAISS checkpoints and shutdown, not after every write."""
+        with self._lock:
+            self._compile()
+            self.index_path.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.index_file.with_name(self.index_file.stem + ".tmp.npz")
+            sections = sorted(self.section_codes, key=self.section_codes.get)
+            np.savez(
+                tmp_file,
+                vocabulary=np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str),
+                sections=np.array(["" if s is None else s for s in sections], dtype=str),
+                section_is_none=np.array([s is None for s in sections], dtype=bool),
+                col_chunk_ids=self.col_chunk_ids[:self.num_columns],
+                col_document_ids=self.col_document_ids[:self.num_columns],
+                col_sections=self.col_sections[:self.num_columns],
+                col_lengths=self.col_lengths[:self.num_columns],
+                col_alive=self.col_alive[:self.num_columns],
+                post_terms=self.post_terms[:self.num_postings],
+                post_cols=self.post_cols[:self.num_postings],
+                post_tfs=self.post_tfs[:self.num_postings],
+                generation=np.array(json.dumps(generation))
+            )
+            tmp_file.replace(self.index_file)
+            self.generation = generation
+    
+    def load_index(self) -> bool:
+        if not self.index_file.exists():
+            return False
         
-        tokenized_query = self._tokenize(query)
-        scores = self.bm25_index.get_scores(tokenized_query)
+        self._loaded_mtime = self.index_file.stat().st_mtime_ns
+        with np.load(self.index_file) as state:
+            self._load_state(state)
         
-        scored_chunks = [
-            {
-                "chunk_id": self.chunk_ids[i],
-                "bm25_score": float(score),
-                "metadata": self.chunks[i].get("metadata", {})
+        return True
+    
+    def _saved_generation(self, state):
+        return json.loads(str(state["generation"])) if "generation" in state.files else None
+    
+    def _load_state(self, state):
+        with self._lock:
+            self._reset()
+            self.vocabulary = {term: i for i, term in enumerate(state["vocabulary"].tolist())}
+            self.section_codes = {
+                (None if is_none else section): i
+                for i, (section, is_none) in enumerate(zip(state["sections"].tolist(), state["section_is_none"].tolist()))
             }
-            for i, score in enumerate(scores)
-        ]
+            self.col_chunk_ids = state["col_chunk_ids"]
+            self.col_document_ids = state["col_document_ids"]
+            self.col_sections = state["col_sections"]
+            self.col_lengths = state["col_lengths"]
+            self.col_alive = state["col_alive"]
+            self.num_columns = len(self.col_chunk_ids)
+            self.post_terms = state["post_terms"]
+            self.post_cols = state["post_cols"]
+            self.post_tfs = state["post_tfs"]
+            self.num_postings = len(self.post_terms)
+            self.generation = self._saved_generation(state)
+            
+            alive_cols = np.flatnonzero(self.col_alive)
+            chunk_ids = self.col_chunk_ids[alive_cols].tolist()
+            self.chunk_columns = dict(zip(chunk_ids, alive_cols.tolist()))
+            for chunk_id, document_id in zip(chunk_ids, self.col_document_ids[alive_cols].tolist()):
+                self.document_chunks.setdefault(document_id if document_id != -1 else None, set()).add(chunk_id)
+            self._compile()
+    
+    def reload_if_changed(self, generation=None) -> bool:
+        """Follow the file the writer process saves at each FAISS checkpoint.
         
-        scored_chunks.sort(key=lambda x: x["bm25_score"], reverse=True)
+        Only a file saved with the FAISS generation this process serves is loaded, so vector and keyword
+        results always cover the same writes; a file from a newer checkpoint waits for the FAISS reload.
+        """
+        try:
+            mtime = self.index_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._loaded_mtime and self.generation == generation:
+            return False
         
-        return scored_chunks[:top_k]
+        with np.load(self.index_file) as state:
+            if self._saved_generation(state) != generation:
+                return False
+            self._load_state(state)
+        self._loaded_mtime = mtime
+        return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "total_chunks": len(self.chunk_columns),
+                "vocabulary_size": len(self.vocabulary),
+                "total_documents": len(self.document_chunks),
+                "postings": len(self._indices),
+                "matrix_bytes": int(self._indptr.nbytes + self._indices.nbytes + self._weights.nbytes)
+            }
 
 bm25_search = BM25Search()
-
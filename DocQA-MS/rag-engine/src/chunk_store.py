@@ -0,0 +1,121 @@
+import numpy as np
+from typing import List, Dict, Any, Optional, Sequence
+from sqlalchemy import Table, Column, LargeBinary, bindparam, insert, inspect, null, select, text, update
+from config import EMBEDDING_DIMENSION, CHUNK_EMBEDDING_DTYPE
+
+# Little-endian whatever the host, so stored bytes stay portable
+EMBEDDING_DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+def chunk_table(model) -> Table:
+    """The model's chunks table with the embedding_bytes column, which the shared ORM model does not map."""
+    table = model.__table__
+    if "embedding_bytes" not in table.c:
+        table.append_column(Column("embedding_bytes", LargeBinary, nullable=True))
+    return table
+
+def ensure_schema(engine, table: Table):
+    """Add embedding_bytes to an existing chunks table; new rows leave the legacy embedding_vector empty."""
+    columns = {column["name"]: column for column in inspect(engine).get_columns(table.name)}
+    with engine.begin() as connection:
+        if "embedding_bytes" not in columns:
+            binary_type = LargeBinary().compile(dialect=engine.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN embedding_bytes {binary_type}"))
+        if engine.dialect.name == "postgresql" and not columns.get("embedding_vector", {"nullable": True})["nullable"]:
+            connection.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN embedding_vector DROP NOT NULL"))
+
+def encode_embeddings(embeddings: np.ndarray, dtype: str = CHUNK_EMBEDDING_DTYPE) -> List[bytes]:
+    packed = np.ascontiguousarray(embeddings, dtype=EMBEDDING_DTYPES[dtype])
+    return [row.tobytes() for row in packed]
+
+def decode_embeddings(blobs: Sequence[bytes], dimension: int = EMBEDDING_DIMENSION) -> np.ndarray:
+    """float32 matrix from stored embeddings; a row's byte length tells whether it was float32 or float16."""
+    embeddings = np.empty((len(blobs), dimension), dtype=np.float32)
+    widths = np.fromiter((len(blob) for blob in blobs), dtype=np.int64, count=len(blobs))
+    decoded = np.zeros(len(blobs), dtype=bool)
+    for dtype in EMBEDDING_DTYPES.values():
+        rows = np.flatnonzero(widths == dimension * np.dtype(dtype).itemsize)
+        if len(rows) == len(blobs):
+            return np.frombuffer(b"".join(blobs), dtype=dtype).reshape(len(blobs), dimension).astype(np.float32)
+        if len(rows):
+            embeddings[rows] = np.frombuffer(b"".join(blobs[i] for i in rows), dtype=dtype).reshape(len(rows), dimension)
+            decoded[rows] = True
+    if not decoded.all():
+        width = int(widths[~decoded][0])
+        raise ValueError(f"Embedding de {width} octets: attendu {dimension} valeurs float32 ou float16")
+    return embeddings
+
+def stored_embeddings(
+    blobs: Sequence[Optional[bytes]],
+    vectors: Sequence[Optional[List[float]]],
+    dimension: int = EMBEDDING_DIMENSION
+) -> np.ndarray:
+    """Embeddings of rows read with both columns: embedding_bytes when set, else the legacy embedding_vector."""
+    binary = [i for i, blob in enumerate(blobs) if blob is not None]
+    if len(binary) == len(blobs):
+        return decode_embeddings(blobs, dimension)
+    embeddings = np.empty((len(blobs), dimension), dtype=np.float32)
+    if binary:
+        embeddings[binary] = decode_embeddings([blobs[i] for i in binary], dimension)
+    for i, (blob, vector) in enumerate(zip(blobs, vectors)):
+        if blob is None:
+            embeddings[i] = vector
+    return embeddings
+
+def insert_chunks(db, table: Table, rows: List[Dict[str, Any]]) -> List[int]:
+    """Insert rows in one statement batch and return their ids in the same order."""
+    if not rows:
+        return []
+    result = db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows)
+    return list(result.scalars())
+
+def migrate_embeddings(
+    engine,
+    table: Table,
+    batch_size: int = 1000,
+    dtype: str = CHUNK_EMBEDDING_DTYPE,
+    drop_vectors: bool = False
+) -> int:
+    """Backfill embedding_bytes from embedding_vector, batch by batch; safe to stop and rerun.
+    
+    With drop_vectors the legacy column is cleared as rows are converted (Postgres only gives the space
+    back to the OS after VACUUM FULL).
+    """
+    ensure_schema(engine, table)
+    
+    values = {"embedding_bytes": bindparam("blob")}
+    if drop_vectors:
+        values["embedding_vector"] = null()
+    convert = update(table).where(table.c.id == bindparam("chunk_id")).values(**values)
+    
+    migrated = 0
+    last_id = None
+    while True:
+        query = (
+            select(table.c.id, table.c.embedding_vector)
+            .where(table.c.embedding_bytes.is_(None), table.c.embedding_vector.isnot(None))
+            .order_by(table.c.id)
+            .limit(batch_size)
+        )
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        
+        with engine.begin() as connection:
+            rows = connection.execute(query).all()
+            if not rows:
+                break
+            blobs = encode_embeddings(np.array([row.embedding_vector for row in rows], dtype=np.float32), dtype)
+            connection.execute(convert, [{"chunk_id": row.id, "blob": blob} for row, blob in zip(rows, blobs)])
+        
+        migrated += len(rows)
+        last_id = rows[-1].id
+        print(f"Migrated {migrated} chunk embeddings (last id {last_id}).", flush=True)
+    
+    if drop_vectors:
+        with engine.begin() as connection:
+            connection.execute(
+                update(table)
+                .where(table.c.embedding_bytes.isnot(None), table.c.embedding_vector.isnot(None))
+                .values(embedding_vector=null())
+            )
+    
+    return migrated
@@ -1,10 +1,48 @@
 import re
+import time
 import warnings
-from typing import List, Dict, Any
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Iterable, Iterator, Tuple
 from transformers import AutoTokenizer
+from config import CHUNK_BATCH_SIZE, CHUNK_WORKERS
 
 warnings.filterwarnings("ignore", message=".*sequence length.*")
 
+def _line_starts(text: str) -> List[int]:
+    return [0] + [match.end() for match in re.finditer("\n", text)]
+
+def _keyword_trie(keywords: Iterable[str]) -> str:
+    """Regex alternation of literal keywords factored by common prefix, longest match first."""
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return f"(?:{body})?"
+        return body
+    
+    return build(trie)
+
+def _case_folding(chars: str) -> Dict[int, str]:
+    """Lowercase characters that re.IGNORECASE treats as one of chars without lower() mapping them to it."""
+    chars = sorted(set(chars))
+    candidates = re.compile("[" + re.escape("".join(chars)) + "]", re.IGNORECASE)
+    folding = {}
+    for match in candidates.finditer("".join(map(chr, range(0x10000)))):
+        char = match.group()
+        if char not in chars and char.lower() == char:
+            folding[ord(char)] = next(c for c in chars if re.fullmatch(re.escape(c), char, re.IGNORECASE))
+    return folding
+
 class MedicalChunker:
     def __init__(self, chunk_size: int = 512, chunk_overlap: int = 50):
         self.chunk_size = chunk_size
@@ -14,113 +52,195 @@ class MedicalChunker:
             model_max_length=512
         )
         
-        self.section_patterns = {
+        # Keywords opening each section, in priority order: a line naming several types takes the first
+        self.section_keywords = {
             "anamnese": [
-                r"(?:anamnèse|anamnese|histoire|histoire de la maladie)",
-                r"(?:motif|raison|consultation)",
-                r"(?:antécédents|antecedents)"
+                "anamnèse", "anamnese", "histoire", "histoire de la maladie",
+                "motif", "raison", "consultation",
+                "antécédents", "antecedents"
             ],
             "diagnostic": [
-                r"(?:diagnostic|diagnostique|conclusion)",
-                r"(?:impression|impression clinique)",
-                r"(?:hypothèse|hypothese diagnostique)"
+                "diagnostic", "diagnostique", "conclusion",
+                "impression", "impression clinique",
+                "hypothèse", "hypothese diagnostique"
             ],
             "traitement": [
-                r"(?:traitement|therapeutique|thérapeutique)",
-                r"(?:prescription|médicaments|medicaments)",
-                r"(?:plan de traitement)"
+                "traitement", "therapeutique", "thérapeutique",
+                "prescription", "médicaments", "medicaments",
+                "plan de traitement"
             ],
             "examen": [
-                r"(?:examen|examen clinique|examen physique)",
-                r"(?:observations|observation)",
-                r"(?:signes cliniques)"
+                "examen", "examen clinique", "examen physique",
+                "observations", "observation",
+                "signes cliniques"
             ],
             "evolution": [
-                r"(?:évolution|evolution|suivi)",
-                r"(?:prognostic|pronostic)",
-                r"(?:suivi|follow-up)"
+                "évolution", "evolution", "suivi",
+                "prognostic", "pronostic",
+                "suivi", "follow-up"
             ]
         }
+        
+        # Keywords are matched case-sensitively against lowercased text, with the few characters that
+        # case-insensitive matching would also accept ("ſ" for "s") folded onto their keyword letter
+        self._section_types = list(self.section_keywords)
+        self._keyword_priority = {}
+        for priority, keywords in enumerate(self.section_keywords.values()):
+            for keyword in keywords:
+                self._keyword_priority.setdefault(keyword, priority)
+        # The scanner reports the longest keyword at each position, which must also stand for its prefixes
+        for keyword in self._keyword_priority:
+            self._keyword_priority[keyword] = min(
+                priority for other, priority in self._keyword_priority.items() if keyword.startswith(other)
+            )
+        self._section_folding = _case_folding("".join(self._keyword_priority))
+        self._section_folded_chars = re.compile("[" + re.escape("".join(map(chr, self._section_folding))) + "]" if self._section_folding else "(?!)")
+        # Zero-width so that overlapping keywords are all seen
+        self._section_scanner = re.compile(f"(?=({_keyword_trie(self._keyword_priority)}))")
+    
+    def _line_types(self, text: str) -> Dict[int, str]:
+        """Section type of every line holding a keyword, keyed by the line's character offset."""
+        lowered = text.lower()
+        offsets = None
+        if len(lowered) != len(text):
+            # A few characters lowercase to several ("İ"): map line offsets back onto the original text
+            offsets = dict(zip(_line_starts(lowered), _line_starts(text)))
+        
+        scanned = lowered
+        if self._section_folded_chars.search(lowered):
+            scanned = lowered.translate(self._section_folding)
+        
+        priorities = {}
+        for match in self._section_scanner.finditer(scanned):
+            line_start = lowered.rfind("\n", 0, match.start()) + 1
+            priority = self._keyword_priority[match.group(1)]
+            if priority < priorities.get(line_start, len(self._section_types)):
+                priorities[line_start] = priority
+        
+        return {
+            offsets[line_start] if offsets else line_start: self._section_types[priority]
+            for line_start, priority in priorities.items()
+        }
     
     def detect_sections(self, text: str) -> List[Dict[str, Any]]:
+        """Split text at lines naming a new section; start/end are character offsets into text."""
         sections = []
-        lines = text.split('\n')
         current_section = None
         current_start = 0
         
-        for i, line in enumerate(lines):
-            line_lower = line.lower().strip()
-            detected_type = None
-            
-            for section_type, patterns in self.section_patterns.items():
-                for pattern in patterns:
-                    if re.search(pattern, line_lower, re.IGNORECASE):
-                        detected_type = section_type
-                        break
-                if detected_type:
-                    break
-            
-            if detected_type and detected_type != current_section:
+        for line_start, detected_type in self._line_types(text).items():
+            if detected_type != current_section:
                 if current_section:
+                    # The section ends before the newline that closes its last line
                     sections.append({
                         "type": current_section,
                         "start": current_start,
-                        "end": i,
-                        "text": "\n".join(lines[current_start:i])
+                        "end": line_start - 1,
+                        "text": text[current_start:line_start - 1]
                     })
                 current_section = detected_type
-                current_start = i
+                current_start = line_start
         
         if current_section:
             sections.append({
                 "type": current_section,
                 "start": current_start,
-                "end": len(lines),
-                "text": "\n".join(lines[current_start:])
+                "end": len(text),
+                "text": text[current_start:]
             })
         
         if not sections:
             sections.append({
                 "type": "general",
                 "start": 0,
-                "end": len(lines),
+                "end": len(text),
                 "text": text
             })
         
         return sections
     
     def chunk_text(self, text: str, metadata: Dict[str, Any] = None) -> List[Dict[str, Any]]:
-        print(f"Detecting sections in text of length {len(text)}...", flush=True)
-        sections = self.detect_sections(text)
-        print(f"Found {len(sections)} sections. Starting chunking...", flush=True)
-        chunks = []
-        
-        for section in sections:
-            section_text = section["text"]
-            section_type = section["type"]
-            
-            section_chunks = self._chunk_section(
-                section_text,
-                section_type,
-                metadata or {}
-            )
-            chunks.extend(section_chunks)
-        
+        chunks, _ = self._chunk_batch([{"content": text, "metadata": metadata}])
         return chunks
     
-    def _chunk_section(self, text: str, section_type: str, base_metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
-        print(f"Tokenizing section '{section_type}' ({len(text)} chars)...", flush=True)
-        tokens = self.tokenizer.encode(text, add_special_tokens=False)
-        print(f"Generated {len(tokens)} tokens. Splitting into chunks...", flush=True)
+    def chunk_documents(
+        self,
+        documents: Iterable[Dict[str, Any]],
+        batch_size: int = CHUNK_BATCH_SIZE,
+        workers: int = CHUNK_WORKERS
+    ) -> "ChunkStream":
+        """Chunk many {"document_id", "content", "metadata"} documents, streaming the chunks as batches finish.
         
-        if len(tokens) <= self.chunk_size:
+        Each batch of documents is tokenized in a single call to the Rust tokenizer. With workers > 0 the
+        batches are spread over a process pool, at most two per worker in flight, so a generator of
+        documents is never read far ahead of the consumer.
+        """
+        batches = _batched(documents, batch_size)
+        if workers > 0:
+            return ChunkStream(self._chunk_batches_in_pool(batches, workers))
+        return ChunkStream((*self._chunk_batch(batch), len(batch)) for batch in batches)
+    
+    def _chunk_batches_in_pool(self, batches: Iterator[List[Dict[str, Any]]], workers: int) -> Iterator[Tuple[List[Dict[str, Any]], int, int]]:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append((executor.submit(_chunk_batch_in_worker, batch), len(batch)))
+                if len(pending) >= 2 * workers:
+                    future, num_documents = pending.popleft()
+                    yield (*future.result(), num_documents)
+            while pending:
+                future, num_documents = pending.popleft()
+                yield (*future.result(), num_documents)
+    
+    def _chunk_batch(self, documents: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+        """Chunks of a list of documents, in order, and the number of tokens they held."""
+        sections = [self.detect_sections(document.get("content") or "") for document in documents]
+        texts = [section["text"] for document_sections in sections for section in document_sections]
+        offsets = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"] if texts else []
+        
+        chunks = []
+        num_tokens = 0
+        position = 0
+        for document, document_sections in zip(documents, sections):
+            for section in document_sections:
+                section_offsets = offsets[position]
+                position += 1
+                num_tokens += len(section_offsets)
+                section_chunks = self._split_section(
+                    section["text"],
+                    section["type"],
+                    document.get("metadata") or {},
+                    section_offsets,
+                    char_offset=section["start"]
+                )
+                if "document_id" in document:
+                    for chunk in section_chunks:
+                        chunk["document_id"] = document["document_id"]
+                chunks.extend(section_chunks)
+        return chunks, num_tokens
+    
+    def _split_section(
+        self,
+        text: str,
+        section_type: str,
+        base_metadata: Dict[str, Any],
+        offsets: List[Tuple[int, int]],
+        char_offset: int = 0
+    ) -> List[Dict[str, Any]]:
+        """Split a section into token windows; char_start/char_end locate each chunk in the whole document."""
+        num_tokens = len(offsets)
+        if num_tokens <= self.chunk_size:
             return [{
                 "text": text,
                 "position": 0,
                 "metadata": {
                     **base_metadata,
                     "section_type": section_type,
-                    "chunk_index": 0
+                    "chunk_index": 0,
+                    "token_start": 0,
+                    "token_end": num_tokens,
+                    "char_start": char_offset,
+                    "char_end": char_offset + len(text)
                 }
             }]
         
@@ -128,34 +248,86 @@ class MedicalChunker:
         start = 0
         chunk_index = 0
         
-        while start < len(tokens):
-            end = min(start + self.chunk_size, len(tokens))
-            chunk_tokens = tokens[start:end]
-            chunk_text = self.tokenizer.decode(chunk_tokens, skip_special_tokens=True)
+        while start < num_tokens:
+            end = min(start + self.chunk_size, num_tokens)
+            # Windows are sliced from the source text through the fast tokenizer's offsets rather than
+            # decoded back from token ids, so chunks keep the original spelling and spacing
+            char_start, char_end = offsets[start][0], offsets[end - 1][1]
             
             chunks.append({
-                "text": chunk_text,
+                "text": text[char_start:char_end],
                 "position": chunk_index,
                 "metadata": {
                     **base_metadata,
                     "section_type": section_type,
                     "chunk_index": chunk_index,
                     "token_start": start,
-                    "token_end": end
+                    "token_end": end,
+                    "char_start": char_offset + char_start,
+                    "char_end": char_offset + char_end
                 }
             })
             
-            if end == len(tokens):
+            if end == num_tokens:
                 break
-                
+            
             start = end - self.chunk_overlap
             chunk_index += 1
-            
-            if chunk_index % 100 == 0:
-                print(f"Processed {chunk_index} chunks...", flush=True)
         
-        print(f"Finished section. Total chunks: {len(chunks)}", flush=True)
         return chunks
 
+class ChunkStream:
+    """Chunks of many documents in order; get_stats() reports the throughput of what was read so far."""
+    
+    def __init__(self, batches: Iterator[Tuple[List[Dict[str, Any]], int, int]]):
+        self._batches = batches
+        self.documents = 0
+        self.chunks = 0
+        self.tokens = 0
+        # Time spent producing chunks, not time the consumer spends between them
+        self.seconds = 0.0
+    
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        while True:
+            start_time = time.perf_counter()
+            batch = next(self._batches, None)
+            self.seconds += time.perf_counter() - start_time
+            if batch is None:
+                return
+            chunks, num_tokens, num_documents = batch
+            self.documents += num_documents
+            self.chunks += len(chunks)
+            self.tokens += num_tokens
+            yield from chunks
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "documents": self.documents,
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "seconds": self.seconds,
+            "docs_per_second": self.documents / self.seconds if self.seconds else 0.0,
+            "tokens_per_second": self.tokens / self.seconds if self.seconds else 0.0
+        }
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+_worker_chunker = None
+
+def _init_worker(chunker: MedicalChunker):
+    global _worker_chunker
+    _worker_chunker = chunker
+
+def _chunk_batch_in_worker(documents: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    return _worker_chunker._chunk_batch(documents)
+
 chunker = MedicalChunker()
 
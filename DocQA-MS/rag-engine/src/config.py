@@ -14,6 +14,15 @@ RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", "5672"))
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "rabbitmq_user")
 RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "rabbitmq_pass")
 RABBITMQ_QUEUE_INDEXER = "indexer_queue"
+# Indexing messages are delivered INDEXER_PREFETCH_COUNT at a time and indexed together once the batch holds
+# about INDEXER_BATCH_MAX_CHUNKS chunks or its first message has waited INDEXER_BATCH_MAX_WAIT_MS
+INDEXER_PREFETCH_COUNT = int(os.getenv("INDEXER_PREFETCH_COUNT", "32"))
+INDEXER_BATCH_MAX_CHUNKS = int(os.getenv("INDEXER_BATCH_MAX_CHUNKS", "256"))
+INDEXER_BATCH_MAX_WAIT_MS = float(os.getenv("INDEXER_BATCH_MAX_WAIT_MS", "200"))
+# How long shutdown waits for the consumer to finish the batch it is indexing
+INDEXER_STOP_TIMEOUT_SECONDS = float(os.getenv("INDEXER_STOP_TIMEOUT_SECONDS", "30"))
+# How often the consumer re-reads the indexer queue depth reported on /metrics
+INDEXER_QUEUE_DEPTH_REFRESH_SECONDS = float(os.getenv("INDEXER_QUEUE_DEPTH_REFRESH_SECONDS", "5"))
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
@@ -24,12 +33,62 @@ SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8004"))
 FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "/app/faiss_index")
 EMBEDDING_MODEL = "paraphrase-multilingual-mpnet-base-v2"
 EMBEDDING_DIMENSION = 768
+# "torch" (SentenceTransformer), "onnx" or "onnx-int8" (dynamically quantized); ONNX graphs are exported
+# under EMBEDDING_ONNX_PATH on first use
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH", "/app/onnx_models")
+EMBEDDING_ONNX_THREADS = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))
+# How chunk embeddings are stored in Postgres: "float32" (exact) or "float16" (half the size)
+CHUNK_EMBEDDING_DTYPE = os.getenv("CHUNK_EMBEDDING_DTYPE", "float32")
 
 CHUNK_SIZE = 512
 CHUNK_OVERLAP = 50
+# Documents tokenized per call to the fast tokenizer, and processes used by chunk_documents (0: in process)
+CHUNK_BATCH_SIZE = int(os.getenv("CHUNK_BATCH_SIZE", "32"))
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", "0"))
 
+# Built with faiss.index_factory; {nlist} is filled in at training time and {M} from FAISS_HNSW_M.
+# Optional refinement suffix ",RFlat" or ",Refine(SQ8)", e.g. "IVF{nlist},SQ8", "IVF{nlist},PQ96,Refine(SQ8)" or "HNSW{M},Flat"
+FAISS_INDEX_FACTORY = os.getenv("FAISS_INDEX_FACTORY", "IVF{nlist},Flat")
+FAISS_REFINE_K_FACTOR = int(os.getenv("FAISS_REFINE_K_FACTOR", "10"))
 FAISS_NLIST = 100
 FAISS_NPROBE = 10
+FAISS_IVF_MIN_VECTORS = int(os.getenv("FAISS_IVF_MIN_VECTORS", "10000"))
+FAISS_NLIST_PER_SQRT_N = float(os.getenv("FAISS_NLIST_PER_SQRT_N", "4"))
+FAISS_TRAINING_SAMPLE_SIZE = int(os.getenv("FAISS_TRAINING_SAMPLE_SIZE", "65536"))
+FAISS_RETRAIN_GROWTH = float(os.getenv("FAISS_RETRAIN_GROWTH", "2.0"))
+FAISS_RETRAIN_IMBALANCE = float(os.getenv("FAISS_RETRAIN_IMBALANCE", "5.0"))
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "128"))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+# HNSW cannot remove vectors: deleted ids are tombstoned and the graph is rebuilt past this dead fraction
+FAISS_HNSW_REBUILD_DEAD_RATIO = float(os.getenv("FAISS_HNSW_REBUILD_DEAD_RATIO", "0.2"))
+FAISS_CHECKPOINT_WAL_BYTES = int(os.getenv("FAISS_CHECKPOINT_WAL_BYTES", str(256 * 1024 * 1024)))
+FAISS_CHECKPOINT_INTERVAL_SECONDS = float(os.getenv("FAISS_CHECKPOINT_INTERVAL_SECONDS", "300"))
+# "standalone": every process owns its index. "shared": uvicorn workers elect one writer through a file lock,
+# the others serve memory-mapped copies of the files it publishes at each checkpoint
+FAISS_SERVING_MODE = os.getenv("FAISS_SERVING_MODE", "standalone")
+FAISS_RELOAD_INTERVAL_SECONDS = float(os.getenv("FAISS_RELOAD_INTERVAL_SECONDS", "2.0"))
+# Above 1, vectors are split by document id over independent indexes searched in parallel and merged
+FAISS_NUM_SHARDS = int(os.getenv("FAISS_NUM_SHARDS", "1"))
+FAISS_SHARD_SEARCH_THREADS = int(os.getenv("FAISS_SHARD_SEARCH_THREADS", "0"))
+
+BM25_REFRESH_SECONDS = float(os.getenv("BM25_REFRESH_SECONDS", "1.0"))
+
+CHUNK_CACHE_SIZE = int(os.getenv("CHUNK_CACHE_SIZE", "10000"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "3600"))
+
+EMBED_MICRO_BATCHING = os.getenv("EMBED_MICRO_BATCHING", "true").lower() == "true"
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "3"))
+EMBED_MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "32"))
+# Padded tokens per document embedding batch (batch size x longest text): 32 texts at the model's 128-token limit
+EMBED_MAX_BATCH_TOKENS = int(os.getenv("EMBED_MAX_BATCH_TOKENS", "4096"))
+
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4"))
+SEARCH_QUEUE_SIZE = int(os.getenv("SEARCH_QUEUE_SIZE", "64"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
 
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 
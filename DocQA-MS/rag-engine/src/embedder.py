@@ -1,58 +1,103 @@
+import re
+import unicodedata
 import numpy as np
 import threading
-from sentence_transformers import SentenceTransformer
-from typing import List, Union
-from config import EMBEDDING_MODEL, EMBEDDING_DIMENSION
+from typing import List, Union, Dict, Any
+from cache import LRUCache
+from micro_batcher import MicroBatcher
+from embedding_backends import create_backend, parity_check, token_budget_batches
+from config import (
+    EMBEDDING_MODEL,
+    EMBEDDING_DIMENSION,
+    EMBEDDING_BACKEND,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL_SECONDS,
+    EMBED_MICRO_BATCHING,
+    EMBED_BATCH_WINDOW_MS,
+    EMBED_MAX_BATCH_SIZE,
+    EMBED_MAX_BATCH_TOKENS
+)
 
 class Embedder:
     def __init__(self):
         self.model = None
         self.model_name = EMBEDDING_MODEL
+        self.backend_name = EMBEDDING_BACKEND
+        # Quantized graphs give slightly different vectors, so they are cached apart from the reference model's
+        self.model_id = EMBEDDING_MODEL if EMBEDDING_BACKEND == "torch" else f"{EMBEDDING_MODEL}@{EMBEDDING_BACKEND}"
         self._lock = threading.Lock()
+        self.query_cache = LRUCache(QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL_SECONDS)
+        self.batcher = MicroBatcher(
+            self._encode_queries,
+            window_ms=EMBED_BATCH_WINDOW_MS,
+            max_batch_size=EMBED_MAX_BATCH_SIZE
+        ) if EMBED_MICRO_BATCHING else None
     
     def load_model(self):
         with self._lock:
             if self.model is None:
-                self.model = SentenceTransformer(self.model_name)
+                self.model = create_backend(self.backend_name, self.model_name)
         return self.model
     
+    def normalize_query(self, text: str) -> str:
+        text = unicodedata.normalize("NFC", text)
+        return re.sub(r"\s+", " ", text).strip()
+    
     def embed_text(self, text: Union[str, List[str]]) -> np.ndarray:
-        if self.model is None:
-            self.load_model()
-        
         if isinstance(text, str):
             text = [text]
         
         max_chars = 1500
-        text = [t[:max_chars] if len(t) > max_chars else t for t in text]
+        text = [self.normalize_query(t)[:max_chars] for t in text]
         
-        embeddings = self.model.encode(
-            text,
-            convert_to_numpy=True,
-            normalize_embeddings=True,
-            show_progress_bar=False
-        )
+        keys = [(self.model_id, t) for t in text]
+        cached = self.query_cache.get_many(keys)
+        missing = list(dict.fromkeys(key for key in keys if key not in cached))
         
-        return embeddings
+        if missing:
+            if self.batcher is not None:
+                futures = [self.batcher.submit(t) for _, t in missing]
+                embeddings = [future.result() for future in futures]
+            else:
+                embeddings = self._encode_queries([t for _, t in missing])
+            
+            for key, embedding in zip(missing, embeddings):
+                cached[key] = embedding.copy()
+                self.query_cache.put(key, cached[key])
+        
+        return np.stack([cached[key] for key in keys])
     
-    def embed_batch(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+    def _encode_queries(self, texts: List[str]) -> np.ndarray:
         if self.model is None:
             self.load_model()
         
-        max_chars = 1500
-        texts = [t[:max_chars] if len(t) > max_chars else t for t in texts]
+        return self.model.encode(texts, batch_size=max(len(texts), 1))
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        return self.query_cache.get_stats()
+    
+    def get_batching_stats(self) -> Dict[str, Any]:
+        if self.batcher is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.batcher.get_stats()}
+    
+    def embed_batch(self, texts: List[str], max_batch_tokens: int = EMBED_MAX_BATCH_TOKENS) -> np.ndarray:
+        """Embed texts in order, tokenized once and grouped by length so short texts are not padded to long ones."""
+        if self.model is None:
+            self.load_model()
         
-        print(f"Embedding batch of {len(texts)} texts...", flush=True)
-        embeddings = self.model.encode(
-            texts,
-            batch_size=batch_size,
-            convert_to_numpy=True,
-            normalize_embeddings=True,
-            show_progress_bar=True
-        )
-        print("Embedding complete.", flush=True)
+        input_ids = self.model.tokenize(texts) if texts else []
+        embeddings = np.zeros((len(texts), self.model.dimension), dtype=np.float32)
+        for batch in token_budget_batches([len(ids) for ids in input_ids], max_batch_tokens):
+            embeddings[batch] = self.model.encode_ids([input_ids[i] for i in batch])
         
         return embeddings
+    
+    def check_parity(self, texts: List[str], reference_backend: str = "torch") -> Dict[str, Any]:
+        """Cosine agreement of the configured backend with the reference model over sample texts."""
+        if self.model is None:
+            self.load_model()
+        return parity_check(self.model, create_backend(reference_backend, self.model_name), texts)
 
 embedder = Embedder()
 
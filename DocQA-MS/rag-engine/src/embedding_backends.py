@@ -0,0 +1,203 @@
+import json
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+from config import EMBEDDING_MODEL, EMBEDDING_BACKEND, EMBEDDING_ONNX_PATH, EMBEDDING_ONNX_THREADS
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_INT8_MODEL_FILE = "model.int8.onnx"
+ONNX_CONFIG_FILE = "embedding_config.json"
+
+def pad_batch(input_ids: List[List[int]], pad_token_id: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Right-pad token id lists to the longest one; returns (input_ids, attention_mask) as int64 arrays."""
+    width = max((len(ids) for ids in input_ids), default=0)
+    padded = np.full((len(input_ids), width), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(input_ids), width), dtype=np.int64)
+    for row, ids in enumerate(input_ids):
+        padded[row, :len(ids)] = ids
+        attention_mask[row, :len(ids)] = 1
+    return padded, attention_mask
+
+class TorchBackend:
+    """Reference backend: the full-precision SentenceTransformer."""
+    
+    name = "torch"
+    
+    def __init__(self, model_name: str = EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu").eval()
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+        self.dimension = self.model.get_sentence_embedding_dimension()
+    
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        return self.model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+    
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        # Stripped and truncated the way SentenceTransformer.encode does it
+        return self.tokenizer([text.strip() for text in texts], truncation=True, max_length=self.max_seq_length)["input_ids"]
+    
+    def encode_ids(self, input_ids: List[List[int]]) -> np.ndarray:
+        import torch
+        padded, attention_mask = pad_batch(input_ids, self.tokenizer.pad_token_id)
+        with torch.no_grad():
+            embeddings = self.model({
+                "input_ids": torch.from_numpy(padded),
+                "attention_mask": torch.from_numpy(attention_mask)
+            })["sentence_embedding"]
+        return torch.nn.functional.normalize(embeddings, dim=1).numpy()
+
+class OnnxBackend:
+    """The transformer exported to ONNX and run by onnxruntime, with pooling and normalization in NumPy."""
+    
+    def __init__(self, model_dir: Path, quantized: bool = False, threads: int = EMBEDDING_ONNX_THREADS):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        
+        self.name = "onnx-int8" if quantized else "onnx"
+        config = json.loads((Path(model_dir) / ONNX_CONFIG_FILE).read_text())
+        self.max_seq_length = config["max_seq_length"]
+        self.pooling = config["pooling"]
+        self.dimension = config["dimension"]
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            str(Path(model_dir) / (ONNX_INT8_MODEL_FILE if quantized else ONNX_MODEL_FILE)),
+            options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+    
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        input_ids = self.tokenize(texts)
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            embeddings[start:start + batch_size] = self.encode_ids(input_ids[start:start + batch_size])
+        return embeddings
+    
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer([text.strip() for text in texts], truncation=True, max_length=self.max_seq_length)["input_ids"]
+    
+    def encode_ids(self, input_ids: List[List[int]]) -> np.ndarray:
+        padded, attention_mask = pad_batch(input_ids, self.tokenizer.pad_token_id)
+        feeds = {"input_ids": padded, "attention_mask": attention_mask}
+        token_embeddings = self.session.run(None, {name: feeds[name] for name in self.input_names})[0]
+        
+        if self.pooling == "cls":
+            pooled = token_embeddings[:, 0]
+        else:
+            # Mean over real tokens, as sentence-transformers' Pooling does
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+def onnx_model_dir(model_name: str = EMBEDDING_MODEL, onnx_path: str = EMBEDDING_ONNX_PATH) -> Path:
+    return Path(onnx_path) / model_name.replace("/", "__")
+
+def export_onnx(model_name: str = EMBEDDING_MODEL, output_dir: Path = None) -> Path:
+    """Export the model's transformer to ONNX plus a dynamically int8-quantized copy. Needs torch."""
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    
+    output_dir = Path(output_dir or onnx_model_dir(model_name))
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer, pooling = model[0], model[1]
+    if not isinstance(pooling, models.Pooling) or any(not isinstance(module, models.Normalize) for module in list(model)[2:]):
+        raise ValueError(f"{model_name}: seuls les modèles Transformer + Pooling (+ Normalize) sont exportables")
+    if not (pooling.pooling_mode_mean_tokens or pooling.pooling_mode_cls_token):
+        raise ValueError(f"{model_name}: pooling non supporté par le backend ONNX")
+    
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+        
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+    
+    sample = model.tokenizer(["Exemple de phrase clinique."], return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer.auto_model.eval()),
+            (sample["input_ids"], sample["attention_mask"]),
+            str(output_dir / ONNX_MODEL_FILE),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["token_embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_embeddings": {0: "batch", 1: "sequence"}
+            },
+            opset_version=14,
+            do_constant_folding=True
+        )
+    quantize_dynamic(str(output_dir / ONNX_MODEL_FILE), str(output_dir / ONNX_INT8_MODEL_FILE), weight_type=QuantType.QInt8)
+    
+    model.tokenizer.save_pretrained(str(output_dir))
+    (output_dir / ONNX_CONFIG_FILE).write_text(json.dumps({
+        "model": model_name,
+        "max_seq_length": model.max_seq_length,
+        "pooling": "mean" if pooling.pooling_mode_mean_tokens else "cls",
+        "dimension": model.get_sentence_embedding_dimension()
+    }))
+    return output_dir
+
+def create_backend(name: str = EMBEDDING_BACKEND, model_name: str = EMBEDDING_MODEL, onnx_path: str = EMBEDDING_ONNX_PATH):
+    if name not in BACKENDS:
+        raise ValueError(f"Backend d'embedding inconnu: {name} (attendu: {', '.join(BACKENDS)})")
+    if name == "torch":
+        return TorchBackend(model_name)
+    
+    model_dir = onnx_model_dir(model_name, onnx_path)
+    if not (model_dir / ONNX_CONFIG_FILE).exists():
+        print(f"Exporting {model_name} to ONNX in {model_dir}...", flush=True)
+        export_onnx(model_name, model_dir)
+    return OnnxBackend(model_dir, quantized=name == "onnx-int8")
+
+def token_budget_batches(lengths: List[int], max_batch_tokens: int) -> List[List[int]]:
+    """Group indices longest first so that no batch exceeds max_batch_tokens once padded to its longest text.
+    
+    A text longer than the budget on its own still gets a batch of one.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # Lengths only decrease, so the batch's first text sets its padded width
+        if batch and (len(batch) + 1) * lengths[batch[0]] > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def parity_check(backend, reference, texts: List[str], batch_size: int = 32) -> Dict[str, Any]:
+    """Cosine agreement between a backend's embeddings and the reference model's on the same texts."""
+    cosines = np.sum(backend.encode(texts, batch_size) * reference.encode(texts, batch_size), axis=1)
+    return {
+        "backend": backend.name,
+        "reference": reference.name,
+        "samples": len(texts),
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+        "p01_cosine": float(np.percentile(cosines, 1))
+    }
+
+if __name__ == "__main__":
+    print(f"ONNX model exported to {export_onnx()}")
@@ -0,0 +1,89 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Any, Dict
+from config import SEARCH_WORKERS, SEARCH_QUEUE_SIZE, INGEST_WORKERS, INGEST_QUEUE_SIZE
+
+class ExecutorSaturatedError(RuntimeError):
+    pass
+
+class BoundedExecutor:
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ExecutorSaturatedError(f"File d'attente '{self.name}' saturée")
+        
+        enqueued_at = time.monotonic()
+        with self._lock:
+            self.queued += 1
+        
+        def task():
+            wait = time.monotonic() - enqueued_at
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+                self._slots.release()
+        
+        def release_if_cancelled(future: Future):
+            if future.cancelled():
+                with self._lock:
+                    self.queued -= 1
+                self._slots.release()
+        
+        try:
+            future = self._executor.submit(task)
+        except Exception:
+            with self._lock:
+                self.queued -= 1
+            self._slots.release()
+            raise
+        
+        future.add_done_callback(release_if_cancelled)
+        return future
+    
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+    
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            started = self.completed + self.running
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_ms": 1000.0 * self.total_wait / started if started else 0.0,
+                "max_wait_ms": 1000.0 * self.max_wait
+            }
+
+search_executor = BoundedExecutor("search", SEARCH_WORKERS, SEARCH_QUEUE_SIZE)
+ingest_executor = BoundedExecutor("ingest", INGEST_WORKERS, INGEST_QUEUE_SIZE)
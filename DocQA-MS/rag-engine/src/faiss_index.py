@@ -1,150 +1,772 @@
 import faiss
 import numpy as np
 import os
+import re
+import json
+import time
+import fcntl
 import pickle
-from typing import List, Dict, Any, Tuple
+import threading
+from typing import List, Dict, Any, Tuple, Optional, NamedTuple, Callable
 from pathlib import Path
-from config import FAISS_INDEX_PATH, EMBEDDING_DIMENSION, FAISS_NLIST, FAISS_NPROBE
+from faiss_wal import WriteAheadLog, OP_ADD, OP_DELETE
+from metadata_store import MetadataStore
+from reservoir import ReservoirSample
+from tombstones import TombstoneSet
+from rwlock import ReadWriteLock
+from metrics import stage_seconds
+from config import (
+    FAISS_INDEX_PATH,
+    EMBEDDING_DIMENSION,
+    FAISS_INDEX_FACTORY,
+    FAISS_REFINE_K_FACTOR,
+    FAISS_NLIST,
+    FAISS_NPROBE,
+    FAISS_IVF_MIN_VECTORS,
+    FAISS_NLIST_PER_SQRT_N,
+    FAISS_TRAINING_SAMPLE_SIZE,
+    FAISS_RETRAIN_GROWTH,
+    FAISS_RETRAIN_IMBALANCE,
+    FAISS_HNSW_M,
+    FAISS_HNSW_EF_CONSTRUCTION,
+    FAISS_HNSW_EF_SEARCH,
+    FAISS_HNSW_REBUILD_DEAD_RATIO,
+    FAISS_CHECKPOINT_WAL_BYTES,
+    FAISS_CHECKPOINT_INTERVAL_SECONDS,
+    FAISS_NUM_SHARDS
+)
+
+class ReadOnlyIndexError(RuntimeError):
+    pass
+
+FILTER_CANDIDATES_PER_RESULT = 32
+# k-means needs this many training points per centroid to converge properly
+MIN_POINTS_PER_CENTROID = 39
+RETRAIN_BATCH_SIZE = 50000
+# Graph search reaches a handful of scattered allowed ids poorly: score them exactly instead
+HNSW_EXACT_FILTER_MAX = 2048
+HNSW_MAX_FILTERED_EF = 4096
+PUBLISH_READ_ATTEMPTS = 20
+
+def parse_factory(factory: str) -> Tuple[str, Optional[str]]:
+    """Split "IVF{nlist},PQ96,Refine(SQ8)" into the base factory string and the refinement codec."""
+    base, _, last = factory.rpartition(",")
+    if last.strip() == "RFlat":
+        return base, "Flat"
+    match = re.fullmatch(r"Refine\((.+)\)", last.strip())
+    if match:
+        return base, match.group(1)
+    return factory, None
+
+class IndexSnapshot(NamedTuple):
+    """The structures one search reads, taken together so a concurrent swap cannot mix two states."""
+    index: Any
+    refine_index: Any
+    tombstones: Optional[TombstoneSet]
+    metadata_store: MetadataStore
+
+def extract_hnsw(index):
+    if isinstance(index, faiss.IndexIDMap):
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            return inner
+    return None
+
+def index_bytes(index) -> int:
+    """Approximate resident size of stored codes, ids, coarse centroids and graph links."""
+    if index is None:
+        return 0
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return ivf.ntotal * (ivf.code_size + 8) + ivf.nlist * ivf.d * 4
+    hnsw = extract_hnsw(index)
+    if hnsw is not None:
+        storage = faiss.downcast_index(hnsw.storage)
+        return index.ntotal * (storage.code_size + 16) + hnsw.hnsw.neighbors.size() * 4
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return index.ntotal * (getattr(inner, "code_size", index.d * 4) + 16)
 
 class FAISSIndex:
-    def __init__(self):
+    def __init__(
+        self,
+        index_path: str = FAISS_INDEX_PATH,
+        dimension: int = EMBEDDING_DIMENSION,
+        auto_retrain: bool = True,
+        factory: str = FAISS_INDEX_FACTORY
+    ):
         self.index = None
-        self.id_mapping = {}
-        self.metadata_store = {}
-        self.index_path = Path(FAISS_INDEX_PATH)
+        # Optional second index holding finer codes used to re-rank the base index candidates
+        self.refine_index = None
+        # Deleted ids still present in an HNSW graph; None for index types that remove in place
+        self.tombstones = None
+        self.dimension = dimension
+        self.auto_retrain = auto_retrain
+        self.factory = factory
+        self.base_factory, self.refine_codec = parse_factory(factory)
+        self._built_factory = None
+        self.metadata_store = MetadataStore()
+        self.needs_rebuild = False
+        self.index_path = Path(index_path)
         self.index_path.mkdir(parents=True, exist_ok=True)
         self.index_file = self.index_path / "faiss_index.idx"
-        self.mapping_file = self.index_path / "id_mapping.pkl"
-        self.metadata_file = self.index_path / "metadata.pkl"
+        self.refine_file = self.index_path / "faiss_refine.idx"
+        self.info_file = self.index_path / "faiss_index.json"
+        self.tombstones_file = self.index_path / "faiss_tombstones.npy"
+        self.writer_lock_file = self.index_path / "faiss_writer.lock"
+        self.legacy_mapping_file = self.index_path / "id_mapping.pkl"
+        self.metadata_file = self.index_path / "metadata.cols"
+        self.legacy_metadata_file = self.index_path / "metadata.pkl"
+        self.wal_file = self.index_path / "faiss_wal.log"
+        self.wal = None
+        self._lock = threading.RLock()
+        # Searches hold the shared side; writers take the exclusive side (after _lock) whenever they change
+        # the index, refinement codes, tombstones or metadata in place or replace them
+        self._readers = ReadWriteLock()
+        self._last_checkpoint = time.monotonic()
+        self._checkpointer = None
+        self._stop_checkpointer = threading.Event()
+        # Saves of companion indexes (BM25) run inside every checkpoint and are published with it
+        self._checkpoint_hooks: List[Callable[[], None]] = []
+        
+        self.reservoir = ReservoirSample(FAISS_TRAINING_SAMPLE_SIZE, dimension)
+        self._retrain_thread = None
+        # Writes applied while a retrain is populating the new index, replayed before the swap
+        self._pending_ops = None
+        self._trained_size = 0
+        self.retrain_count = 0
+        self.last_retrain_seconds = None
+        
+        # Readers serve memory-mapped files published by the single writer process. The generation
+        # in faiss_index.json is odd while the writer is replacing files, like a seqlock
+        self.read_only = False
+        self.generation = 0
+        self._writer_lock = None
+    
+    def _build_index(self, nlist: int) -> Tuple[Any, Any]:
+        index = faiss.index_factory(self.dimension, self.base_factory.format(nlist=nlist, M=FAISS_HNSW_M), faiss.METRIC_INNER_PRODUCT)
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is None:
+            index = faiss.IndexIDMap2(index)
+            hnsw = extract_hnsw(index)
+            if hnsw is not None:
+                hnsw.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+        elif isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ):
+            # The factory enables polysemous training, which only serves Hamming-threshold search and
+            # makes PQ training ~40x slower
+            faiss.downcast_index(ivf).do_polysemous_training = False
+        self._configure_index(index)
+        
+        refine = None
+        if self.refine_codec:
+            # A single-list IVF gives the refinement codes an id -> offset table for O(1) lookups and removals
+            refine = faiss.index_factory(self.dimension, f"IVF1,{self.refine_codec}", faiss.METRIC_INNER_PRODUCT)
+            self._configure_index(refine)
+        return index, refine
+    
+    def _new_tombstones(self, index) -> Optional[TombstoneSet]:
+        return TombstoneSet() if extract_hnsw(index) is not None else None
     
     def initialize_index(self):
-        quantizer = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-        self.index = faiss.IndexIVFFlat(quantizer, EMBEDDING_DIMENSION, FAISS_NLIST)
-        self.index.nprobe = FAISS_NPROBE
-        self.id_mapping = {}
-        self.metadata_store = {}
+        index, refine = self._build_index(FAISS_NLIST)
+        with self._readers.write():
+            self.index, self.refine_index = index, refine
+            self.tombstones = self._new_tombstones(index)
+            self._built_factory = self.factory
+            self.metadata_store = MetadataStore()
+    
+    def _configure_index(self, index=None):
+        index = index if index is not None else self.index
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = FAISS_NPROBE
+            # id -> (list, offset) table so removing a document touches only its own vectors
+            if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        hnsw = extract_hnsw(index)
+        if hnsw is not None:
+            hnsw.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+    
+    def _add_to(self, index, embeddings: np.ndarray, chunk_ids: np.ndarray, tombstones: Optional[TombstoneSet] = None):
+        if tombstones is not None:
+            # Chunk ids are database keys bound to one text, so a re-added id revives its stale copy too;
+            # search drops the duplicate and the next rebuild removes it
+            tombstones.discard(chunk_ids)
+        index.add_with_ids(embeddings, chunk_ids)
+    
+    def _remove_from(self, index, chunk_ids: np.ndarray, tombstones: Optional[TombstoneSet] = None) -> int:
+        if index is None or not index.ntotal or not len(chunk_ids):
+            return 0
+        
+        if tombstones is not None:
+            tombstones.add(chunk_ids)
+            return len(chunk_ids)
+        
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.Hashtable:
+            chunk_ids = np.ascontiguousarray(chunk_ids, dtype=np.int64)
+            return index.remove_ids(faiss.IDSelectorArray(len(chunk_ids), faiss.swig_ptr(chunk_ids)))
+        return index.remove_ids(chunk_ids)
+    
+    def _remove_ids(self, chunk_ids: np.ndarray) -> int:
+        self._remove_from(self.refine_index, chunk_ids)
+        return self._remove_from(self.index, chunk_ids, self.tombstones)
     
     def load_index(self):
-        if self.index_file.exists():
-            self.index = faiss.read_index(str(self.index_file))
-            self.index.nprobe = FAISS_NPROBE
+        with self._lock, self._readers.write():
+            if self.legacy_mapping_file.exists():
+                # Legacy L2 index addressed through id_mapping.pkl: vectors are re-added from the database
+                print("Legacy FAISS index (L2 + id_mapping.pkl) detected, rebuild required.", flush=True)
+                self.initialize_index()
+                self.needs_rebuild = True
+                return
             
-            if self.mapping_file.exists():
-                with open(self.mapping_file, 'rb') as f:
-                    self.id_mapping = pickle.load(f)
+            if self.index_file.exists():
+                self.index = faiss.read_index(str(self.index_file))
+                self._configure_index()
+                self.refine_index = None
+                if self.refine_file.exists():
+                    self.refine_index = faiss.read_index(str(self.refine_file))
+                    self._configure_index(self.refine_index)
+                self.tombstones = self._new_tombstones(self.index)
+                if self.tombstones is not None and self.tombstones_file.exists():
+                    self.tombstones = TombstoneSet.load(self.tombstones_file)
+                if self.info_file.exists():
+                    info = self._read_info()
+                    self._built_factory = info["factory"]
+                    # Resume numbering past a publish that may have been interrupted
+                    self.generation = info.get("generation", 0) + info.get("generation", 0) % 2
+                else:
+                    # Written before index types were configurable: always IVFFlat or the exact fallback
+                    ivf = faiss.try_extract_index_ivf(self.index)
+                    self._built_factory = "IVF{nlist},Flat" if ivf is not None else "flat"
+                
+                if self.metadata_file.exists():
+                    self.metadata_store = MetadataStore.load(self.metadata_file)
+                elif self.legacy_metadata_file.exists():
+                    with open(self.legacy_metadata_file, 'rb') as f:
+                        self.metadata_store = MetadataStore.from_dict(pickle.load(f))
+                    print("Migrated metadata.pkl to columnar metadata store.", flush=True)
+                    self.save_index()
+                    self.legacy_metadata_file.unlink()
+            else:
+                self.initialize_index()
             
-            if self.metadata_file.exists():
-                with open(self.metadata_file, 'rb') as f:
-                    self.metadata_store = pickle.load(f)
-        else:
-            self.initialize_index()
+            self._replay_wal()
+    
+    def _open_wal(self):
+        if self.wal is None:
+            self.wal = WriteAheadLog(self.wal_file)
+    
+    def _replay_wal(self):
+        self._open_wal()
+        records = list(self.wal.replay())
+        if not records:
+            return
+        
+        # The checkpoint may already contain part of the log: drop every id the log touches,
+        # then re-apply the records in order so replay is idempotent
+        touched = np.unique(np.concatenate([ids for _, ids, _, _ in records]))
+        self._remove_ids(touched)
+        self.metadata_store.remove(touched)
+        
+        for op, ids, vectors, metadata in records:
+            if op == OP_ADD:
+                self._apply_add(vectors, ids, metadata)
+            else:
+                self._apply_delete(ids)
+        
+        print(f"Replayed {len(records)} WAL records into FAISS index.", flush=True)
+        self.save_index()
+    
+    def _write_atomic(self, path: Path, write):
+        tmp_path = path.with_name(path.name + ".tmp")
+        write(tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def _read_info(self) -> Dict[str, Any]:
+        try:
+            return json.loads(self.info_file.read_text())
+        except FileNotFoundError:
+            return {"factory": None, "generation": 0}
+    
+    def _write_info(self):
+        self._write_atomic(
+            self.info_file,
+            lambda path: path.write_text(json.dumps({"factory": self._built_factory, "generation": self.generation}))
+        )
     
     def save_index(self):
-        if self.index is not None:
-            faiss.write_index(self.index, str(self.index_file))
+        with self._lock:
+            if self.index is None or self.read_only:
+                return
+            
+            start_time = time.perf_counter()
+            self.generation += 1
+            self._write_info()
+            
+            self._write_atomic(self.index_file, lambda path: faiss.write_index(self.index, str(path)))
+            if self.refine_index is not None:
+                self._write_atomic(self.refine_file, lambda path: faiss.write_index(self.refine_index, str(path)))
+            else:
+                self.refine_file.unlink(missing_ok=True)
+            if self.tombstones is not None:
+                self._write_atomic(self.tombstones_file, self.tombstones.save)
+            else:
+                self.tombstones_file.unlink(missing_ok=True)
+            self.metadata_store.save(self.metadata_file)
+            for hook in self._checkpoint_hooks:
+                hook()
+            
+            self.generation += 1
+            self._write_info()
+            
+            dir_fd = os.open(self.index_path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            
+            if self.wal is not None:
+                self.wal.reset()
+            self._last_checkpoint = time.monotonic()
+            stage_seconds.observe(time.perf_counter() - start_time, stage="faiss_save")
+    
+    def add_checkpoint_hook(self, hook: Callable[[], None]):
+        self._checkpoint_hooks.append(hook)
+    
+    @property
+    def published_generation(self) -> int:
+        """Generation readers see once the checkpoint in progress, if any, is published."""
+        return self.generation + self.generation % 2
+    
+    @property
+    def unsaved_writes(self) -> int:
+        """WAL records logged since the last checkpoint."""
+        return self.wal.records if self.wal is not None else 0
+    
+    def checkpoint_due(self) -> bool:
+        with self._lock:
+            return bool(self.unsaved_writes) and (
+                self.wal.size >= FAISS_CHECKPOINT_WAL_BYTES
+                or time.monotonic() - self._last_checkpoint >= FAISS_CHECKPOINT_INTERVAL_SECONDS
+            )
+    
+    def _maybe_checkpoint(self):
+        if self.checkpoint_due():
+            self.save_index()
+    
+    def acquire_writer_role(self) -> bool:
+        """Take the exclusive writer lock; held until the process exits."""
+        if self._writer_lock is None:
+            lock_file = open(self.writer_lock_file, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._writer_lock = lock_file
+        return True
+    
+    def _load_published(self) -> bool:
+        for _ in range(PUBLISH_READ_ATTEMPTS):
+            info = self._read_info()
+            generation = info.get("generation", 0)
+            if generation % 2 or not self.index_file.exists():
+                time.sleep(0.05)
+                continue
+            
+            # Inverted lists stay in the page cache shared by every reader; only ids maps and centroids
+            # are copied into the process
+            flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            index = faiss.read_index(str(self.index_file), flags)
+            refine = faiss.read_index(str(self.refine_file), flags) if self.refine_file.exists() else None
+            tombstones = None
+            if extract_hnsw(index) is not None:
+                tombstones = TombstoneSet.load(self.tombstones_file, mmap=True) if self.tombstones_file.exists() else TombstoneSet()
+            metadata_store = MetadataStore.load(self.metadata_file, mmap=True)
             
-            with open(self.mapping_file, 'wb') as f:
-                pickle.dump(self.id_mapping, f)
+            if self._read_info().get("generation", 0) != generation:
+                continue
             
-            with open(self.metadata_file, 'wb') as f:
-                pickle.dump(self.metadata_store, f)
+            for loaded in (index, refine):
+                if loaded is not None:
+                    self._configure_index(loaded)
+            with self._lock, self._readers.write():
+                self.index, self.refine_index, self.tombstones = index, refine, tombstones
+                self.metadata_store = metadata_store
+                self._built_factory = info["factory"]
+                self.generation = generation
+            return True
+        return False
+    
+    def open_read_only(self):
+        self.read_only = True
+        self.auto_retrain = False
+        if not self._load_published():
+            # Nothing published yet: serve an empty index until the writer's first checkpoint
+            with self._lock:
+                self.initialize_index()
+    
+    def reload_if_published(self) -> bool:
+        generation = self._read_info().get("generation", 0)
+        if generation == self.generation or generation % 2:
+            return False
+        return self._load_published()
+    
+    def start_checkpointer(self, checkpoint: bool = True):
+        """Background checkpoints and retrains; without checkpoint, only retrains (the caller checkpoints)."""
+        if self._checkpointer is not None:
+            return
+        
+        def run():
+            while not self._stop_checkpointer.wait(min(FAISS_CHECKPOINT_INTERVAL_SECONDS, 30)):
+                with self._lock:
+                    if checkpoint:
+                        self._maybe_checkpoint()
+                    self._maybe_retrain()
+        
+        self._checkpointer = threading.Thread(target=run, name="faiss-checkpointer", daemon=True)
+        self._checkpointer.start()
+    
+    def stop_checkpointer(self):
+        self._stop_checkpointer.set()
+    
+    def finish_rebuild(self):
+        with self._lock:
+            self.save_index()
+            # A WAL left by the index the rebuild replaced was never opened, so the checkpoint did not reset it
+            if self.wal is None:
+                self.wal_file.unlink(missing_ok=True)
+        self.legacy_mapping_file.unlink(missing_ok=True)
+        self.needs_rebuild = False
     
     def train_index(self, embeddings: np.ndarray):
         if self.index is None:
             self.initialize_index()
         
-        if not self.index.is_trained:
-            self.index.train(embeddings.astype('float32'))
+        embeddings = embeddings.astype('float32')
+        with self._readers.write():
+            if not self.index.is_trained:
+                self.index.train(embeddings)
+            if self.refine_index is not None and not self.refine_index.is_trained:
+                self.refine_index.train(embeddings)
     
-    def add_vectors(self, embeddings: np.ndarray, chunk_ids: List[int], metadata: List[Dict[str, Any]]):
-        if self.index is None:
-            self.load_index()
+    def _apply_add(self, embeddings: np.ndarray, chunk_ids: np.ndarray, metadata: List[Dict[str, Any]]):
+        with self._readers.write():
+            if not self.index.is_trained:
+                # Exact search until the corpus is large enough to train IVF centroids on a representative sample
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+                self.refine_index = None
+                self.tombstones = None
+                self._built_factory = "flat"
+            
+            self.metadata_store.add(chunk_ids, metadata)
+            
+            self._add_to(self.index, embeddings, chunk_ids, self.tombstones)
+            if self.refine_index is not None:
+                self._add_to(self.refine_index, embeddings, chunk_ids)
+        self.reservoir.add(embeddings)
+        if self._pending_ops is not None:
+            self._pending_ops.append((OP_ADD, chunk_ids, embeddings))
+    
+    def _apply_delete(self, chunk_ids: np.ndarray):
+        with self._readers.write():
+            self._remove_ids(chunk_ids)
+            self.metadata_store.remove(chunk_ids)
+        if self._pending_ops is not None:
+            self._pending_ops.append((OP_DELETE, chunk_ids, None))
+    
+    def _target_nlist(self, num_vectors: int, sample_size: int) -> int:
+        nlist = max(FAISS_NLIST, int(FAISS_NLIST_PER_SQRT_N * np.sqrt(num_vectors)))
+        return max(1, min(nlist, sample_size // MIN_POINTS_PER_CENTROID))
+    
+    def needs_retrain(self) -> bool:
+        if self.index is None or self.needs_rebuild or self.index.ntotal < FAISS_IVF_MIN_VECTORS:
+            return False
         
-        if not self.index.is_trained:
-            total_vectors_after = self.index.ntotal + len(embeddings) if hasattr(self.index, 'ntotal') else len(embeddings)
-            if total_vectors_after < FAISS_NLIST:
-                if not isinstance(self.index, faiss.IndexFlatL2):
-                    self.index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-            else:
-                self.train_index(embeddings)
+        if self._built_factory != self.factory:
+            return True
+        if self.tombstones is not None:
+            # Tombstoned and duplicated entries still cost graph hops on every search
+            dead = self.index.ntotal - self.metadata_store.live_count
+            return dead >= FAISS_HNSW_REBUILD_DEAD_RATIO * self.index.ntotal
         
-        start_id = len(self.id_mapping)
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is None:
+            # Built as configured and without lists to grow or rebalance: retraining would rebuild the same index
+            return False
         
-        for i, (chunk_id, meta) in enumerate(zip(chunk_ids, metadata)):
-            faiss_id = start_id + i
-            self.id_mapping[faiss_id] = chunk_id
-            self.metadata_store[chunk_id] = meta
+        sample_size = min(self.index.ntotal, self.reservoir.capacity)
+        if self._target_nlist(self.index.ntotal, sample_size) >= FAISS_RETRAIN_GROWTH * ivf.nlist:
+            return True
         
-        self.index.add(embeddings.astype('float32'))
-        self.save_index()
+        # Skewed lists make probes uneven; only act on it once the corpus has grown since the last training
+        return (
+            self.index.ntotal >= 1.5 * self._trained_size
+            and ivf.invlists.imbalance_factor() >= FAISS_RETRAIN_IMBALANCE
+        )
+    
+    def _maybe_retrain(self):
+        if not self.auto_retrain or self._retrain_thread is not None or not self.needs_retrain():
+            return
+        
+        self._retrain_thread = threading.Thread(target=self.retrain, name="faiss-retrain", daemon=True)
+        self._retrain_thread.start()
+    
+    def _reconstruct(self, chunk_ids: np.ndarray, snapshot: Optional[IndexSnapshot] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Caller holds the lock or reads a snapshot: ids deleted since the chunk id list was taken are skipped
+        index, refine_index, _, metadata_store = snapshot or self._snapshot()
+        chunk_ids = chunk_ids[metadata_store.lookup_rows(chunk_ids) >= 0]
+        if not len(chunk_ids):
+            return chunk_ids, np.zeros((0, self.dimension), dtype=np.float32)
+        # Prefer the refinement codes: they are the most precise copy kept in memory
+        source = refine_index if refine_index is not None else index
+        return chunk_ids, source.reconstruct_batch(chunk_ids)
+    
+    def _training_sample(self, chunk_ids: np.ndarray) -> np.ndarray:
+        wanted = min(len(chunk_ids), self.reservoir.capacity)
+        if len(self.reservoir) < wanted:
+            # The reservoir starts empty after a restart: draw a uniform sample from the index instead
+            picked = np.random.default_rng().choice(chunk_ids, size=wanted, replace=False)
+            parts = []
+            for start in range(0, len(picked), RETRAIN_BATCH_SIZE):
+                with self._lock:
+                    parts.append(self._reconstruct(picked[start:start + RETRAIN_BATCH_SIZE])[1])
+            self.reservoir.reset(np.concatenate(parts), seen=len(chunk_ids))
+        return self.reservoir.sample()
+    
+    def retrain(self):
+        with self._lock:
+            if self._pending_ops is not None:
+                return
+            self._pending_ops = []
+            chunk_ids = self.metadata_store.chunk_ids().copy()
+        
+        try:
+            started = time.monotonic()
+            sample = self._training_sample(chunk_ids)
+            nlist = self._target_nlist(len(chunk_ids), len(sample))
+            print(f"Retraining FAISS index {self.factory}: {len(chunk_ids)} vectors, nlist={nlist}, sample={len(sample)}.", flush=True)
+            
+            index, refine = self._build_index(nlist)
+            tombstones = self._new_tombstones(index)
+            targets = [(target, tombstones if target is index else None) for target in (index, refine) if target is not None]
+            for target, _ in targets:
+                if not target.is_trained:
+                    target.train(sample)
+            
+            # Copy the live vectors in batches; searches and writes keep using the current index meanwhile
+            for start in range(0, len(chunk_ids), RETRAIN_BATCH_SIZE):
+                with self._lock:
+                    ids, vectors = self._reconstruct(chunk_ids[start:start + RETRAIN_BATCH_SIZE])
+                for target, _ in targets:
+                    target.add_with_ids(vectors, ids)
+            
+            with self._lock:
+                ops = self._pending_ops
+                if ops:
+                    touched = np.unique(np.concatenate([ids for _, ids, _ in ops]))
+                    for target, target_tombstones in targets:
+                        self._remove_from(target, touched, target_tombstones)
+                    for op, ids, vectors in ops:
+                        for target, target_tombstones in targets:
+                            if op == OP_ADD:
+                                self._add_to(target, vectors, ids, target_tombstones)
+                            else:
+                                self._remove_from(target, ids, target_tombstones)
+                
+                with self._readers.write():
+                    self.index, self.refine_index, self.tombstones = index, refine, tombstones
+                    self._built_factory = self.factory
+                self._trained_size = index.ntotal
+                self.retrain_count += 1
+                self.last_retrain_seconds = time.monotonic() - started
+                self.save_index()
+                print(f"FAISS index retrained in {self.last_retrain_seconds:.1f}s ({len(ops)} writes replayed).", flush=True)
+        except Exception as e:
+            print(f"FAISS retrain failed: {e}", flush=True)
+        finally:
+            with self._lock:
+                self._pending_ops = None
+                self._retrain_thread = None
+    
+    def add_vectors(self, embeddings: np.ndarray, chunk_ids: List[int], metadata: List[Dict[str, Any]], save: bool = True):
+        if self.read_only:
+            raise ReadOnlyIndexError("FAISS index is served read-only in this process")
+        
+        with self._lock:
+            if self.index is None:
+                self.load_index()
+            
+            embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+            chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+            
+            if save:
+                self._open_wal()
+                self.wal.append_add(chunk_ids, embeddings, metadata)
+            
+            self._apply_add(embeddings, chunk_ids, metadata)
+            
+            if save:
+                self._maybe_checkpoint()
+            self._maybe_retrain()
     
-    def search(self, query_embedding: np.ndarray, k: int = 10) -> List[Dict[str, Any]]:
+    def _search_params(self, index, bitmap: Optional[np.ndarray], chunk_ids: Optional[np.ndarray], allowed: int, k: int):
+        if chunk_ids is not None:
+            selector = faiss.IDSelectorBatch(len(chunk_ids), faiss.swig_ptr(np.ascontiguousarray(chunk_ids, dtype=np.int64)))
+        else:
+            selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            # IDSelectorBitmap reads the array in place: keep it alive for the duration of the search
+            selector.bitmap_ref = bitmap
+        
+        # Built for the index the search runs on: a retrain may have swapped self.index for another type since
+        hnsw = extract_hnsw(index)
+        if hnsw is not None:
+            # Rejected nodes are still traversed: widen the beam in proportion to the filter selectivity
+            ef = max(FAISS_HNSW_EF_SEARCH, int(np.ceil(k * index.ntotal / allowed)))
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=min(ef, max(FAISS_HNSW_EF_SEARCH, HNSW_MAX_FILTERED_EF)))
+        
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is None:
+            return faiss.SearchParameters(sel=selector)
+        
+        # Probe enough lists to expect FILTER_CANDIDATES_PER_RESULT * k allowed vectors. Rejected ids
+        # are skipped before any distance computation, so the extra lists cost little
+        nprobe = min(ivf.nlist, max(FAISS_NPROBE, int(np.ceil(FILTER_CANDIDATES_PER_RESULT * k * ivf.nlist / allowed))))
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    
+    def _snapshot(self) -> IndexSnapshot:
+        return IndexSnapshot(self.index, self.refine_index, self.tombstones, self.metadata_store)
+    
+    def search(self, query_embedding: np.ndarray, k: int = 10, filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
         if self.index is None:
             self.load_index()
         
-        if self.index.ntotal == 0:
+        # FAISS lists, tombstones and metadata are changed in place by writers: they wait for the
+        # searches in flight, and a search only reads the structures it found when it started
+        with self._readers.read():
+            return self._search(self._snapshot(), query_embedding, k, filters)
+    
+    def _search(self, snapshot: IndexSnapshot, query_embedding: np.ndarray, k: int, filters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        index, refine, tombstones, metadata_store = snapshot
+        if index.ntotal == 0:
             return []
         
         query_embedding = query_embedding.astype('float32').reshape(1, -1)
         
-        distances, indices = self.index.search(query_embedding, min(k, self.index.ntotal))
+        fetch = k * FAISS_REFINE_K_FACTOR if refine is not None else k
+        hnsw = extract_hnsw(index)
         
-        results = []
-        for distance, idx in zip(distances[0], indices[0]):
-            if idx == -1:
-                continue
-            
-            chunk_id = self.id_mapping.get(idx)
-            if chunk_id is None:
-                continue
-            
-            metadata = self.metadata_store.get(chunk_id, {})
-            
-            results.append({
-                "chunk_id": chunk_id,
-                "distance": float(distance),
-                "score": float(1 / (1 + distance)),
-                "metadata": metadata
-            })
+        params, allowed = None, index.ntotal
+        if filters:
+            bitmap, chunk_ids, allowed = metadata_store.selection(filters)
+            if allowed == 0:
+                return []
+            if hnsw is not None and chunk_ids is not None and len(chunk_ids) <= HNSW_EXACT_FILTER_MAX:
+                return self._exact_search(snapshot, query_embedding, k, chunk_ids)
+            params = self._search_params(index, bitmap, chunk_ids, allowed, fetch)
+        elif tombstones:
+            params = faiss.SearchParametersHNSW(sel=tombstones.selector(), efSearch=FAISS_HNSW_EF_SEARCH)
         
-        return results
-    
-    def delete_document(self, document_id: int):
-        chunks_to_remove = []
+        distances, indices = index.search(query_embedding, min(fetch, allowed, index.ntotal), params=params)
         
-        for chunk_id, metadata in self.metadata_store.items():
-            if metadata.get("document_id") == document_id:
-                chunks_to_remove.append(chunk_id)
+        found = indices[0] != -1
+        scores, chunk_ids = distances[0][found], indices[0][found]
+        if tombstones is not None:
+            # Ids revived after a tombstone are stored twice until the next rebuild
+            first = np.sort(np.unique(chunk_ids, return_index=True)[1])
+            scores, chunk_ids = scores[first], chunk_ids[first]
+        if refine is not None and len(chunk_ids):
+            # Re-rank the coarse candidates with the finer codes
+            scores = refine.reconstruct_batch(chunk_ids) @ query_embedding[0]
+            order = np.argsort(-scores, kind="stable")[:k]
+            scores, chunk_ids = scores[order], chunk_ids[order]
         
-        if not chunks_to_remove:
-            return
+        return self._results(metadata_store, chunk_ids, scores)
+    
+    def _results(self, metadata_store: MetadataStore, chunk_ids: np.ndarray, scores: np.ndarray) -> List[Dict[str, Any]]:
+        metadata = metadata_store.get_batch(chunk_ids)
         
-        faiss_ids_to_remove = [
-            faiss_id for faiss_id, chunk_id in self.id_mapping.items()
-            if chunk_id in chunks_to_remove
+        return [
+            {"chunk_id": chunk_id, "score": score, "metadata": meta}
+            for chunk_id, score, meta in zip(chunk_ids.tolist(), scores.tolist(), metadata)
         ]
+    
+    def _exact_search(self, snapshot: IndexSnapshot, query_embedding: np.ndarray, k: int, chunk_ids: np.ndarray) -> List[Dict[str, Any]]:
+        chunk_ids, vectors = self._reconstruct(np.asarray(chunk_ids, dtype=np.int64), snapshot)
+        scores = vectors @ query_embedding[0]
+        order = np.argsort(-scores, kind="stable")[:k]
+        scores, chunk_ids = scores[order], chunk_ids[order]
+        return self._results(snapshot.metadata_store, chunk_ids, scores)
+    
+    def chunk_ids_for_document(self, document_id: int) -> np.ndarray:
+        if self.index is None:
+            self.load_index()
+        with self._readers.read():
+            return self.metadata_store.chunk_ids_for_document(document_id).copy()
+    
+    def delete_document(self, document_id: int) -> int:
+        if self.read_only:
+            raise ReadOnlyIndexError("FAISS index is served read-only in this process")
         
-        if faiss_ids_to_remove:
-            self.index.remove_ids(np.array(faiss_ids_to_remove, dtype=np.int64))
+        with self._lock:
+            if self.index is None:
+                self.load_index()
             
-            for faiss_id in faiss_ids_to_remove:
-                chunk_id = self.id_mapping.pop(faiss_id, None)
-                if chunk_id:
-                    self.metadata_store.pop(chunk_id, None)
+            chunk_ids = self.metadata_store.chunk_ids_for_document(document_id)
+            if not len(chunk_ids):
+                return 0
             
-            self.save_index()
+            self._open_wal()
+            self.wal.append_delete(chunk_ids)
+            self._apply_delete(chunk_ids)
+            self._maybe_checkpoint()
+            self._maybe_retrain()
+            return len(chunk_ids)
     
     def get_stats(self) -> Dict[str, Any]:
         if self.index is None:
             self.load_index()
         
-        return {
-            "total_vectors": self.index.ntotal if self.index else 0,
-            "dimension": EMBEDDING_DIMENSION,
-            "is_trained": self.index.is_trained if self.index else False,
-            "nlist": FAISS_NLIST,
-            "nprobe": FAISS_NPROBE
-        }
+        with self._readers.read():
+            ivf = faiss.try_extract_index_ivf(self.index)
+            return {
+                "total_vectors": self.index.ntotal if self.index else 0,
+                "dimension": self.dimension,
+                "is_trained": self.index.is_trained if self.index else False,
+                "metric": "inner_product",
+                "index_type": "ivf" if ivf is not None else "hnsw" if extract_hnsw(self.index) is not None else "flat",
+                "factory": self._built_factory,
+                "read_only": self.read_only,
+                "generation": self.generation,
+                "configured_factory": self.factory,
+                "bytes_per_vector": (index_bytes(self.index) + index_bytes(self.refine_index)) / self.index.ntotal if self.index.ntotal else 0.0,
+                "nlist": ivf.nlist if ivf is not None else 0,
+                "nprobe": FAISS_NPROBE,
+                "hnsw": {
+                    "M": FAISS_HNSW_M,
+                    "ef_construction": FAISS_HNSW_EF_CONSTRUCTION,
+                    "ef_search": FAISS_HNSW_EF_SEARCH,
+                    "tombstones": self.tombstones.get_stats(),
+                    "dead_vectors": self.index.ntotal - self.metadata_store.live_count
+                } if self.tombstones is not None else None,
+                "list_imbalance": ivf.invlists.imbalance_factor() if ivf is not None and ivf.ntotal else None,
+                "retraining": self._pending_ops is not None,
+                "retrain_count": self.retrain_count,
+                "last_retrain_seconds": self.last_retrain_seconds,
+                "training_reservoir": self.reservoir.get_stats(),
+                "needs_rebuild": self.needs_rebuild,
+                "wal_bytes": self.wal.size if self.wal else 0,
+                "wal_records": self.wal.records if self.wal else 0,
+                "seconds_since_checkpoint": time.monotonic() - self._last_checkpoint,
+                "metadata_store": self.metadata_store.get_stats()
+            }
 
-faiss_index = FAISSIndex()
+if FAISS_NUM_SHARDS > 1:
+    from sharded_index import ShardedFAISSIndex
+    faiss_index = ShardedFAISSIndex()
+else:
+    faiss_index = FAISSIndex()
 
@@ -0,0 +1,93 @@
+import os
+import json
+import zlib
+import struct
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Any, Iterator, Tuple, Optional
+
+OP_ADD = 1
+OP_DELETE = 2
+
+# length (payload bytes), crc32 (payload), op
+_RECORD_HEADER = struct.Struct("<IIB")
+_COUNTS = struct.Struct("<II")
+
+class WriteAheadLog:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "ab")
+        self.records = 0
+    
+    @property
+    def size(self) -> int:
+        return self._file.tell()
+    
+    def _append(self, op: int, payload: bytes):
+        self._file.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload), op))
+        self._file.write(payload)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records += 1
+    
+    def append_add(self, ids: np.ndarray, vectors: np.ndarray, metadata: List[Dict[str, Any]]):
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        payload = b"".join([
+            _COUNTS.pack(len(ids), vectors.shape[1]),
+            ids.tobytes(),
+            vectors.tobytes(),
+            json.dumps(metadata, default=str).encode("utf-8")
+        ])
+        self._append(OP_ADD, payload)
+    
+    def append_delete(self, ids: np.ndarray):
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self._append(OP_DELETE, _COUNTS.pack(len(ids), 0) + ids.tobytes())
+    
+    def replay(self) -> Iterator[Tuple[int, np.ndarray, Optional[np.ndarray], Optional[List[Dict[str, Any]]]]]:
+        with open(self.path, "rb") as f:
+            data = f.read()
+        
+        offset = 0
+        records = 0
+        while offset + _RECORD_HEADER.size <= len(data):
+            length, crc, op = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            
+            count, dim = _COUNTS.unpack_from(payload)
+            ids_end = _COUNTS.size + 8 * count
+            ids = np.frombuffer(payload, dtype=np.int64, count=count, offset=_COUNTS.size)
+            if op == OP_ADD:
+                vectors_end = ids_end + 4 * count * dim
+                vectors = np.frombuffer(payload, dtype=np.float32, count=count * dim, offset=ids_end).reshape(count, dim)
+                metadata = json.loads(payload[vectors_end:].decode("utf-8"))
+                yield op, ids, vectors, metadata
+            else:
+                yield op, ids, None, None
+            
+            offset = start + length
+            records += 1
+        
+        if offset < len(data):
+            # Torn or corrupted tail from an interrupted write: drop it
+            print(f"WAL {self.path.name}: truncating {len(data) - offset} bytes of incomplete records", flush=True)
+            self._file.truncate(offset)
+            self._file.seek(offset)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.records = records
+    
+    def reset(self):
+        self._file.truncate(0)
+        self._file.seek(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records = 0
+    
+    def close(self):
+        self._file.close()
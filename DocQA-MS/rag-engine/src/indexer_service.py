@@ -1,8 +1,12 @@
+import json
+import hashlib
 from typing import List, Dict, Any, Tuple
 from sqlalchemy.orm import Session
 import numpy as np
 
-from src.database import get_db, SessionLocal
+from sqlalchemy import select
+
+from src.database import get_db, SessionLocal, engine
 import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "DocQA-MS-Backend" / "database"))
@@ -10,13 +14,51 @@ from models import Document, Chunk
 from chunker import chunker
 from embedder import embedder
 from faiss_index import faiss_index
-from config import EMBEDDING_DIMENSION
+from bm25_search import bm25_search
+from cache import LRUCache
+from chunk_store import chunk_table, ensure_schema, encode_embeddings, stored_embeddings, insert_chunks
+from metrics import stage_seconds, documents_indexed, documents_deleted, documents_unchanged, chunks_indexed, chunks_reused
+from config import EMBEDDING_DIMENSION, CHUNK_CACHE_SIZE
+
+chunks_table = chunk_table(Chunk)
+
+class DocumentNotFoundError(ValueError):
+    pass
 
 class IndexerService:
     def __init__(self):
         self.chunker = chunker
         self.embedder = embedder
         self.faiss_index = faiss_index
+        self.bm25_search = bm25_search
+        self.chunk_cache = LRUCache(CHUNK_CACHE_SIZE)
+    
+    def ensure_schema(self):
+        ensure_schema(engine, chunks_table)
+    
+    def _stored_embeddings(self, db: Session, chunk_ids: List[int]) -> Dict[int, np.ndarray]:
+        if not chunk_ids:
+            return {}
+        rows = db.execute(
+            select(chunks_table.c.id, chunks_table.c.embedding_bytes, chunks_table.c.embedding_vector)
+            .where(chunks_table.c.id.in_(chunk_ids))
+            .where(chunks_table.c.embedding_bytes.isnot(None) | chunks_table.c.embedding_vector.isnot(None))
+        ).all()
+        embeddings = stored_embeddings([row.embedding_bytes for row in rows], [row.embedding_vector for row in rows])
+        return dict(zip((row.id for row in rows), embeddings))
+    
+    def content_hash(self, text: str) -> str:
+        """Identity of a chunk's vector: the same text embedded by the same model gives the same embedding."""
+        return hashlib.sha256(f"{self.embedder.model_id}\0{text}".encode("utf-8")).hexdigest()
+    
+    def document_hash(self, content: str, metadata: Dict[str, Any]) -> str:
+        """Identity of everything index_document derives from a submission: its chunks, vectors and postings."""
+        key = json.dumps(
+            [self.embedder.model_id, self.chunker.chunk_size, self.chunker.chunk_overlap, content, metadata],
+            sort_keys=True,
+            default=str
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
     
     def index_document(
         self,
@@ -24,62 +66,207 @@ class IndexerService:
         content: str,
         metadata: Dict[str, Any] = None
     ) -> Dict[str, Any]:
+        outcome = self.index_documents([{"document_id": document_id, "content": content, "metadata": metadata}])[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    
+    def index_documents(self, documents: List[Dict[str, Any]]) -> List[Any]:
+        """Index {"document_id", "content", "metadata"} documents with one embedding pass, one transaction
+        and one FAISS add.
         
+        Returns one outcome per document, in order: its result, or the exception that failed it alone (each
+        document is written under its own savepoint). Failures of the shared steps are raised.
+        """
         db = SessionLocal()
         try:
-            document = db.query(Document).filter(Document.id == document_id).first()
-            if not document:
-                raise ValueError(f"Document {document_id} non trouvé")
-            
-            existing_chunks = db.query(Chunk).filter(Chunk.document_id == document_id).all()
-            for chunk in existing_chunks:
-                db.delete(chunk)
-            db.commit()
-            
-            chunks_data = self.chunker.chunk_text(content, metadata or {})
-            print(f"Document {document_id}: Content length={len(content)} chars. Generated {len(chunks_data)} chunks.", flush=True)
-            
-            if not chunks_data:
-                return {"status": "error", "message": "Aucun chunk généré"}
-            
-            chunk_texts = [chunk["text"] for chunk in chunks_data]
-            embeddings = self.embedder.embed_batch(chunk_texts)
-            
-            chunk_ids = []
-            for i, (chunk_data, embedding) in enumerate(zip(chunks_data, embeddings)):
-                chunk = Chunk(
-                    document_id=document_id,
-                    texte=chunk_data["text"],
-                    embedding_vector=embedding.tolist(),
-                    position=chunk_data["position"],
-                    chunk_metadata=chunk_data["metadata"]
-                )
-                db.add(chunk)
-                db.flush()
-                chunk_ids.append(chunk.id)
-            
-            db.commit()
+            outcomes = [None] * len(documents)
+            plans = []
+            for position, document in enumerate(documents):
+                try:
+                    plan = self._plan_document(db, document["document_id"], document["content"], document.get("metadata") or {})
+                except Exception as e:
+                    db.rollback()
+                    outcomes[position] = e
+                    continue
+                if "status" in plan:
+                    outcomes[position] = plan
+                else:
+                    plan["position"] = position
+                    plans.append(plan)
             
-            chunk_metadata = [
-                {
-                    **chunk_data["metadata"],
-                    "document_id": document_id,
-                    "chunk_id": chunk_id
-                }
-                for chunk_data, chunk_id in zip(chunks_data, chunk_ids)
-            ]
+            texts = [plan["chunks_data"][i]["text"] for plan in plans for i in plan["new_rows"]]
+            if texts:
+                with stage_seconds.time(stage="embed"):
+                    new_embeddings = self.embedder.embed_batch(texts)
+                start = 0
+                for plan in plans:
+                    plan["embeddings"][plan["new_rows"]] = new_embeddings[start:start + len(plan["new_rows"])]
+                    start += len(plan["new_rows"])
             
-            self.faiss_index.add_vectors(embeddings, chunk_ids, chunk_metadata)
+            with stage_seconds.time(stage="db_write"):
+                written = []
+                for plan in plans:
+                    try:
+                        with db.begin_nested():
+                            plan["chunk_ids"] = self._write_chunks(db, plan)
+                        written.append(plan)
+                    except Exception as e:
+                        outcomes[plan["position"]] = e
+                db.commit()
+        finally:
+            db.close()
+        
+        # BM25 is updated first: a FAISS write may checkpoint, which persists BM25 as it stands
+        for plan in written:
+            self.chunk_cache.pop_many(plan["stale_ids"])
+            # Reused vectors are re-added with the rest: their section and offsets may have moved
+            self.bm25_search.delete_document(plan["document_id"])
+            self.faiss_index.delete_document(plan["document_id"])
+        
+        indexed = [plan for plan in written if plan["chunks_data"]]
+        chunk_ids = [chunk_id for plan in indexed for chunk_id in plan["chunk_ids"]]
+        chunks_data = [chunk_data for plan in indexed for chunk_data in plan["chunks_data"]]
+        chunk_metadata = [
+            {
+                **chunk_data["metadata"],
+                "document_id": plan["document_id"],
+                "chunk_id": chunk_id
+            }
+            for plan in indexed
+            for chunk_data, chunk_id in zip(plan["chunks_data"], plan["chunk_ids"])
+        ]
+        
+        if chunk_ids:
+            self.bm25_search.add_chunks(
+                {"chunk_id": chunk_id, "text": chunk_data["text"], "metadata": meta}
+                for chunk_id, chunk_data, meta in zip(chunk_ids, chunks_data, chunk_metadata)
+            )
             
+            with stage_seconds.time(stage="faiss_add"):
+                self.faiss_index.add_vectors(np.concatenate([plan["embeddings"] for plan in indexed]), chunk_ids, chunk_metadata)
+        
+        for plan in written:
+            if not plan["chunks_data"]:
+                outcomes[plan["position"]] = {"status": "error", "message": "Aucun chunk généré"}
+                continue
+            num_reused = len(plan["chunk_ids"]) - len(plan["new_rows"])
+            documents_indexed.inc()
+            chunks_indexed.inc(len(plan["new_rows"]))
+            chunks_reused.inc(num_reused)
+            outcomes[plan["position"]] = {
+                "status": "success",
+                "document_id": plan["document_id"],
+                "chunks_count": len(plan["chunks_data"]),
+                "chunk_ids": plan["chunk_ids"],
+                "reused_chunks": num_reused,
+                "embedded_chunks": len(plan["new_rows"]),
+                "unchanged": False
+            }
+        
+        return outcomes
+    
+    def _is_indexed(self, document_id: int, chunk_ids: List[int]) -> bool:
+        """Whether FAISS and BM25 hold exactly these chunks of the document.
+        
+        The hashes are committed before the indexes are updated: a failure in between leaves stored chunks
+        that match a resubmission but were never indexed, which the retry must still index.
+        """
+        expected = set(chunk_ids)
+        return (
+            set(self.faiss_index.chunk_ids_for_document(document_id).tolist()) == expected
+            and self.bm25_search.chunk_ids_for_document(document_id) == expected
+        )
+    
+    def _plan_document(self, db: Session, document_id: int, content: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """What indexing a document changes, without writing: its result if there is nothing to do."""
+        document = db.query(Document).filter(Document.id == document_id).first()
+        if not document:
+            raise DocumentNotFoundError(f"Document {document_id} non trouvé")
+        
+        existing_chunks = db.query(Chunk).filter(Chunk.document_id == document_id).order_by(Chunk.id).all()
+        document_hash = self.document_hash(content, metadata)
+        if (
+            existing_chunks
+            and all((chunk.chunk_metadata or {}).get("document_hash") == document_hash for chunk in existing_chunks)
+            and self._is_indexed(document_id, [chunk.id for chunk in existing_chunks])
+        ):
+            # Identical resubmission: the stored chunks, vectors and postings are what indexing would produce
+            documents_unchanged.inc()
+            chunks_reused.inc(len(existing_chunks))
             return {
                 "status": "success",
                 "document_id": document_id,
-                "chunks_count": len(chunks_data),
-                "chunk_ids": chunk_ids
+                "chunks_count": len(existing_chunks),
+                "chunk_ids": [chunk.id for chunk in existing_chunks],
+                "reused_chunks": len(existing_chunks),
+                "embedded_chunks": 0,
+                "unchanged": True
             }
         
-        finally:
-            db.close()
+        with stage_seconds.time(stage="chunk"):
+            chunks_data = self.chunker.chunk_text(content, metadata)
+        print(f"Document {document_id}: Content length={len(content)} chars. Generated {len(chunks_data)} chunks.", flush=True)
+        
+        # Chunks whose text is unchanged keep their row, id and vector; only new or edited text is embedded
+        hashed_chunks = [chunk for chunk in existing_chunks if (chunk.chunk_metadata or {}).get("content_hash")]
+        vectors = self._stored_embeddings(db, [chunk.id for chunk in hashed_chunks])
+        reusable = {}
+        for chunk in hashed_chunks:
+            if chunk.id in vectors:
+                reusable.setdefault(chunk.chunk_metadata["content_hash"], []).append(chunk)
+        
+        kept_chunks = []
+        for chunk_data in chunks_data:
+            content_hash = self.content_hash(chunk_data["text"])
+            chunk_data["metadata"] = {**chunk_data["metadata"], "content_hash": content_hash, "document_hash": document_hash}
+            candidates = reusable.get(content_hash)
+            kept_chunks.append(candidates.pop(0) if candidates else None)
+        
+        kept_ids = {chunk.id for chunk in kept_chunks if chunk is not None}
+        stale_chunks = [chunk for chunk in existing_chunks if chunk.id not in kept_ids]
+        
+        embeddings = np.zeros((len(chunks_data), EMBEDDING_DIMENSION), dtype='float32')
+        for i, chunk in enumerate(kept_chunks):
+            if chunk is not None:
+                embeddings[i] = vectors[chunk.id]
+        
+        return {
+            "document_id": document_id,
+            "chunks_data": chunks_data,
+            "kept_chunks": kept_chunks,
+            "stale_chunks": stale_chunks,
+            # Read now: deleted rows cannot be read once committed
+            "stale_ids": [chunk.id for chunk in stale_chunks],
+            "new_rows": [i for i, chunk in enumerate(kept_chunks) if chunk is None],
+            "embeddings": embeddings
+        }
+    
+    def _write_chunks(self, db: Session, plan: Dict[str, Any]) -> List[int]:
+        for chunk in plan["stale_chunks"]:
+            db.delete(chunk)
+        for chunk_data, chunk in zip(plan["chunks_data"], plan["kept_chunks"]):
+            if chunk is not None:
+                chunk.position = chunk_data["position"]
+                chunk.chunk_metadata = chunk_data["metadata"]
+        db.flush()
+        
+        # One INSERT ... RETURNING for all new chunks, embeddings as raw bytes rather than JSON floats
+        chunks_data = plan["chunks_data"]
+        new_ids = insert_chunks(db, chunks_table, [
+            {
+                "document_id": plan["document_id"],
+                "texte": chunks_data[i]["text"],
+                "embedding_bytes": blob,
+                "position": chunks_data[i]["position"],
+                "chunk_metadata": chunks_data[i]["metadata"]
+            }
+            for i, blob in zip(plan["new_rows"], encode_embeddings(plan["embeddings"][plan["new_rows"]]))
+        ])
+        chunk_ids = [chunk.id if chunk is not None else None for chunk in plan["kept_chunks"]]
+        for i, chunk_id in zip(plan["new_rows"], new_ids):
+            chunk_ids[i] = chunk_id
+        return chunk_ids
     
     def search(
         self,
@@ -88,54 +275,61 @@ class IndexerService:
         filters: Dict[str, Any] = None
     ) -> List[Dict[str, Any]]:
         
-        query_embedding = self.embedder.embed_text(query)
+        with stage_seconds.time(stage="query_embed"):
+            query_embedding = self.embedder.embed_text(query)
         
-        results = self.faiss_index.search(query_embedding, k=top_k * 2)
+        with stage_seconds.time(stage="vector_search"):
+            results = self.faiss_index.search(query_embedding, k=top_k, filters=filters)
         
-        if filters:
-            results = self._apply_filters(results, filters)
-        
-        results = results[:top_k]
-        
-        db = SessionLocal()
-        try:
-            for result in results:
-                chunk = db.query(Chunk).filter(Chunk.id == result["chunk_id"]).first()
-                if chunk:
-                    result["text"] = chunk.texte
-                    result["document_id"] = chunk.document_id
-        finally:
-            db.close()
+        self.hydrate_results(results)
         
         return results
     
-    def _apply_filters(self, results: List[Dict[str, Any]], filters: Dict[str, Any]) -> List[Dict[str, Any]]:
-        filtered = []
-        for result in results:
-            metadata = result.get("metadata", {})
-            match = True
-            
-            if "document_id" in filters and metadata.get("document_id") != filters["document_id"]:
-                match = False
-            if "section_type" in filters and metadata.get("section_type") != filters["section_type"]:
-                match = False
+    def hydrate_results(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with stage_seconds.time(stage="hydration"):
+            return self._hydrate_results(results)
+    
+    def _hydrate_results(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        chunk_ids = [result["chunk_id"] for result in results]
+        found = self.chunk_cache.get_many(chunk_ids)
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in found]
+        
+        if missing:
+            db = SessionLocal()
+            try:
+                rows = (
+                    db.query(Chunk.id, Chunk.texte, Chunk.document_id)
+                    .filter(Chunk.id.in_(missing))
+                    .all()
+                )
+            finally:
+                db.close()
             
-            if match:
-                filtered.append(result)
+            for chunk_id, texte, document_id in rows:
+                found[chunk_id] = (texte, document_id)
+                self.chunk_cache.put(chunk_id, (texte, document_id))
+        
+        for result in results:
+            hit = found.get(result["chunk_id"])
+            if hit:
+                result["text"], result["document_id"] = hit
         
-        return filtered
+        return results
     
     def delete_document(self, document_id: int) -> Dict[str, Any]:
         db = SessionLocal()
         try:
             chunks = db.query(Chunk).filter(Chunk.document_id == document_id).all()
+            self.chunk_cache.pop_many(chunk.id for chunk in chunks)
             
+            self.bm25_search.delete_document(document_id)
             self.faiss_index.delete_document(document_id)
             
             for chunk in chunks:
                 db.delete(chunk)
             db.commit()
             
+            documents_deleted.inc()
             return {
                 "status": "success",
                 "document_id": document_id,
@@ -143,6 +337,72 @@ class IndexerService:
             }
         finally:
             db.close()
+    
+    def build_bm25_index(self, batch_size: int = 1000) -> int:
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(Chunk.id, Chunk.texte, Chunk.document_id, Chunk.chunk_metadata)
+                .execution_options(yield_per=batch_size)
+            )
+            self.bm25_search.build_index(
+                {
+                    "chunk_id": chunk_id,
+                    "text": texte,
+                    "metadata": {**(chunk_metadata or {}), "document_id": document_id}
+                }
+                for chunk_id, texte, document_id, chunk_metadata in rows
+            )
+        finally:
+            db.close()
+        
+        self.save_bm25_index()
+        return self.bm25_search.get_stats()["total_chunks"]
+    
+    def save_bm25_index(self):
+        # Stamped with the FAISS generation it goes with: a restart rebuilds BM25 when FAISS replayed writes past it
+        self.bm25_search.save_index(self.faiss_index.published_generation)
+    
+    def rebuild_faiss_index(self, batch_size: int = 1000) -> int:
+        self.faiss_index.initialize_index()
+        
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(
+                    chunks_table.c.id,
+                    chunks_table.c.document_id,
+                    chunks_table.c.embedding_bytes,
+                    chunks_table.c.embedding_vector,
+                    chunks_table.c.chunk_metadata
+                )
+                .where(chunks_table.c.embedding_bytes.isnot(None) | chunks_table.c.embedding_vector.isnot(None))
+                .order_by(chunks_table.c.id)
+                .execution_options(yield_per=batch_size)
+            )
+            
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    self._add_rows_to_faiss(batch)
+                    batch = []
+            if batch:
+                self._add_rows_to_faiss(batch)
+        finally:
+            db.close()
+        
+        self.faiss_index.finish_rebuild()
+        return self.faiss_index.get_stats()["total_vectors"]
+    
+    def _add_rows_to_faiss(self, rows):
+        embeddings = stored_embeddings([row.embedding_bytes for row in rows], [row.embedding_vector for row in rows])
+        chunk_ids = [row.id for row in rows]
+        metadata = [
+            {**(row.chunk_metadata or {}), "document_id": row.document_id, "chunk_id": row.id}
+            for row in rows
+        ]
+        self.faiss_index.add_vectors(embeddings, chunk_ids, metadata, save=False)
 
 indexer_service = IndexerService()
 
@@ -1,16 +1,20 @@
-from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi import FastAPI, HTTPException, Depends, Body, Response
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import threading
+import time
 
 from src.database import get_db
 from indexer_service import indexer_service
 from hybrid_search import hybrid_search
 from faiss_index import faiss_index
+from bm25_search import bm25_search
 from rabbitmq_consumer import rabbitmq_consumer
 from embedder import embedder
-from config import SERVICE_PORT
+from executors import search_executor, ingest_executor, ExecutorSaturatedError
+from metrics import registry, queries
+from config import SERVICE_PORT, FAISS_SERVING_MODE, FAISS_RELOAD_INTERVAL_SECONDS, INDEXER_STOP_TIMEOUT_SECONDS
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI(
@@ -28,6 +32,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Gauges are read from the live objects when /metrics is scraped
+registry.gauge("docqa_faiss_vectors", "Vectors in the FAISS index.", lambda: faiss_index.get_stats()["total_vectors"])
+registry.gauge("docqa_bm25_chunks", "Chunks in the BM25 index.", lambda: bm25_search.get_stats()["total_chunks"])
+registry.gauge(
+    "docqa_executor_queue_depth", "Requests waiting for an executor worker.",
+    lambda: {"search": search_executor.queued, "ingest": ingest_executor.queued}, label="executor"
+)
+registry.gauge(
+    "docqa_executor_running", "Requests being served by executor workers.",
+    lambda: {"search": search_executor.running, "ingest": ingest_executor.running}, label="executor"
+)
+registry.gauge("docqa_indexer_queue_messages", "Messages waiting in the RabbitMQ indexer queue.", rabbitmq_consumer.queue_depth)
+registry.gauge(
+    "docqa_cache_entries", "Entries held by each cache.",
+    lambda: {"chunk": len(indexer_service.chunk_cache), "query": len(embedder.query_cache)}, label="cache"
+)
+
 class EmbedRequest(BaseModel):
     document_id: int
     content: str
@@ -53,7 +74,13 @@ async def embed_document(
     db: Session = Depends(get_db)
 ):
     try:
-        result = indexer_service.index_document(
+        if faiss_index.read_only:
+            # Only the writer worker ingests; hand the document over through its queue
+            await ingest_executor.run(rabbitmq_consumer.publish, request.model_dump())
+            return {"status": "queued", "document_id": request.document_id}
+        
+        result = await ingest_executor.run(
+            indexer_service.index_document,
             document_id=request.document_id,
             content=request.content,
             metadata=request.metadata
@@ -61,6 +88,8 @@ async def embed_document(
         
         return result
     
+    except ExecutorSaturatedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -69,18 +98,14 @@ async def embed_document(
 @app.post("/index/search")
 async def search_documents(request: SearchRequest):
     try:
-        if request.use_hybrid:
-            results = hybrid_search.search(
-                query=request.query,
-                top_k=request.top_k,
-                filters=request.filters
-            )
-        else:
-            results = indexer_service.search(
-                query=request.query,
-                top_k=request.top_k,
-                filters=request.filters
-            )
+        search = hybrid_search.search if request.use_hybrid else indexer_service.search
+        queries.inc(mode="hybrid" if request.use_hybrid else "vector")
+        results = await search_executor.run(
+            search,
+            query=request.query,
+            top_k=request.top_k,
+            filters=request.filters
+        )
         
         return {
             "status": "success",
@@ -89,15 +114,23 @@ async def search_documents(request: SearchRequest):
             "results": results
         }
     
+    except ExecutorSaturatedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors de la recherche: {str(e)}")
 
 @app.delete("/index/document/{document_id}")
 async def delete_document(document_id: int):
     try:
-        result = indexer_service.delete_document(document_id)
+        if faiss_index.read_only:
+            await ingest_executor.run(rabbitmq_consumer.publish, {"action": "delete", "document_id": document_id})
+            return {"status": "queued", "document_id": document_id}
+        
+        result = await ingest_executor.run(indexer_service.delete_document, document_id)
         return result
     
+    except ExecutorSaturatedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors de la suppression: {str(e)}")
 
@@ -105,26 +138,84 @@ async def delete_document(document_id: int):
 def get_stats():
     return {
         "faiss_stats": faiss_index.get_stats(),
+        "bm25_stats": bm25_search.get_stats(),
+        "chunk_cache": indexer_service.chunk_cache.get_stats(),
+        "query_cache": embedder.get_cache_stats(),
+        "query_batching": embedder.get_batching_stats(),
+        "executors": {
+            "search": search_executor.get_stats(),
+            "ingest": ingest_executor.get_stats()
+        },
+        "indexer_consumer": rabbitmq_consumer.get_stats(),
         "embedding_model": "paraphrase-multilingual-mpnet-base-v2",
         "embedding_dimension": 768
     }
 
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def follow_writer():
+    while True:
+        time.sleep(FAISS_RELOAD_INTERVAL_SECONDS)
+        try:
+            if faiss_index.reload_if_published():
+                print(f"Loaded published FAISS index generation {faiss_index.generation}.", flush=True)
+            # BM25 is published inside each FAISS checkpoint: load the copy saved with the generation now served
+            bm25_search.reload_if_changed(faiss_index.generation)
+        except Exception as e:
+            print(f"Index reload failed: {str(e)}", flush=True)
+
 @app.on_event("startup")
 async def startup_event():
-    print("Starting RabbitMQ consumer...", flush=True)
-    consumer_thread = threading.Thread(target=rabbitmq_consumer.start_consuming, daemon=True)
-    consumer_thread.start()
+    if FAISS_SERVING_MODE == "shared" and not faiss_index.acquire_writer_role():
+        print("FAISS writer lock held by another worker, serving the published index read-only...", flush=True)
+        faiss_index.open_read_only()
+        bm25_search.load_index()
+        threading.Thread(target=follow_writer, name="index-follower", daemon=True).start()
+        print("Startup complete!", flush=True)
+        return
+    
+    # Adds the binary embedding column before anything writes chunks; migrate_embeddings.py backfills old rows
+    indexer_service.ensure_schema()
     
     print("Loading FAISS index...", flush=True)
     faiss_index.load_index()
+    if faiss_index.needs_rebuild:
+        print("Rebuilding FAISS index from stored embeddings...", flush=True)
+        rebuilt = indexer_service.rebuild_faiss_index()
+        print(f"FAISS index rebuilt with {rebuilt} vectors.", flush=True)
+    
+    print("Loading BM25 index...", flush=True)
+    if not bm25_search.load_index():
+        print("No BM25 index on disk, building from database...", flush=True)
+        indexed = indexer_service.build_bm25_index()
+        print(f"BM25 index built with {indexed} chunks.", flush=True)
+    elif bm25_search.generation != faiss_index.published_generation:
+        # BM25 is only saved at FAISS checkpoints: writes replayed from the FAISS WAL are missing from it
+        print("BM25 index older than the FAISS index, rebuilding from database...", flush=True)
+        indexed = indexer_service.build_bm25_index()
+        print(f"BM25 index built with {indexed} chunks.", flush=True)
+    faiss_index.add_checkpoint_hook(indexer_service.save_bm25_index)
+    faiss_index.start_checkpointer()
+    
+    # Started once both indexes are loaded, so no message is indexed into an index about to be replaced
+    print("Starting RabbitMQ consumer...", flush=True)
+    rabbitmq_consumer.start()
 
     print("Startup complete!", flush=True)
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    rabbitmq_consumer.stop_consuming()
-    rabbitmq_consumer.close()
-    faiss_index.save_index()
+    # Waits for the consumer thread to settle its batch; it closes its own connection
+    if not rabbitmq_consumer.stop_consuming(timeout=INDEXER_STOP_TIMEOUT_SECONDS):
+        print("RabbitMQ consumer still indexing at shutdown, unacked messages will be redelivered.", flush=True)
+    search_executor.shutdown()
+    ingest_executor.shutdown(wait=True)
+    faiss_index.stop_checkpointer()
+    if not faiss_index.read_only:
+        # Saves BM25 too, through the checkpoint hook
+        faiss_index.save_index()
 
 if __name__ == "__main__":
     import uvicorn
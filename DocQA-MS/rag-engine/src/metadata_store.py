@@ -0,0 +1,406 @@
+import os
+import json
+import struct
+import threading
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+_MAGIC = b"DQMS"
+_ALIGN = 64
+
+# Fields kept per chunk; -1 marks a missing integer value
+COLUMNS = {
+    "chunk_id": np.int64,
+    "document_id": np.int64,
+    "section": np.int16,
+    "chunk_index": np.int32,
+    "token_start": np.int32,
+    "token_end": np.int32,
+    "char_start": np.int32,
+    "char_end": np.int32
+}
+OPTIONAL_FIELDS = ("token_start", "token_end", "char_start", "char_end")
+
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    if size <= len(array):
+        return array
+    grown = np.empty(max(size, 2 * len(array), 1024), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def _grow_zeros(array: np.ndarray, size: int) -> np.ndarray:
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array), 1024), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def parse_filters(filters: Dict[str, Any]) -> Tuple[Optional[List[int]], Optional[List[Optional[str]]]]:
+    """Return the allowed document ids and section types, None meaning unrestricted."""
+    document_ids = None
+    if "document_id" in filters:
+        document_ids = [filters["document_id"]]
+    if "document_ids" in filters:
+        allowed = set(filters["document_ids"] or [])
+        document_ids = sorted(allowed) if document_ids is None else [i for i in document_ids if i in allowed]
+    
+    section_types = None
+    if "section_type" in filters:
+        value = filters["section_type"]
+        section_types = list(value) if isinstance(value, (list, tuple, set)) else [value]
+    
+    return document_ids, section_types
+
+class MetadataStore:
+    def __init__(self):
+        self.sections: List[Optional[str]] = []
+        self._section_codes: Dict[Optional[str], int] = {}
+        self.size = 0
+        self.columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.alive = np.zeros(0, dtype=bool)
+        self.live_count = 0
+        
+        # Sorted chunk_id -> row index used for vectorized lookups
+        self._index_ids = np.zeros(0, dtype=np.int64)
+        self._index_rows = np.zeros(0, dtype=np.int64)
+        self._index_size = 0
+        self._index_dirty = False
+        self._lock = threading.RLock()
+        
+        # Filter structures: one bitmap over chunk ids per section code, chunk ids per document
+        self._section_bitmaps: List[np.ndarray] = []
+        self._section_counts = np.zeros(0, dtype=np.int64)
+        self._document_chunks: Dict[int, np.ndarray] = {}
+    
+    def __len__(self) -> int:
+        return self.live_count
+    
+    @property
+    def nbytes(self) -> int:
+        return int(
+            sum(column[:self.size].nbytes for column in self.columns.values())
+            + self.alive[:self.size].nbytes
+            + self._index_ids[:self._index_size].nbytes
+            + self._index_rows[:self._index_size].nbytes
+            + sum(bitmap.nbytes for bitmap in self._section_bitmaps)
+            + sum(ids.nbytes for ids in self._document_chunks.values())
+        )
+    
+    def _section_code(self, section_type: Optional[str]) -> int:
+        code = self._section_codes.get(section_type)
+        if code is None:
+            code = len(self.sections)
+            self.sections.append(section_type)
+            self._section_codes[section_type] = code
+            self._section_bitmaps.append(np.zeros(0, dtype=np.uint8))
+            self._section_counts = np.append(self._section_counts, 0)
+        return code
+    
+    def section_code(self, section_type: Optional[str]) -> int:
+        return self._section_codes.get(section_type, -1)
+    
+    def _rebuild_lookup(self):
+        rows = np.flatnonzero(self.alive[:self.size])
+        ids = self.columns["chunk_id"][rows]
+        order = np.argsort(ids, kind="stable")
+        self._index_ids = ids[order]
+        self._index_rows = rows[order]
+        self._index_size = len(rows)
+        self._index_dirty = False
+    
+    def lookup_rows(self, chunk_ids: Iterable[int]) -> np.ndarray:
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        with self._lock:
+            if self._index_dirty:
+                self._rebuild_lookup()
+            
+            index_ids = self._index_ids[:self._index_size]
+            if not len(index_ids):
+                return np.full(len(chunk_ids), -1, dtype=np.int64)
+            
+            pos = np.minimum(np.searchsorted(index_ids, chunk_ids), len(index_ids) - 1)
+            rows = self._index_rows[pos]
+            found = (index_ids[pos] == chunk_ids) & self.alive[rows]
+            return np.where(found, rows, -1)
+    
+    def add(self, chunk_ids: Iterable[int], metadata: List[Dict[str, Any]]):
+        with self._lock:
+            chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+            if not len(chunk_ids):
+                return
+            self.remove(chunk_ids)
+            
+            start, end = self.size, self.size + len(chunk_ids)
+            for name in self.columns:
+                self.columns[name] = _grow(self.columns[name], end)
+            self.alive = _grow(self.alive, end)
+            
+            self.columns["chunk_id"][start:end] = chunk_ids
+            self.columns["document_id"][start:end] = [
+                meta.get("document_id") if meta.get("document_id") is not None else -1 for meta in metadata
+            ]
+            self.columns["section"][start:end] = [self._section_code(meta.get("section_type")) for meta in metadata]
+            self.columns["chunk_index"][start:end] = [meta.get("chunk_index", -1) for meta in metadata]
+            for name in OPTIONAL_FIELDS:
+                self.columns[name][start:end] = [meta.get(name, -1) for meta in metadata]
+            self.alive[start:end] = True
+            self.size = end
+            self.live_count += len(chunk_ids)
+            self._index_filters(start, end, present=True)
+            
+            # Chunk ids come from a database sequence, so new ids usually extend the sorted lookup
+            if (
+                not self._index_dirty
+                and (self._index_size == 0 or chunk_ids.min() > self._index_ids[self._index_size - 1])
+            ):
+                order = np.argsort(chunk_ids, kind="stable")
+                index_end = self._index_size + len(chunk_ids)
+                self._index_ids = _grow(self._index_ids, index_end)
+                self._index_rows = _grow(self._index_rows, index_end)
+                self._index_ids[self._index_size:index_end] = chunk_ids[order]
+                self._index_rows[self._index_size:index_end] = np.arange(start, end, dtype=np.int64)[order]
+                self._index_size = index_end
+            else:
+                self._index_dirty = True
+    
+    def remove(self, chunk_ids: Iterable[int]) -> np.ndarray:
+        with self._lock:
+            rows = self.lookup_rows(chunk_ids)
+            rows = np.unique(rows[rows >= 0])
+            if len(rows):
+                self.alive[rows] = False
+                self.live_count -= len(rows)
+                self._index_filters(rows, present=False)
+            return self.columns["chunk_id"][rows]
+    
+    def _index_filters(self, rows, end: Optional[int] = None, present: bool = True):
+        if end is not None:
+            rows = np.arange(rows, end)
+        chunk_ids = self.columns["chunk_id"][rows]
+        codes = self.columns["section"][rows]
+        documents = self.columns["document_id"][rows]
+        
+        for code in np.unique(codes).tolist():
+            ids = chunk_ids[codes == code]
+            bitmap = _grow_zeros(self._section_bitmaps[code], int(ids.max() >> 3) + 1)
+            bits = np.left_shift(1, ids & 7).astype(np.uint8)
+            if present:
+                np.bitwise_or.at(bitmap, ids >> 3, bits)
+            else:
+                np.bitwise_and.at(bitmap, ids >> 3, ~bits)
+            self._section_bitmaps[code] = bitmap
+            self._section_counts[code] += len(ids) if present else -len(ids)
+        
+        for document_id in np.unique(documents).tolist():
+            ids = chunk_ids[documents == document_id]
+            current = self._document_chunks.get(document_id)
+            if present:
+                self._document_chunks[document_id] = ids if current is None else np.union1d(current, ids)
+            elif current is not None:
+                remaining = np.setdiff1d(current, ids, assume_unique=True)
+                if len(remaining):
+                    self._document_chunks[document_id] = remaining
+                else:
+                    del self._document_chunks[document_id]
+    
+    def _rebuild_filters(self, include_documents: bool = True):
+        live = self.alive[:self.size]
+        chunk_ids = self.columns["chunk_id"][:self.size][live]
+        codes = self.columns["section"][:self.size][live]
+        documents = self.columns["document_id"][:self.size][live]
+        
+        self._section_bitmaps = []
+        for code in range(len(self.sections)):
+            bits = np.zeros(int(chunk_ids.max()) + 1 if len(chunk_ids) else 0, dtype=bool)
+            bits[chunk_ids[codes == code]] = True
+            self._section_bitmaps.append(np.packbits(bits, bitorder="little"))
+        self._section_counts = np.bincount(codes, minlength=len(self.sections)).astype(np.int64)
+        if not include_documents:
+            return
+        
+        order = np.lexsort((chunk_ids, documents))
+        documents, chunk_ids = documents[order], chunk_ids[order]
+        starts = np.flatnonzero(np.r_[True, documents[1:] != documents[:-1]]) if len(documents) else []
+        self._document_chunks = {
+            int(documents[start]): ids for start, ids in zip(starts, np.split(chunk_ids, starts[1:]))
+        }
+    
+    def selection(self, filters: Dict[str, Any]) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], int]:
+        """Resolve filters to (section bitmap over chunk ids, explicit chunk ids, number of chunks allowed)."""
+        document_ids, section_types = parse_filters(filters)
+        
+        with self._lock:
+            codes = [self._section_codes[s] for s in (section_types or []) if s in self._section_codes]
+            bitmap = None
+            if section_types is not None:
+                if len(codes) == 1:
+                    bitmap = self._section_bitmaps[codes[0]]
+                else:
+                    bitmap = np.zeros(max([len(self._section_bitmaps[c]) for c in codes] or [0]), dtype=np.uint8)
+                    for code in codes:
+                        bitmap[:len(self._section_bitmaps[code])] |= self._section_bitmaps[code]
+            
+            if document_ids is None:
+                return bitmap, None, int(self._section_counts[codes].sum()) if bitmap is not None else self.live_count
+            
+            parts = [self._document_chunks[d] for d in document_ids if d in self._document_chunks]
+            chunk_ids = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        
+        if bitmap is not None:
+            in_range = (chunk_ids >> 3) < len(bitmap)
+            chunk_ids = chunk_ids[in_range]
+            chunk_ids = chunk_ids[(bitmap[chunk_ids >> 3] >> (chunk_ids & 7)) & 1 == 1]
+        return None, chunk_ids, len(chunk_ids)
+    
+    def chunk_ids(self) -> np.ndarray:
+        return self.columns["chunk_id"][:self.size][self.alive[:self.size]]
+    
+    def chunk_ids_for_document(self, document_id: int) -> np.ndarray:
+        with self._lock:
+            return self._document_chunks.get(document_id, np.zeros(0, dtype=np.int64)).copy()
+    
+    def get_columns(self, chunk_ids: Iterable[int]) -> Dict[str, np.ndarray]:
+        with self._lock:
+            rows = self.lookup_rows(chunk_ids)
+            safe_rows = np.maximum(rows, 0)
+            batch = {name: column[safe_rows] for name, column in self.columns.items()}
+            batch["found"] = rows >= 0
+            return batch
+    
+    def get_batch(self, chunk_ids: Iterable[int]) -> List[Dict[str, Any]]:
+        batch = self.get_columns(chunk_ids)
+        results = []
+        for i, found in enumerate(batch["found"].tolist()):
+            if not found:
+                results.append({})
+                continue
+            
+            document_id = int(batch["document_id"][i])
+            meta = {
+                "chunk_id": int(batch["chunk_id"][i]),
+                "document_id": document_id if document_id != -1 else None,
+                "section_type": self.sections[batch["section"][i]],
+                "chunk_index": int(batch["chunk_index"][i])
+            }
+            for name in OPTIONAL_FIELDS:
+                value = int(batch[name][i])
+                if value != -1:
+                    meta[name] = value
+            results.append(meta)
+        return results
+    
+    def get(self, chunk_id: int) -> Dict[str, Any]:
+        return self.get_batch([chunk_id])[0]
+    
+    def compact(self):
+        with self._lock:
+            if self.live_count == self.size:
+                return
+            live = self.alive[:self.size]
+            for name in self.columns:
+                self.columns[name] = self.columns[name][:self.size][live]
+            self.size = len(self.columns["chunk_id"])
+            self.alive = np.ones(self.size, dtype=bool)
+            self.live_count = self.size
+            self._index_dirty = True
+    
+    def _document_index_arrays(self) -> Dict[str, np.ndarray]:
+        document_ids = np.array(sorted(self._document_chunks), dtype=np.int64)
+        parts = [self._document_chunks[document_id] for document_id in document_ids.tolist()]
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(part) for part in parts])
+        return {
+            "document_ids": document_ids,
+            "document_offsets": offsets,
+            "document_chunks": np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+        }
+    
+    def save(self, path: Path):
+        with self._lock:
+            self.compact()
+            arrays = {name: self.columns[name][:self.size] for name in COLUMNS}
+            arrays.update(self._document_index_arrays())
+        
+        header = {
+            "size": self.size,
+            "sections": self.sections,
+            "columns": {}
+        }
+        
+        offset = 0
+        for name, array in arrays.items():
+            header["columns"][name] = {"dtype": array.dtype.str, "offset": offset, "length": len(array)}
+            offset += -(-array.nbytes // _ALIGN) * _ALIGN
+        
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_start = -(-(len(_MAGIC) + 4 + len(header_bytes)) // _ALIGN) * _ALIGN
+        
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+            for name, array in arrays.items():
+                f.seek(data_start + header["columns"][name]["offset"])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True) -> "MetadataStore":
+        with open(path, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"{path} n'est pas un fichier de métadonnées valide")
+            (header_length,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_length).decode("utf-8"))
+        data_start = -(-(len(_MAGIC) + 4 + header_length) // _ALIGN) * _ALIGN
+        
+        store = cls()
+        store.size = header["size"]
+        for section in header["sections"]:
+            store._section_code(section)
+        
+        arrays = {}
+        for name, spec in header["columns"].items():
+            dtype = np.dtype(spec["dtype"])
+            length = spec.get("length", store.size)
+            if length == 0:
+                arrays[name] = np.zeros(0, dtype=dtype)
+            elif mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=data_start + spec["offset"], shape=(length,))
+            else:
+                arrays[name] = np.fromfile(path, dtype=dtype, count=length, offset=data_start + spec["offset"])
+        
+        for name, dtype in COLUMNS.items():
+            # Files written before a column existed load it as missing values
+            store.columns[name] = arrays[name] if name in arrays else np.full(store.size, -1, dtype=dtype)
+        store.alive = np.ones(store.size, dtype=bool)
+        store.live_count = store.size
+        store._index_dirty = True
+        
+        if "document_ids" in arrays:
+            offsets = arrays["document_offsets"].tolist()
+            store._document_chunks = {
+                document_id: arrays["document_chunks"][offsets[i]:offsets[i + 1]]
+                for i, document_id in enumerate(arrays["document_ids"].tolist())
+            }
+            store._rebuild_filters(include_documents=False)
+        else:
+            store._rebuild_filters()
+        return store
+    
+    @classmethod
+    def from_dict(cls, metadata: Dict[int, Dict[str, Any]]) -> "MetadataStore":
+        store = cls()
+        store.add(list(metadata.keys()), list(metadata.values()))
+        return store
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "chunks": self.live_count,
+            "bytes": self.nbytes,
+            "bytes_per_chunk": self.nbytes / self.live_count if self.live_count else 0.0,
+            "section_types": len(self.sections)
+        }
@@ -0,0 +1,163 @@
+import math
+import time
+import bisect
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# Upper bounds in seconds, from sub-millisecond cache hits to multi-second document ingestion
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(labels)} {_format_value(value)}" for labels, value in values)
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: count per bucket (not cumulative, the last one is +Inf), sum, count
+        self._series: Dict[Labels, List] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+    
+    def time(self, **labels: str) -> "_Timer":
+        return _Timer(self, labels)
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+class _Timer:
+    # A plain class rather than @contextmanager: entering a generator costs several times more
+    __slots__ = ("histogram", "labels", "start_time")
+    
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start_time, **self.labels)
+
+class Gauge:
+    """Read when scraped: collect returns a value, or {label value: value} for one label, or None to skip."""
+    
+    def __init__(self, name: str, help: str, collect: Callable[[], Union[None, float, Dict[str, float]]], label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.label = label
+    
+    def render(self) -> List[str]:
+        try:
+            value = self.collect()
+        except Exception:
+            # One broken source must not fail the whole scrape
+            value = None
+        if value is None:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if isinstance(value, dict):
+            lines.extend(
+                f"{self.name}{_format_labels(((self.label, key),))} {_format_value(v)}"
+                for key, v in sorted(value.items()) if v is not None
+            )
+        else:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+    
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrique {metric.name} déjà enregistrée")
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help))
+    
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, buckets))
+    
+    def gauge(self, name: str, help: str, collect: Callable, label: Optional[str] = None) -> Gauge:
+        return self._register(Gauge(name, help, collect, label))
+    
+    def render(self) -> str:
+        """Prometheus text exposition format, version 0.0.4."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+# Where ingestion and query time goes; stage is one of chunk, embed, db_write, faiss_add, faiss_save,
+# query_embed, vector_search, bm25, fusion, hydration
+stage_seconds = registry.histogram("docqa_stage_duration_seconds", "Time spent in each ingestion and query stage.")
+documents_indexed = registry.counter("docqa_documents_indexed_total", "Documents indexed.")
+documents_deleted = registry.counter("docqa_documents_deleted_total", "Documents deleted from the index.")
+documents_unchanged = registry.counter("docqa_documents_unchanged_total", "Re-submitted documents skipped because nothing changed.")
+chunks_indexed = registry.counter("docqa_chunks_indexed_total", "Chunks embedded and indexed.")
+chunks_reused = registry.counter("docqa_chunks_reused_total", "Re-indexed chunks whose stored vector was kept.")
+indexing_batch_documents = registry.histogram(
+    "docqa_indexing_batch_documents", "Documents indexed together per batch of RabbitMQ messages.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+queries = registry.counter("docqa_queries_total", "Search queries served, by mode.")
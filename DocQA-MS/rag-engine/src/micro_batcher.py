@@ -0,0 +1,89 @@
+import time
+import queue
+import threading
+import numpy as np
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable, List, Dict, Any
+
+class MicroBatcher:
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], window_ms: float = 3.0, max_batch_size: int = 32):
+        self.encode_fn = encode_fn
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.batch_sizes = Counter()
+    
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embed-micro-batcher", daemon=True)
+                self._thread.start()
+    
+    def submit(self, text: str) -> Future:
+        if self._thread is None:
+            self.start()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+    
+    def _collect(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = [(text, future) for text, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            texts = [text for text, _ in batch]
+            futures = [future for _, future in batch]
+            
+            try:
+                embeddings = self.encode_fn(texts)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            
+            for future, embedding in zip(futures, embeddings):
+                future.set_result(embedding)
+            
+            with self._lock:
+                self.batches += 1
+                self.requests += len(texts)
+                self.batch_sizes[len(texts)] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "window_ms": self.window * 1000.0,
+                "max_batch_size": self.max_batch_size,
+                "batches": self.batches,
+                "requests": self.requests,
+                "avg_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "largest_batch": max(self.batch_sizes) if self.batch_sizes else 0,
+                "batch_size_counts": dict(sorted(self.batch_sizes.items())),
+                "queue_depth": self._queue.qsize()
+            }
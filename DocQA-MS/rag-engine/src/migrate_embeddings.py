@@ -0,0 +1,17 @@
+import argparse
+from src.database import engine, Chunk
+from chunk_store import chunk_table, migrate_embeddings, EMBEDDING_DTYPES
+from config import CHUNK_EMBEDDING_DTYPE
+
+def main():
+    parser = argparse.ArgumentParser(description="Convertit les embeddings JSON des chunks en binaire (embedding_bytes).")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dtype", choices=list(EMBEDDING_DTYPES), default=CHUNK_EMBEDDING_DTYPE)
+    parser.add_argument("--drop-vectors", action="store_true", help="vider embedding_vector une fois converti")
+    args = parser.parse_args()
+    
+    migrated = migrate_embeddings(engine, chunk_table(Chunk), args.batch_size, args.dtype, args.drop_vectors)
+    print(f"Migration terminée: {migrated} embeddings convertis")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 from sentence_transformers import SentenceTransformer
 from transformers import AutoTokenizer
-from config import EMBEDDING_MODEL
+from config import EMBEDDING_MODEL, EMBEDDING_BACKEND
+from embedding_backends import create_backend
 
 def preload_models():
     print(f"Préchargement du modèle d'embedding: {EMBEDDING_MODEL}")
@@ -11,6 +12,11 @@ def preload_models():
     tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
     print("Tokenizer chargé avec succès")
     
+    if EMBEDDING_BACKEND != "torch":
+        print(f"Préparation du backend {EMBEDDING_BACKEND}...")
+        create_backend(EMBEDDING_BACKEND, EMBEDDING_MODEL)
+        print("Backend prêt")
+    
     print("Tous les modèles sont prêts")
 
 if __name__ == "__main__":
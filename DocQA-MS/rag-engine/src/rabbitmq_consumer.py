@@ -1,21 +1,46 @@
 import pika
 import json
+import time
 import threading
-from typing import Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from config import (
     RABBITMQ_HOST,
     RABBITMQ_PORT,
     RABBITMQ_USER,
     RABBITMQ_PASSWORD,
-    RABBITMQ_QUEUE_INDEXER
+    RABBITMQ_QUEUE_INDEXER,
+    INDEXER_PREFETCH_COUNT,
+    INDEXER_BATCH_MAX_CHUNKS,
+    INDEXER_BATCH_MAX_WAIT_MS,
+    INDEXER_QUEUE_DEPTH_REFRESH_SECONDS
 )
-from indexer_service import indexer_service
+from indexer_service import indexer_service, DocumentNotFoundError
+from metrics import indexing_batch_documents
 
 class RabbitMQConsumer:
-    def __init__(self):
+    def __init__(
+        self,
+        queue: str = RABBITMQ_QUEUE_INDEXER,
+        prefetch_count: int = INDEXER_PREFETCH_COUNT,
+        batch_max_chunks: int = INDEXER_BATCH_MAX_CHUNKS,
+        batch_max_wait_ms: float = INDEXER_BATCH_MAX_WAIT_MS
+    ):
         self.connection = None
         self.channel = None
-        self.running = False
+        # The connection and channel are only used by the consuming thread, which also closes them
+        self._thread = None
+        self._stop_requested = threading.Event()
+        self.queue = queue
+        self.prefetch_count = prefetch_count
+        self.batch_max_chunks = batch_max_chunks
+        self.batch_max_wait = batch_max_wait_ms / 1000.0
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.documents = 0
+        self.seconds = 0.0
+        # Read by /metrics scrapes, written by the consuming thread; None until it has read the queue
+        self._queue_depth = None
+        self._queue_depth_read_at = 0.0
     
     def connect(self):
         credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
@@ -28,60 +53,198 @@ class RabbitMQConsumer:
         )
         self.connection = pika.BlockingConnection(parameters)
         self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=RABBITMQ_QUEUE_INDEXER, durable=True)
+        self.channel.queue_declare(queue=self.queue, durable=True)
     
-    def process_message(self, ch, method, properties, body):
-        try:
-            message = json.loads(body)
-            document_id = message.get("document_id")
-            content = message.get("content")
-            metadata = message.get("metadata", {})
+    def _estimated_chunks(self, content: str) -> int:
+        # About four characters per token; exact counts would mean chunking before the batch is formed
+        return len(content) // (4 * indexer_service.chunker.chunk_size) + 1
+    
+    def _consume_batches(self):
+        """Gather delivered messages into batches and index each batch in one pass.
+        
+        A batch is indexed when its documents reach batch_max_chunks estimated chunks, when it holds every
+        message the broker will deliver unacked, or when its first message has waited batch_max_wait. Deletes
+        and a second message for a document already in the batch close it first, so each document's
+        messages are applied in order.
+        """
+        pending: List[Tuple[int, Dict[str, Any]]] = []
+        pending_documents = set()
+        pending_chunks = 0
+        first_received = 0.0
+        
+        for method, properties, body in self.channel.consume(self.queue, inactivity_timeout=min(self.batch_max_wait, 0.05)):
+            if time.monotonic() - self._queue_depth_read_at >= INDEXER_QUEUE_DEPTH_REFRESH_SECONDS:
+                self._refresh_queue_depth()
             
-            result = indexer_service.index_document(
-                document_id=document_id,
-                content=content,
-                metadata=metadata
-            )
+            if method is not None:
+                try:
+                    message = json.loads(body)
+                except ValueError as e:
+                    # Never decodable: requeueing would redeliver it forever
+                    print(f"Message illisible ignoré: {str(e)}", flush=True)
+                    self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                    message = None
+                
+                if message is not None:
+                    document_id = message.get("document_id")
+                    is_delete = message.get("action") == "delete"
+                    if pending and (is_delete or document_id in pending_documents):
+                        self._index_batch(pending)
+                        pending, pending_documents, pending_chunks = [], set(), 0
+                    
+                    if is_delete:
+                        self._delete(method.delivery_tag, document_id)
+                    else:
+                        if not pending:
+                            first_received = time.monotonic()
+                        pending.append((method.delivery_tag, message))
+                        pending_documents.add(document_id)
+                        pending_chunks += self._estimated_chunks(message.get("content") or "")
+            
+            if pending and (
+                pending_chunks >= self.batch_max_chunks
+                or len(pending) >= self.prefetch_count
+                or time.monotonic() - first_received >= self.batch_max_wait
+                or self._stop_requested.is_set()
+            ):
+                self._index_batch(pending)
+                pending, pending_documents, pending_chunks = [], set(), 0
             
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            if self._stop_requested.is_set():
+                break
+        
+        # Messages delivered to this consumer but not yet handed out go back to the queue
+        self.channel.cancel()
+    
+    def _refresh_queue_depth(self):
+        self._queue_depth = self.channel.queue_declare(queue=self.queue, passive=True).method.message_count
+        self._queue_depth_read_at = time.monotonic()
+    
+    def _index_batch(self, pending: List[Tuple[int, Dict[str, Any]]]):
+        start_time = time.perf_counter()
+        try:
+            outcomes = indexer_service.index_documents([
+                {
+                    "document_id": message.get("document_id"),
+                    "content": message.get("content"),
+                    "metadata": message.get("metadata", {})
+                }
+                for _, message in pending
+            ])
+        except Exception as e:
+            outcomes = [e] * len(pending)
+        
+        # Each message is settled on its own document's outcome
+        for (delivery_tag, message), outcome in zip(pending, outcomes):
+            if isinstance(outcome, DocumentNotFoundError):
+                # Redelivering would fail the same way forever
+                print(f"Message ignoré: {str(outcome)}", flush=True)
+                self.channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            elif isinstance(outcome, Exception):
+                print(f"Erreur lors de l'indexation du document {message.get('document_id')}: {str(outcome)}", flush=True)
+                self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            else:
+                self.channel.basic_ack(delivery_tag=delivery_tag)
+        
+        indexing_batch_documents.observe(len(pending))
+        with self._stats_lock:
+            self.batches += 1
+            self.documents += len(pending)
+            self.seconds += time.perf_counter() - start_time
+    
+    def _delete(self, delivery_tag: int, document_id: int):
+        try:
+            indexer_service.delete_document(document_id)
+            self.channel.basic_ack(delivery_tag=delivery_tag)
         except Exception as e:
-            print(f"Erreur lors de l'indexation: {str(e)}")
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            print(f"Erreur lors de la suppression: {str(e)}", flush=True)
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "prefetch_count": self.prefetch_count,
+                "batch_max_chunks": self.batch_max_chunks,
+                "batches": self.batches,
+                "documents": self.documents,
+                "average_batch_size": self.documents / self.batches if self.batches else 0.0,
+                "documents_per_second": self.documents / self.seconds if self.seconds else 0.0
+            }
+    
+    def start(self):
+        self._stop_requested.clear()
+        self._thread = threading.Thread(target=self.start_consuming, name="indexer-consumer", daemon=True)
+        self._thread.start()
     
     def start_consuming(self):
-        self.running = True
-        while self.running:
-            try:
-                if not self.connection or self.connection.is_closed:
-                    self.connect()
-                
-                self.channel.basic_qos(prefetch_count=1)
-                self.channel.basic_consume(
-                    queue=RABBITMQ_QUEUE_INDEXER,
-                    on_message_callback=self.process_message
-                )
-                
-                print("Indexer Consumer démarré, en attente de messages...", flush=True)
-                self.channel.start_consuming()
-            except Exception as e:
-                print(f"Erreur consumer RabbitMQ: {str(e)}. Tentative de reconnexion dans 5s...", flush=True)
-                import time
-                time.sleep(5)
+        try:
+            while not self._stop_requested.is_set():
                 try:
-                    if self.connection and not self.connection.is_closed:
-                        self.connection.close()
-                except:
-                    pass
-                self.connection = None
+                    if not self.connection or self.connection.is_closed:
+                        self.connect()
+                    
+                    # The broker delivers at most prefetch_count unacked messages, which bounds a batch
+                    self.channel.basic_qos(prefetch_count=self.prefetch_count)
+                    
+                    print("Indexer Consumer démarré, en attente de messages...", flush=True)
+                    self._consume_batches()
+                except Exception as e:
+                    print(f"Erreur consumer RabbitMQ: {str(e)}. Tentative de reconnexion dans 5s...", flush=True)
+                    self._stop_requested.wait(5)
+                    try:
+                        if self.connection and not self.connection.is_closed:
+                            self.connection.close()
+                    except:
+                        pass
+                    self.connection = None
+        finally:
+            # pika connections are not thread-safe: the thread that used it closes it, after its last ack
+            self.close()
     
-    def stop_consuming(self):
-        if self.channel and self.running:
-            self.channel.stop_consuming()
-            self.running = False
+    def publish(self, message: Dict[str, Any]):
+        # Short-lived connection: the consumer's channel belongs to the consuming thread
+        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials))
+        try:
+            channel = connection.channel()
+            channel.queue_declare(queue=self.queue, durable=True)
+            channel.basic_publish(
+                exchange="",
+                routing_key=self.queue,
+                body=json.dumps(message),
+                properties=pika.BasicProperties(delivery_mode=2)
+            )
+        finally:
+            connection.close()
+    
+    def queue_depth(self) -> Optional[int]:
+        """Messages waiting in the indexer queue, not counting those delivered and not yet acked.
+        
+        The last depth the consuming thread read, at most INDEXER_QUEUE_DEPTH_REFRESH_SECONDS old; None while
+        it is not consuming, so a scrape never opens a connection to the broker.
+        """
+        return self._queue_depth
+    
+    def stop_consuming(self, timeout: float = None) -> bool:
+        """Ask the consuming thread to stop and wait for it; False if it is still running after timeout.
+        
+        It sees the request within one poll, indexes and settles the messages it holds, then closes its connection.
+        """
+        self._stop_requested.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
     
     def close(self):
-        if self.connection and not self.connection.is_closed:
-            self.connection.close()
+        try:
+            if self.connection and not self.connection.is_closed:
+                self.connection.close()
+        finally:
+            self.connection = None
+            self.channel = None
+            self._queue_depth = None
+            self._queue_depth_read_at = 0.0
 
 rabbitmq_consumer = RabbitMQConsumer()
 
@@ -0,0 +1,56 @@
+import threading
+import numpy as np
+from typing import Dict, Any, Optional
+
+class ReservoirSample:
+    def __init__(self, capacity: int, dimension: int, seed: Optional[int] = None):
+        self.capacity = capacity
+        self.dimension = dimension
+        # float16 halves the footprint; k-means on normalized embeddings does not need more precision
+        self.vectors = np.zeros((0, dimension), dtype=np.float16)
+        self.seen = 0
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return min(self.seen, self.capacity)
+    
+    def add(self, vectors: np.ndarray):
+        with self._lock:
+            filled = len(self)
+            take = min(self.capacity - filled, len(vectors))
+            if take:
+                if filled + take > len(self.vectors):
+                    grown = np.zeros((min(self.capacity, max(filled + take, 2 * len(self.vectors))), self.dimension), dtype=np.float16)
+                    grown[:filled] = self.vectors[:filled]
+                    self.vectors = grown
+                self.vectors[filled:filled + take] = vectors[:take]
+            
+            rest = vectors[take:]
+            if len(rest):
+                # Algorithm R, vectorized: item t replaces a random slot with probability capacity / (t + 1)
+                positions = self.seen + take + np.arange(len(rest))
+                slots = (self._rng.random(len(rest)) * (positions + 1)).astype(np.int64)
+                keep = slots < self.capacity
+                self.vectors[slots[keep]] = rest[keep]
+            
+            self.seen += len(vectors)
+    
+    def reset(self, vectors: np.ndarray, seen: int):
+        with self._lock:
+            self.seen = 0
+        self.add(vectors[:self.capacity])
+        with self._lock:
+            self.seen = max(seen, len(self))
+    
+    def sample(self) -> np.ndarray:
+        with self._lock:
+            return self.vectors[:len(self)].astype(np.float32)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "size": len(self),
+            "seen": self.seen,
+            "bytes": self.vectors.nbytes
+        }
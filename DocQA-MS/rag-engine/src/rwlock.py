@@ -0,0 +1,53 @@
+import threading
+from contextlib import contextmanager
+
+class ReadWriteLock:
+    """Shared side for any number of readers, exclusive side for one writer; a waiting writer holds back new readers.
+    
+    The write side is reentrant for the thread holding it. A thread must not take the write side while it reads.
+    """
+    
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+    
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer is not None or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+    
+    @contextmanager
+    def write(self):
+        thread_id = threading.get_ident()
+        with self._condition:
+            if self._writer == thread_id:
+                self._writer_depth += 1
+            else:
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._condition.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = thread_id
+                self._writer_depth = 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._condition.notify_all()
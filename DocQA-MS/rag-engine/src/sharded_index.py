@@ -0,0 +1,219 @@
+import json
+import heapq
+import shutil
+import threading
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable
+from faiss_index import FAISSIndex
+from config import (
+    FAISS_INDEX_PATH,
+    EMBEDDING_DIMENSION,
+    FAISS_INDEX_FACTORY,
+    FAISS_NUM_SHARDS,
+    FAISS_SHARD_SEARCH_THREADS,
+    FAISS_CHECKPOINT_INTERVAL_SECONDS
+)
+
+# Fibonacci hashing spreads sequential or strided document ids evenly over the shards
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+class ShardedFAISSIndex:
+    """N independent FAISSIndex shards routed by document id; drop-in for a single FAISSIndex."""
+    
+    def __init__(
+        self,
+        index_path: str = FAISS_INDEX_PATH,
+        num_shards: int = FAISS_NUM_SHARDS,
+        dimension: int = EMBEDDING_DIMENSION,
+        auto_retrain: bool = True,
+        factory: str = FAISS_INDEX_FACTORY,
+        search_threads: int = FAISS_SHARD_SEARCH_THREADS
+    ):
+        self.index_path = Path(index_path)
+        self.index_path.mkdir(parents=True, exist_ok=True)
+        self.layout_file = self.index_path / "shards.json"
+        self.num_shards = num_shards
+        self.dimension = dimension
+        self.shards = [
+            FAISSIndex(index_path=str(self.index_path / f"shard_{i:02d}"), dimension=dimension, auto_retrain=auto_retrain, factory=factory)
+            for i in range(num_shards)
+        ]
+        self._executor = ThreadPoolExecutor(max_workers=search_threads or num_shards, thread_name_prefix="faiss-shard")
+        self._layout_mismatch = False
+        # Hooks persist state shared by all shards (BM25): they run once per checkpoint round, after every shard
+        self._checkpoint_hooks: List[Callable[[], None]] = []
+        self._checkpoint_lock = threading.Lock()
+        # Shard generations the hooks last saved with; a shard checkpointing on its own moves past them
+        self._hooked_generation = None
+        self._checkpointer = None
+        self._stop_checkpointer = threading.Event()
+    
+    def shard_of(self, document_ids) -> np.ndarray:
+        document_ids = np.asarray(document_ids, dtype=np.int64).astype(np.uint64)
+        with np.errstate(over="ignore"):
+            return ((document_ids * _HASH_MULTIPLIER) >> np.uint64(32)) % np.uint64(self.num_shards)
+    
+    @property
+    def read_only(self) -> bool:
+        return self.shards[0].read_only
+    
+    @property
+    def generation(self) -> List[int]:
+        return [shard.generation for shard in self.shards]
+    
+    @property
+    def published_generation(self) -> List[int]:
+        return [shard.published_generation for shard in self.shards]
+    
+    @property
+    def needs_rebuild(self) -> bool:
+        return self._layout_mismatch or any(shard.needs_rebuild for shard in self.shards)
+    
+    @property
+    def ntotal(self) -> int:
+        return sum(shard.index.ntotal for shard in self.shards if shard.index is not None)
+    
+    def initialize_index(self):
+        for shard in self.shards:
+            shard.initialize_index()
+    
+    def load_index(self):
+        layout = json.loads(self.layout_file.read_text()) if self.layout_file.exists() else None
+        if layout is not None and layout["num_shards"] != self.num_shards:
+            print(f"FAISS index has {layout['num_shards']} shards, {self.num_shards} configured: rebuild required.", flush=True)
+            self._layout_mismatch = True
+        elif layout is None and (self.index_path / "faiss_index.idx").exists():
+            print("Unsharded FAISS index found, rebuild into shards required.", flush=True)
+            self._layout_mismatch = True
+        
+        if self._layout_mismatch:
+            self.initialize_index()
+            return
+        
+        for shard in self.shards:
+            shard.load_index()
+    
+    def save_index(self):
+        self._checkpoint(self.shards)
+        if not self.read_only:
+            self.layout_file.write_text(json.dumps({"num_shards": self.num_shards, "router": "document_id_hash"}))
+    
+    def _checkpoint(self, shards: List[FAISSIndex]):
+        with self._checkpoint_lock:
+            for shard in shards:
+                shard.save_index()
+            self._run_checkpoint_hooks()
+    
+    def _run_checkpoint_hooks(self):
+        if self.read_only:
+            return
+        for hook in self._checkpoint_hooks:
+            hook()
+        self._hooked_generation = self.published_generation
+    
+    def finish_rebuild(self):
+        with self._checkpoint_lock:
+            for shard in self.shards:
+                shard.finish_rebuild()
+            for stale in self.index_path.glob("shard_*"):
+                if stale.is_dir() and int(stale.name.split("_")[1]) >= self.num_shards:
+                    shutil.rmtree(stale)
+            # Files of an unsharded index at the root are superseded once the shards are written
+            for stale in ["faiss_index.idx", "faiss_index.json", "faiss_refine.idx", "faiss_tombstones.npy", "faiss_wal.log", "metadata.cols", "metadata.pkl", "id_mapping.pkl"]:
+                (self.index_path / stale).unlink(missing_ok=True)
+            self.layout_file.write_text(json.dumps({"num_shards": self.num_shards, "router": "document_id_hash"}))
+            self._layout_mismatch = False
+            self._run_checkpoint_hooks()
+    
+    def add_checkpoint_hook(self, hook: Callable[[], None]):
+        self._checkpoint_hooks.append(hook)
+    
+    def start_checkpointer(self):
+        """Checkpoint rounds for all shards together; each shard still retrains in the background on its own."""
+        if self._checkpointer is not None:
+            return
+        
+        for shard in self.shards:
+            shard.start_checkpointer(checkpoint=False)
+        # What the hooks saved last, at startup or a rebuild; rounds start from there
+        self._hooked_generation = self.published_generation
+        
+        def run():
+            while not self._stop_checkpointer.wait(min(FAISS_CHECKPOINT_INTERVAL_SECONDS, 30)):
+                # A shard may also have checkpointed alone, past a WAL size limit or after a retrain
+                if any(shard.checkpoint_due() for shard in self.shards) or self.published_generation != self._hooked_generation:
+                    self._checkpoint([shard for shard in self.shards if shard.unsaved_writes])
+        
+        self._checkpointer = threading.Thread(target=run, name="faiss-shard-checkpointer", daemon=True)
+        self._checkpointer.start()
+    
+    def stop_checkpointer(self):
+        self._stop_checkpointer.set()
+        for shard in self.shards:
+            shard.stop_checkpointer()
+    
+    def acquire_writer_role(self) -> bool:
+        # Every worker tries the shards in the same order, so whoever wins shard 0 gets them all
+        return all(shard.acquire_writer_role() for shard in self.shards)
+    
+    def open_read_only(self):
+        for shard in self.shards:
+            shard.open_read_only()
+    
+    def reload_if_published(self) -> bool:
+        return any([shard.reload_if_published() for shard in self.shards])
+    
+    def add_vectors(self, embeddings: np.ndarray, chunk_ids: List[int], metadata: List[Dict[str, Any]], save: bool = True):
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        # Chunks without a document fall back to their own id so they still spread evenly
+        document_ids = [
+            meta.get("document_id") if meta.get("document_id") is not None else chunk_id
+            for meta, chunk_id in zip(metadata, chunk_ids.tolist())
+        ]
+        owners = self.shard_of(document_ids)
+        for shard_id in np.unique(owners).tolist():
+            rows = np.flatnonzero(owners == shard_id)
+            self.shards[shard_id].add_vectors(embeddings[rows], chunk_ids[rows], [metadata[row] for row in rows.tolist()], save=save)
+    
+    def chunk_ids_for_document(self, document_id: int) -> np.ndarray:
+        return self.shards[int(self.shard_of([document_id])[0])].chunk_ids_for_document(document_id)
+    
+    def delete_document(self, document_id: int) -> int:
+        return self.shards[int(self.shard_of([document_id])[0])].delete_document(document_id)
+    
+    def _target_shards(self, filters: Optional[Dict[str, Any]]) -> List[FAISSIndex]:
+        document_ids = None
+        if filters and filters.get("document_id") is not None:
+            document_ids = [filters["document_id"]]
+        elif filters and filters.get("document_ids") is not None:
+            document_ids = filters["document_ids"]
+        if document_ids is None:
+            return self.shards
+        return [self.shards[shard_id] for shard_id in np.unique(self.shard_of(document_ids)).tolist()]
+    
+    def search(self, query_embedding: np.ndarray, k: int = 10, filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        shards = self._target_shards(filters)
+        if len(shards) == 1:
+            return shards[0].search(query_embedding, k=k, filters=filters)
+        
+        # FAISS releases the GIL while searching, so shards are scanned concurrently
+        results = self._executor.map(lambda shard: shard.search(query_embedding, k=k, filters=filters), shards)
+        return heapq.nlargest(k, (result for shard_results in results for result in shard_results), key=lambda r: r["score"])
+    
+    def get_stats(self) -> Dict[str, Any]:
+        shard_stats = [shard.get_stats() for shard in self.shards]
+        total_vectors = sum(stats["total_vectors"] for stats in shard_stats)
+        return {
+            "total_vectors": total_vectors,
+            "dimension": self.dimension,
+            "num_shards": self.num_shards,
+            "router": "document_id_hash",
+            "index_type": shard_stats[0]["index_type"],
+            "factory": shard_stats[0]["factory"],
+            "read_only": self.read_only,
+            "bytes_per_vector": sum(stats["bytes_per_vector"] * stats["total_vectors"] for stats in shard_stats) / total_vectors if total_vectors else 0.0,
+            "needs_rebuild": self.needs_rebuild,
+            "shards": shard_stats
+        }
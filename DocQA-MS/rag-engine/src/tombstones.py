@@ -0,0 +1,64 @@
+import faiss
+import numpy as np
+from pathlib import Path
+from typing import Dict, Any
+
+class TombstoneSet:
+    """Deleted chunk ids still stored in an index that cannot remove vectors in place (HNSW)."""
+    
+    def __init__(self, bitmap: np.ndarray = None):
+        # One bit per chunk id, little-endian within each byte as faiss.IDSelectorBitmap expects
+        self.bitmap = bitmap if bitmap is not None else np.zeros(0, dtype=np.uint8)
+        self.count = int(np.unpackbits(self.bitmap).sum()) if len(self.bitmap) else 0
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def _ensure_capacity(self, chunk_ids: np.ndarray) -> np.ndarray:
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        size = int(chunk_ids.max()) // 8 + 1 if len(chunk_ids) else 0
+        if size > len(self.bitmap):
+            grown = np.zeros(max(size, 2 * len(self.bitmap)), dtype=np.uint8)
+            grown[:len(self.bitmap)] = self.bitmap
+            self.bitmap = grown
+        return chunk_ids
+    
+    def contains(self, chunk_ids: np.ndarray) -> np.ndarray:
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        present = np.zeros(len(chunk_ids), dtype=bool)
+        inside = (chunk_ids >> 3) < len(self.bitmap)
+        present[inside] = (self.bitmap[chunk_ids[inside] >> 3] >> (chunk_ids[inside] & 7)) & 1 == 1
+        return present
+    
+    def add(self, chunk_ids: np.ndarray):
+        chunk_ids = np.unique(self._ensure_capacity(chunk_ids))
+        chunk_ids = chunk_ids[~self.contains(chunk_ids)]
+        np.bitwise_or.at(self.bitmap, chunk_ids >> 3, (1 << (chunk_ids & 7)).astype(np.uint8))
+        self.count += len(chunk_ids)
+    
+    def discard(self, chunk_ids: np.ndarray):
+        chunk_ids = np.unique(np.asarray(chunk_ids, dtype=np.int64))
+        chunk_ids = chunk_ids[self.contains(chunk_ids)]
+        np.bitwise_and.at(self.bitmap, chunk_ids >> 3, ~(1 << (chunk_ids & 7)).astype(np.uint8))
+        self.count -= len(chunk_ids)
+    
+    def selector(self):
+        """IDSelector accepting every id that is not tombstoned."""
+        bitmap = faiss.IDSelectorBitmap(len(self.bitmap), faiss.swig_ptr(self.bitmap))
+        # IDSelectorBitmap reads the array in place; IDSelectorNot already holds a reference to its inner selector
+        bitmap.bitmap_ref = self.bitmap
+        return faiss.IDSelectorNot(bitmap)
+    
+    def save(self, path: Path):
+        with open(path, 'wb') as f:
+            np.save(f, self.bitmap)
+    
+    @classmethod
+    def load(cls, path: Path, mmap: bool = False) -> "TombstoneSet":
+        return cls(np.load(path, mmap_mode="r" if mmap else None))
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "bytes": self.bitmap.nbytes
+        }
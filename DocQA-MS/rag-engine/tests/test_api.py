@@ -18,4 +18,9 @@ class TestAPI:
         response = client.get("/index/stats")
         assert response.status_code == 200
         assert "faiss_stats" in response.json()
-
+    
+    def test_metrics_endpoint(self):
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "# TYPE docqa_stage_duration_seconds histogram" in response.text
@@ -0,0 +1,113 @@
+import pytest
+import numpy as np
+from src.bm25_search import BM25Search
+from src.faiss_index import FAISSIndex
+
+def bm25_at(path):
+    bm25 = BM25Search(refresh_seconds=0)
+    bm25.index_path = path
+    bm25.index_file = path / "bm25_index.npz"
+    return bm25
+
+def make_chunks():
+    return [
+        {"chunk_id": 1, "text": "Traitement anticoagulant par héparine", "metadata": {"document_id": 10, "section_type": "traitement"}},
+        {"chunk_id": 2, "text": "Antécédents cardiaques: infarctus", "metadata": {"document_id": 10, "section_type": "anamnese"}},
+        {"chunk_id": 3, "text": "Examen clinique sans particularité", "metadata": {"document_id": 20, "section_type": "examen"}}
+    ]
+
+class TestBM25Search:
+    def test_search_ranks_matching_chunk_first(self):
+        bm25 = BM25Search()
+        bm25.build_index(make_chunks())
+        
+        results = bm25.search("traitement anticoagulant", top_k=2)
+        
+        assert results[0]["chunk_id"] == 1
+        assert results[0]["metadata"]["document_id"] == 10
+        assert all(r["bm25_score"] > 0 for r in results)
+    
+    def test_incremental_add_and_delete(self):
+        bm25 = BM25Search(refresh_seconds=0)
+        bm25.build_index(make_chunks())
+        
+        bm25.add_chunks([{"chunk_id": 4, "text": "Anticoagulant arrêté", "metadata": {"document_id": 30}}])
+        assert 4 in {r["chunk_id"] for r in bm25.search("anticoagulant")}
+        
+        bm25.delete_document(10)
+        chunk_ids = {r["chunk_id"] for r in bm25.search("anticoagulant cardiaques")}
+        assert chunk_ids == {4}
+        assert bm25.get_stats()["total_chunks"] == 2
+    
+    def test_scores_match_reference_formula(self):
+        bm25 = BM25Search()
+        chunks = make_chunks()
+        bm25.build_index(chunks)
+        
+        docs = [bm25._tokenize(c["text"]) for c in chunks]
+        avgdl = sum(len(d) for d in docs) / len(docs)
+        expected = {}
+        for chunk, doc in zip(chunks, docs):
+            score = 0.0
+            for term in ["anticoagulant", "examen"]:
+                df = sum(term in d for d in docs)
+                tf = doc.count(term)
+                idf = np.log1p((len(docs) - df + 0.5) / (df + 0.5))
+                score += idf * tf * (bm25.k1 + 1) / (tf + bm25.k1 * (1 - bm25.b + bm25.b * len(doc) / avgdl))
+            if score > 0:
+                expected[chunk["chunk_id"]] = score
+        
+        results = bm25.search("anticoagulant examen", top_k=10)
+        assert {r["chunk_id"]: r["bm25_score"] for r in results} == pytest.approx(expected, rel=1e-5)
+    
+    def test_save_and_load(self, tmp_path):
+        bm25 = BM25Search()
+        bm25.index_path = tmp_path
+        bm25.index_file = tmp_path / "bm25_index.npz"
+        bm25.build_index(make_chunks())
+        bm25.save_index()
+        
+        restored = BM25Search()
+        restored.index_path = tmp_path
+        restored.index_file = tmp_path / "bm25_index.npz"
+        assert restored.load_index()
+        assert restored.search("examen") == bm25.search("examen")
+    
+    def test_save_records_faiss_generation(self, tmp_path):
+        bm25 = BM25Search()
+        bm25.index_path = tmp_path
+        bm25.index_file = tmp_path / "bm25_index.npz"
+        bm25.build_index(make_chunks())
+        bm25.save_index(generation=[4, 6])
+        
+        restored = BM25Search()
+        restored.index_path = tmp_path
+        restored.index_file = tmp_path / "bm25_index.npz"
+        assert restored.load_index()
+        assert restored.generation == [4, 6]
+    
+    def test_reader_loads_copy_published_with_faiss(self, tmp_path):
+        writer, writer_bm25 = FAISSIndex(index_path=str(tmp_path)), bm25_at(tmp_path)
+        writer.load_index()
+        writer.add_checkpoint_hook(lambda: writer_bm25.save_index(writer.published_generation))
+        embeddings = np.random.rand(4, 768).astype('float32')
+        writer_bm25.build_index(make_chunks())
+        writer.add_vectors(embeddings[:3], [1, 2, 3], [{"document_id": 10}, {"document_id": 10}, {"document_id": 20}])
+        writer.save_index()
+        
+        reader, reader_bm25 = FAISSIndex(index_path=str(tmp_path)), bm25_at(tmp_path)
+        reader.open_read_only()
+        assert reader_bm25.reload_if_changed(reader.generation)
+        assert not reader_bm25.reload_if_changed(reader.generation)
+        
+        writer_bm25.add_chunks([{"chunk_id": 4, "text": "Anticoagulant arrêté", "metadata": {"document_id": 30}}])
+        writer.add_vectors(embeddings[3:], [4], [{"document_id": 30}])
+        writer.save_index()
+        
+        # Saved at a checkpoint the reader's FAISS index has not loaded yet
+        assert not reader_bm25.reload_if_changed(reader.generation)
+        assert 4 not in {r["chunk_id"] for r in reader_bm25.search("anticoagulant")}
+        
+        assert reader.reload_if_published()
+        assert reader_bm25.reload_if_changed(reader.generation)
+        assert 4 in {r["chunk_id"] for r in reader_bm25.search("anticoagulant")}
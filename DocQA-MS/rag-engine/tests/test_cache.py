@@ -0,0 +1,38 @@
+import time
+import pytest
+from src.cache import LRUCache
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.put(1, "a")
+        cache.put(2, "b")
+        cache.get(1)
+        cache.put(3, "c")
+        
+        assert cache.get(2) is None
+        assert cache.get_many([1, 3]) == {1: "a", 3: "c"}
+        assert len(cache) == 2
+    
+    def test_stats_and_invalidation(self):
+        cache = LRUCache(max_size=10)
+        cache.put(1, "a")
+        cache.put(2, "b")
+        cache.get(1)
+        cache.pop_many([1, 2])
+        cache.get(1)
+        
+        stats = cache.get_stats()
+        assert stats["size"] == 0
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_rate"] == 0.5
+    
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(max_size=10, ttl=0.01)
+        cache.put("q", 1)
+        assert cache.get("q") == 1
+        
+        time.sleep(0.02)
+        assert cache.get("q") is None
+        assert cache.get_stats()["expirations"] == 1
@@ -0,0 +1,96 @@
+import types
+import pytest
+import numpy as np
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, Text, JSON, insert, select
+from sqlalchemy.orm import Session
+from src.chunk_store import (
+    chunk_table,
+    ensure_schema,
+    encode_embeddings,
+    decode_embeddings,
+    stored_embeddings,
+    insert_chunks,
+    migrate_embeddings
+)
+
+def _legacy_chunks(engine):
+    # The columns of the shared chunks table, before embedding_bytes
+    table = Table(
+        "chunks", MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("document_id", Integer),
+        Column("texte", Text),
+        Column("position", Integer),
+        Column("chunk_metadata", JSON),
+        Column("embedding_vector", JSON)
+    )
+    table.metadata.create_all(engine)
+    return table
+
+def _embeddings(num_rows, dimension=768, seed=0):
+    embeddings = np.random.default_rng(seed).standard_normal((num_rows, dimension)).astype('float32')
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+class TestEmbeddingEncoding:
+    def test_round_trip(self):
+        embeddings = _embeddings(5)
+        blobs = encode_embeddings(embeddings, "float32")
+        assert all(len(blob) == 768 * 4 for blob in blobs)
+        assert np.array_equal(decode_embeddings(blobs), embeddings)
+        
+        blobs = encode_embeddings(embeddings, "float16")
+        assert all(len(blob) == 768 * 2 for blob in blobs)
+        decoded = decode_embeddings(blobs)
+        assert decoded.dtype == np.float32
+        assert np.abs(decoded - embeddings).max() < 1e-3
+    
+    def test_mixed_rows(self):
+        embeddings = _embeddings(4)
+        blobs = encode_embeddings(embeddings[:2], "float16") + encode_embeddings(embeddings[2:3], "float32") + [None]
+        decoded = stored_embeddings(blobs, [None, None, None, embeddings[3].tolist()])
+        assert np.abs(decoded - embeddings).max() < 1e-3
+        assert np.array_equal(decoded[2:], embeddings[2:])
+        
+        with pytest.raises(ValueError):
+            decode_embeddings([b"\0" * 10])
+
+class TestChunkStore:
+    def test_bulk_insert_returns_ids_in_order(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'chunks.db'}")
+        table = chunk_table(types.SimpleNamespace(__table__=_legacy_chunks(engine)))
+        ensure_schema(engine, table)
+        ensure_schema(engine, table)
+        
+        embeddings = _embeddings(50)
+        with Session(engine) as db:
+            ids = insert_chunks(db, table, [
+                {"document_id": 1, "texte": f"chunk {i}", "position": i, "chunk_metadata": {}, "embedding_bytes": blob}
+                for i, blob in enumerate(encode_embeddings(embeddings))
+            ])
+            db.commit()
+            rows = db.execute(select(table.c.id, table.c.texte, table.c.embedding_bytes)).all()
+        
+        assert len(ids) == 50
+        by_id = {row.id: row for row in rows}
+        assert [by_id[chunk_id].texte for chunk_id in ids] == [f"chunk {i}" for i in range(50)]
+        assert np.array_equal(decode_embeddings([by_id[chunk_id].embedding_bytes for chunk_id in ids]), embeddings)
+    
+    def test_migration_backfills_legacy_rows(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'chunks.db'}")
+        legacy = _legacy_chunks(engine)
+        embeddings = _embeddings(23)
+        with engine.begin() as connection:
+            connection.execute(insert(legacy), [
+                {"document_id": 1, "texte": f"chunk {i}", "position": i, "chunk_metadata": {}, "embedding_vector": embedding.tolist()}
+                for i, embedding in enumerate(embeddings)
+            ])
+        
+        table = chunk_table(types.SimpleNamespace(__table__=legacy))
+        assert migrate_embeddings(engine, table, batch_size=7, dtype="float16", drop_vectors=True) == 23
+        assert migrate_embeddings(engine, table, batch_size=7) == 0
+        
+        with engine.connect() as connection:
+            rows = connection.execute(select(table.c.embedding_bytes, table.c.embedding_vector).order_by(table.c.id)).all()
+        assert all(row.embedding_vector is None for row in rows)
+        decoded = stored_embeddings([row.embedding_bytes for row in rows], [row.embedding_vector for row in rows])
+        assert np.abs(decoded - embeddings).max() < 1e-3
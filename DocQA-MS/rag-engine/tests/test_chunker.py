@@ -1,3 +1,4 @@
+import re
 import pytest
 from src.chunker import MedicalChunker
 
@@ -25,3 +26,103 @@ class TestMedicalChunker:
         assert all("text" in chunk for chunk in chunks)
         assert all("metadata" in chunk for chunk in chunks)
 
+
+# The regex table the keyword scanner replaced
+LINE_PATTERNS = {
+    "anamnese": [r"(?:anamnèse|anamnese|histoire|histoire de la maladie)", r"(?:motif|raison|consultation)", r"(?:antécédents|antecedents)"],
+    "diagnostic": [r"(?:diagnostic|diagnostique|conclusion)", r"(?:impression|impression clinique)", r"(?:hypothèse|hypothese diagnostique)"],
+    "traitement": [r"(?:traitement|therapeutique|thérapeutique)", r"(?:prescription|médicaments|medicaments)", r"(?:plan de traitement)"],
+    "examen": [r"(?:examen|examen clinique|examen physique)", r"(?:observations|observation)", r"(?:signes cliniques)"],
+    "evolution": [r"(?:évolution|evolution|suivi)", r"(?:prognostic|pronostic)", r"(?:suivi|follow-up)"]
+}
+
+def _line_based_sections(text):
+    # Reference for the single-pass scanner: the original line by line detection
+    sections = []
+    lines = text.split('\n')
+    current_section = None
+    current_start = 0
+    for i, line in enumerate(lines):
+        line_lower = line.lower().strip()
+        detected_type = next(
+            (t for t, patterns in LINE_PATTERNS.items() if any(re.search(p, line_lower, re.IGNORECASE) for p in patterns)),
+            None
+        )
+        if detected_type and detected_type != current_section:
+            if current_section:
+                sections.append((current_section, "\n".join(lines[current_start:i])))
+            current_section = detected_type
+            current_start = i
+    if current_section:
+        sections.append((current_section, "\n".join(lines[current_start:])))
+    return sections or [("general", text)]
+
+GOLDEN_DOCUMENTS = [
+    "",
+    "Texte libre sans aucune rubrique.\nDeuxième ligne.",
+    "Préambule ignoré\nANAMNÈSE\nDouleur thoracique.\n\nDIAGNOSTIC\nInfarctus.\nTRAITEMENT\nAspirine.\n",
+    "Examen clinique : diagnostic évoqué\nSuivi à 3 mois\nÉVOLUTION favorable\nsuivi\n",
+    "Motif de consultation\nAntécédents\nHistoire de la maladie\nExamen physique\nObservations\nPlan de traitement",
+    "İmpression clinique\nHYPOTHÈSE diagnostique\nfollow-up\nPronostic réservé",
+    "traitement\n\n\ntraitement\nexamen\n   \nconclusion\r\nprescription\n",
+    "ſuivi post-opératoire\nDıagnostic retenu\nKONCLUSION",
+]
+
+class TestSectionScanner:
+    @pytest.mark.parametrize("text", GOLDEN_DOCUMENTS)
+    def test_matches_line_based_detection(self, text):
+        chunker = MedicalChunker()
+        sections = chunker.detect_sections(text)
+        assert [(s["type"], s["text"]) for s in sections] == _line_based_sections(text)
+        assert all(text[s["start"]:s["end"]] == s["text"] for s in sections)
+    
+    def test_highest_priority_type_wins_on_a_line(self):
+        chunker = MedicalChunker()
+        sections = chunker.detect_sections("Examen et diagnostic\nRAS")
+        assert [s["type"] for s in sections] == ["diagnostic"]
+
+class TestOffsetSlicing:
+    def test_chunks_are_slices_of_the_document(self, monkeypatch):
+        chunker = MedicalChunker(chunk_size=64, chunk_overlap=8)
+        monkeypatch.setattr(chunker.tokenizer, "decode", None)
+        text = "Préambule\nANAMNÈSE\n" + "Le  patient présente une dyspnée d'effort.\n" * 40 + "TRAITEMENT\nAspirine 100 mg, à jeun.\n"
+        chunks = chunker.chunk_text(text)
+        
+        assert len(chunks) > 2
+        for chunk in chunks:
+            meta = chunk["metadata"]
+            assert chunk["text"] == text[meta["char_start"]:meta["char_end"]]
+            assert meta["token_end"] - meta["token_start"] <= 64
+        
+        anamnese = [c["metadata"] for c in chunks if c["metadata"]["section_type"] == "anamnese"]
+        assert anamnese[0]["char_start"] == text.index("ANAMNÈSE")
+        assert all(b["token_start"] == a["token_end"] - 8 for a, b in zip(anamnese, anamnese[1:]))
+        assert chunks[-1]["metadata"]["char_end"] == len(text)
+
+class TestChunkDocuments:
+    def _documents(self, count):
+        for i in range(count):
+            body = f"Patient {i} : douleur thoracique, dyspnée.\n" * (5 + 20 * (i % 3))
+            yield {"document_id": i, "content": f"ANAMNÈSE\n{body}DIAGNOSTIC\nAngor stable.\n", "metadata": {"source": "test"}}
+    
+    def test_matches_chunk_text(self):
+        chunker = MedicalChunker(chunk_size=64, chunk_overlap=8)
+        stream = chunker.chunk_documents(self._documents(10), batch_size=4)
+        chunks = list(stream)
+        
+        expected = []
+        for document in self._documents(10):
+            for chunk in chunker.chunk_text(document["content"], document["metadata"]):
+                expected.append({**chunk, "document_id": document["document_id"]})
+        assert chunks == expected
+        
+        stats = stream.get_stats()
+        assert stats["documents"] == 10
+        assert stats["chunks"] == len(chunks)
+        assert stats["tokens"] > 0 and stats["tokens_per_second"] > 0
+    
+    def test_process_pool_keeps_order(self):
+        chunker = MedicalChunker(chunk_size=64, chunk_overlap=8)
+        pooled = list(chunker.chunk_documents(self._documents(12), batch_size=2, workers=2))
+        assert pooled == list(chunker.chunk_documents(self._documents(12), batch_size=5))
+        assert [c["document_id"] for c in pooled] == sorted(c["document_id"] for c in pooled)
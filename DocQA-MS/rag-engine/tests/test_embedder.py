@@ -1,6 +1,7 @@
 import pytest
 import numpy as np
 from src.embedder import Embedder
+from src.embedding_backends import create_backend, parity_check, pad_batch, token_budget_batches
 
 class TestEmbedder:
     def test_embed_text_single(self):
@@ -22,4 +23,47 @@ class TestEmbedder:
         embedding = embedder.embed_text(text)
         norm = np.linalg.norm(embedding[0])
         assert abs(norm - 1.0) < 0.01
+    
+    def test_query_cache_hit(self):
+        embedder = Embedder()
+        first = embedder.embed_text("traitement  anticoagulant")
+        second = embedder.embed_text(" traitement anticoagulant")
+        assert np.allclose(first, second)
+        assert embedder.get_cache_stats()["hits"] == 1
+    
+    def test_embed_batch_keeps_input_order(self):
+        embedder = Embedder()
+        texts = ["Diagnostic", "Le patient présente une douleur thoracique irradiant au bras gauche depuis trois jours. " * 5, "Suivi"]
+        batched = embedder.embed_batch(texts, max_batch_tokens=64)
+        assert batched.shape == (3, 768)
+        for text, embedding in zip(texts, batched):
+            assert np.dot(embedder.embed_text(text)[0], embedding) > 0.999
 
+class TestEmbeddingBackends:
+    def test_token_budget_batches(self):
+        lengths = [5, 120, 7, 128, 3, 64, 9]
+        batches = token_budget_batches(lengths, max_batch_tokens=256)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+        assert batches[0] == [3, 1]
+        for batch in batches:
+            assert len(batch) * max(lengths[i] for i in batch) <= 256
+        assert token_budget_batches([300, 10], max_batch_tokens=256) == [[0], [1]]
+        assert token_budget_batches([], max_batch_tokens=256) == []
+    
+    def test_pad_batch(self):
+        input_ids, attention_mask = pad_batch([[0, 7, 2], [0, 2]], pad_token_id=1)
+        assert input_ids.tolist() == [[0, 7, 2], [0, 2, 1]]
+        assert attention_mask.tolist() == [[1, 1, 1], [1, 1, 0]]
+    
+    def test_unknown_backend_rejected(self):
+        with pytest.raises(ValueError):
+            create_backend("tensorrt")
+    
+    @pytest.mark.parametrize("name, min_cosine", [("onnx", 0.999), ("onnx-int8", 0.95)])
+    def test_onnx_parity_with_torch(self, tmp_path, name, min_cosine):
+        pytest.importorskip("onnxruntime")
+        texts = ["Douleur thoracique irradiant au bras gauche", "Traitement anticoagulant poursuivi", "Test"]
+        backend = create_backend(name, onnx_path=str(tmp_path))
+        parity = parity_check(backend, create_backend("torch"), texts)
+        assert parity["samples"] == 3
+        assert parity["min_cosine"] > min_cosine
@@ -0,0 +1,28 @@
+import threading
+import pytest
+from src.executors import BoundedExecutor, ExecutorSaturatedError
+
+class TestBoundedExecutor:
+    def test_rejects_when_queue_is_full(self):
+        executor = BoundedExecutor("test", max_workers=1, max_queue=1)
+        release = threading.Event()
+        
+        running = executor.submit(release.wait)
+        queued = executor.submit(lambda: 42)
+        with pytest.raises(ExecutorSaturatedError):
+            executor.submit(lambda: 0)
+        
+        assert executor.get_stats()["queue_depth"] == 1
+        release.set()
+        assert queued.result(timeout=2) == 42
+        assert running.result(timeout=2)
+        
+        stats = executor.get_stats()
+        assert stats["rejected"] == 1
+        assert stats["completed"] == 2
+        executor.shutdown()
+    
+    async def test_run_from_event_loop(self):
+        executor = BoundedExecutor("test", max_workers=2, max_queue=2)
+        assert await executor.run(sum, [1, 2, 3]) == 6
+        executor.shutdown()
@@ -1,6 +1,8 @@
+import time
 import pytest
+import threading
 import numpy as np
-from src.faiss_index import FAISSIndex
+from src.faiss_index import FAISSIndex, ReadOnlyIndexError
 
 class TestFAISSIndex:
     def test_initialize_index(self):
@@ -38,4 +40,324 @@ class TestFAISSIndex:
         
         assert len(results) <= 5
         assert all("chunk_id" in r for r in results)
-
+    
+    def test_chunk_ids_are_faiss_ids(self):
+        index = FAISSIndex()
+        index.initialize_index()
+        
+        embeddings = np.random.rand(20, 768).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        
+        index.add_vectors(embeddings[:10], list(range(100, 110)), [{"document_id": 1}] * 10)
+        index.add_vectors(embeddings[10:], list(range(200, 210)), [{"document_id": 2}] * 10)
+        index.delete_document(1)
+        index.add_vectors(embeddings[:1], [300], [{"document_id": 3}])
+        
+        results = index.search(embeddings[10], k=1)
+        assert results[0]["chunk_id"] == 200
+        assert results[0]["score"] == pytest.approx(1.0, abs=1e-5)
+        assert results[0]["metadata"]["document_id"] == 2
+        assert index.index.ntotal == 11
+    
+    def test_wal_replay_after_crash(self, tmp_path):
+        index = FAISSIndex(index_path=str(tmp_path))
+        index.load_index()
+        
+        embeddings = np.random.rand(6, 768).astype('float32')
+        index.add_vectors(embeddings[:3], [1, 2, 3], [{"document_id": 1}] * 3)
+        index.save_index()
+        index.add_vectors(embeddings[3:], [4, 5, 6], [{"document_id": 2}] * 3)
+        index.delete_document(1)
+        assert index.wal.records == 2
+        
+        recovered = FAISSIndex(index_path=str(tmp_path))
+        recovered.load_index()
+        
+        assert recovered.index.ntotal == 3
+        assert set(recovered.metadata_store.chunk_ids().tolist()) == {4, 5, 6}
+        assert recovered.search(embeddings[4], k=1)[0]["chunk_id"] == 5
+        assert recovered.wal.records == 0
+    
+    def test_filtered_search_returns_full_top_k(self, tmp_path):
+        index = FAISSIndex(index_path=str(tmp_path))
+        index.initialize_index()
+        
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((2000, 768)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        sections = ["anamnese", "diagnostic", "traitement", "conclusion"]
+        metadata = [{"document_id": i // 20, "section_type": sections[i % 4]} for i in range(2000)]
+        index.add_vectors(embeddings, list(range(2000)), metadata, save=False)
+        
+        by_document = index.search(embeddings[0], k=10, filters={"document_id": 42})
+        assert len(by_document) == 10
+        assert {r["metadata"]["document_id"] for r in by_document} == {42}
+        
+        by_section = index.search(embeddings[0], k=10, filters={"section_type": "conclusion"})
+        assert len(by_section) == 10
+        assert {r["metadata"]["section_type"] for r in by_section} == {"conclusion"}
+        
+        combined = index.search(embeddings[0], k=10, filters={"document_ids": [3, 4], "section_type": "anamnese"})
+        assert len(combined) == 10
+        assert all(r["metadata"]["document_id"] in (3, 4) and r["chunk_id"] % 4 == 0 for r in combined)
+        
+        assert index.search(embeddings[0], k=10, filters={"section_type": "inconnue"}) == []
+    
+    def test_delete_document_after_reload(self, tmp_path):
+        index = FAISSIndex(index_path=str(tmp_path))
+        index.load_index()
+        
+        embeddings = np.random.rand(300, 768).astype('float32')
+        metadata = [{"document_id": i // 30, "section_type": "general"} for i in range(300)]
+        index.add_vectors(embeddings, list(range(300)), metadata)
+        index.save_index()
+        
+        reloaded = FAISSIndex(index_path=str(tmp_path))
+        reloaded.load_index()
+        assert reloaded.metadata_store.chunk_ids_for_document(4).tolist() == list(range(120, 150))
+        
+        assert reloaded.delete_document(4) == 30
+        assert reloaded.delete_document(4) == 0
+        assert reloaded.index.ntotal == 270
+        assert all(r["metadata"]["document_id"] != 4 for r in reloaded.search(embeddings[125], k=50))
+    
+    def test_retrain_replays_concurrent_writes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("src.faiss_index.FAISS_IVF_MIN_VECTORS", 2000)
+        index = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False)
+        index.load_index()
+        
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((4000, 32)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        index.add_vectors(embeddings[:3000], list(range(3000)), [{"document_id": i // 10} for i in range(3000)])
+        assert index.get_stats()["index_type"] == "flat"
+        assert index.needs_retrain()
+        
+        training_sample = index._training_sample
+        
+        def sample_with_writes(chunk_ids):
+            # Writes landing while the new index is being populated
+            index.delete_document(0)
+            index.add_vectors(embeddings[3000:], list(range(3000, 4000)), [{"document_id": 300 + i // 10} for i in range(1000)])
+            return training_sample(chunk_ids)
+        monkeypatch.setattr(index, "_training_sample", sample_with_writes)
+        index.retrain()
+        
+        stats = index.get_stats()
+        assert stats["index_type"] == "ivf" and stats["retrain_count"] == 1
+        assert index.index.ntotal == 3990
+        assert index.search(embeddings[3500], k=1)[0]["chunk_id"] == 3500
+        assert index.search(embeddings[5], k=1)[0]["chunk_id"] != 5
+        assert not index.needs_retrain()
+    
+    @pytest.mark.parametrize("factory", [
+        "IVF{nlist},Flat",
+        "IVF{nlist},SQ8",
+        "IVF{nlist},PQ8",
+        "IVF{nlist},PQ8,RFlat",
+        "OPQ8,IVF{nlist},PQ8,Refine(SQ8)"
+    ])
+    def test_index_types(self, tmp_path, monkeypatch, factory):
+        monkeypatch.setattr("src.faiss_index.FAISS_IVF_MIN_VECTORS", 2000)
+        index = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False, factory=factory)
+        index.load_index()
+        
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((3000, 32)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        index.add_vectors(embeddings, list(range(3000)), [{"document_id": i // 10} for i in range(3000)])
+        index.retrain()
+        
+        stats = index.get_stats()
+        assert stats["factory"] == factory and stats["index_type"] == "ivf"
+        assert 0 < stats["bytes_per_vector"] < 32 * 4 + 64
+        assert not index.needs_retrain()
+        
+        assert index.delete_document(7) == 10
+        index.add_vectors(embeddings[:5], [5000, 5001, 5002, 5003, 5004], [{"document_id": 500}] * 5)
+        
+        reloaded = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False, factory=factory)
+        reloaded.load_index()
+        assert reloaded.index.ntotal == 2995
+        assert (reloaded.refine_index is not None) == ("R" in factory)
+        assert not reloaded.needs_retrain()
+        
+        results = reloaded.search(embeddings[1234], k=10)
+        assert 1234 in {r["chunk_id"] for r in results}
+        assert all(r["metadata"]["document_id"] != 7 for r in reloaded.search(embeddings[75], k=10))
+        filtered = reloaded.search(embeddings[0], k=5, filters={"document_id": 500})
+        assert {r["chunk_id"] for r in filtered} == {5000, 5001, 5002, 5003, 5004}
+    
+    @pytest.mark.parametrize("factory", ["Flat", "PQ8"])
+    def test_non_ivf_index_retrains_once(self, tmp_path, monkeypatch, factory):
+        monkeypatch.setattr("src.faiss_index.FAISS_IVF_MIN_VECTORS", 2000)
+        index = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False, factory=factory)
+        index.load_index()
+        
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((4000, 32)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        index.add_vectors(embeddings[:3000], list(range(3000)), [{"document_id": i // 10} for i in range(3000)])
+        # Only the flat fallback of an untrained quantizer is worth rebuilding
+        assert index.needs_retrain() == (factory != "Flat")
+        index.retrain()
+        assert not index.needs_retrain()
+        
+        index.add_vectors(embeddings[3000:], list(range(3000, 4000)), [{"document_id": i // 10} for i in range(3000, 4000)])
+        assert not index.needs_retrain()
+        assert index.retrain_count == 1
+        assert 3500 in {r["chunk_id"] for r in index.search(embeddings[3500], k=10)}
+    
+    def test_hnsw_tombstones_and_rebuild(self, tmp_path, monkeypatch):
+        index = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False, factory="HNSW{M},Flat")
+        index.load_index()
+        assert index.get_stats()["index_type"] == "hnsw"
+        
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((3000, 32)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        for start in range(0, 3000, 500):
+            ids = list(range(start, start + 500))
+            index.add_vectors(embeddings[start:start + 500], ids, [{"document_id": i // 10, "section_type": "general"} for i in ids])
+        
+        assert index.search(embeddings[42], k=1)[0]["chunk_id"] == 42
+        for document_id in range(0, 100):
+            index.delete_document(document_id)
+        assert len(index.tombstones) == 1000 and index.index.ntotal == 3000
+        results = index.search(embeddings[42], k=10)
+        assert len(results) == 10 and all(r["chunk_id"] >= 1000 for r in results)
+        by_section = index.search(embeddings[42], k=10, filters={"section_type": "general"})
+        assert len(by_section) == 10 and all(r["chunk_id"] >= 1000 for r in by_section)
+        assert index.search(embeddings[42], k=5, filters={"document_id": 4}) == []
+        assert [r["chunk_id"] for r in index.search(embeddings[1234], k=3, filters={"document_id": 123})][0] == 1234
+        
+        monkeypatch.setattr("src.faiss_index.FAISS_IVF_MIN_VECTORS", 1000)
+        assert index.needs_retrain()
+        index.retrain()
+        assert index.index.ntotal == 2000 and len(index.tombstones) == 0
+        assert index.search(embeddings[2500], k=1)[0]["chunk_id"] == 2500
+        
+        index.delete_document(250)
+        reloaded = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False, factory="HNSW{M},Flat")
+        reloaded.load_index()
+        assert len(reloaded.tombstones) == 10 and reloaded.index.ntotal == 2000
+        results = reloaded.search(embeddings[2505], k=10)
+        assert len(results) == 10 and all(r["metadata"]["document_id"] != 250 for r in results)
+    
+    def test_read_only_worker_follows_writer(self, tmp_path):
+        writer = FAISSIndex(index_path=str(tmp_path))
+        assert writer.acquire_writer_role()
+        writer.load_index()
+        
+        embeddings = np.random.rand(40, 768).astype('float32')
+        writer.add_vectors(embeddings[:20], list(range(20)), [{"document_id": i // 10} for i in range(20)])
+        writer.save_index()
+        
+        reader = FAISSIndex(index_path=str(tmp_path))
+        assert not reader.acquire_writer_role()
+        reader.open_read_only()
+        assert reader.index.ntotal == 20 and reader.generation == writer.generation
+        assert reader.search(embeddings[3], k=1)[0]["chunk_id"] == 3
+        with pytest.raises(ReadOnlyIndexError):
+            reader.delete_document(0)
+        
+        writer.add_vectors(embeddings[20:], list(range(20, 40)), [{"document_id": 2 + i // 10} for i in range(20)])
+        writer.delete_document(0)
+        assert not reader.reload_if_published()
+        writer.save_index()
+        
+        assert reader.reload_if_published()
+        assert reader.index.ntotal == 30
+        assert reader.search(embeddings[25], k=1)[0]["chunk_id"] == 25
+        assert reader.search(embeddings[3], k=5, filters={"document_id": 0}) == []
+    
+    def test_search_during_writes_sees_consistent_state(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("src.faiss_index.FAISS_IVF_MIN_VECTORS", 1000)
+        index = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False)
+        index.load_index()
+        
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((3000, 32)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        index.add_vectors(embeddings[:2000], list(range(2000)), [{"document_id": i // 10} for i in range(2000)], save=False)
+        index.retrain()
+        assert index.get_stats()["index_type"] == "ivf"
+        
+        stop = threading.Event()
+        errors = []
+        
+        def write():
+            document_id = 200
+            while not stop.is_set():
+                start = 2000 + (document_id % 100) * 10
+                ids = list(range(start, start + 10))
+                index.add_vectors(embeddings[start:start + 10], ids, [{"document_id": document_id}] * 10, save=False)
+                index.delete_document(document_id - 50)
+                document_id += 1
+        
+        def search():
+            queries = np.random.default_rng()
+            while not stop.is_set():
+                try:
+                    query = embeddings[queries.integers(3000)]
+                    for result in index.search(query, k=20) + index.search(query, k=10, filters={"document_ids": [3, 250]}):
+                        if not result["metadata"]:
+                            errors.append(result["chunk_id"])
+                except Exception as e:
+                    errors.append(e)
+        
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=search) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(2)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        
+        assert errors == []
+    
+    def test_retrain_while_searching(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("src.faiss_index.FAISS_IVF_MIN_VECTORS", 1000)
+        index = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False, factory="HNSW{M},Flat")
+        index.load_index()
+        
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((3000, 32)).astype('float32')
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        index.add_vectors(embeddings, list(range(3000)), [{"document_id": i // 10, "section_type": "general"} for i in range(3000)])
+        index.save_index()
+        
+        # Configured factory changed: the retrain replaces the HNSW graph with an IVF index
+        index = FAISSIndex(index_path=str(tmp_path), dimension=32, auto_retrain=False, factory="IVF{nlist},Flat")
+        index.load_index()
+        assert index.get_stats()["index_type"] == "hnsw" and index.needs_retrain()
+        
+        selection = index.metadata_store.selection
+        retrain = threading.Thread(target=index.retrain)
+        
+        def retrain_mid_search(filters):
+            if retrain.ident is None:
+                # The swap waits for this search instead of landing between its snapshot and its search parameters
+                retrain.start()
+                retrain.join(timeout=1)
+            return selection(filters)
+        monkeypatch.setattr(index.metadata_store, "selection", retrain_mid_search)
+        
+        results = index.search(embeddings[1234], k=5, filters={"section_type": "general"})
+        assert results[0]["chunk_id"] == 1234
+        retrain.join()
+        assert index.get_stats()["index_type"] == "ivf" and index.retrain_count == 1
+        assert index.search(embeddings[1234], k=1, filters={"section_type": "general"})[0]["chunk_id"] == 1234
+    
+    def test_checkpoint_hook_runs_before_publish(self, tmp_path):
+        index = FAISSIndex(index_path=str(tmp_path))
+        index.load_index()
+        index.add_vectors(np.random.rand(5, 768).astype('float32'), list(range(5)), [{"document_id": 1}] * 5)
+        
+        seen = []
+        index.add_checkpoint_hook(lambda: seen.append((index._read_info()["generation"], index.published_generation)))
+        index.save_index()
+        
+        # Readers still see an odd generation while the hook writes, and load both once it is even
+        assert seen == [(index.generation - 1, index.generation)]
+        assert index.generation % 2 == 0
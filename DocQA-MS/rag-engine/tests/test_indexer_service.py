@@ -0,0 +1,149 @@
+import types
+import hashlib
+import pytest
+import numpy as np
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, Text, JSON, ForeignKey
+from sqlalchemy.orm import sessionmaker, registry
+from src.indexer_service import IndexerService
+from src.chunk_store import chunk_table
+from src.faiss_index import FAISSIndex
+from src.bm25_search import BM25Search
+
+class StubEmbedder:
+    model_id = "stub-model"
+    
+    def __init__(self):
+        self.texts = []
+    
+    def embed_batch(self, texts, **kwargs):
+        self.texts.extend(texts)
+        embeddings = np.stack([
+            np.random.default_rng(int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)).standard_normal(768)
+            for text in texts
+        ]).astype('float32')
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+class LineChunker:
+    # One chunk per line, so an edited line changes exactly one chunk
+    chunk_size = 512
+    chunk_overlap = 50
+    
+    def chunk_text(self, text, metadata=None):
+        return [
+            {"text": line, "position": i, "metadata": {**(metadata or {}), "section_type": "general", "chunk_index": i}}
+            for i, line in enumerate(text.split("\n"))
+        ]
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # Stand-ins for the shared documents and chunks tables, with the columns the service reads and writes
+    metadata = MetaData()
+    documents = Table("documents", metadata, Column("id", Integer, primary_key=True))
+    chunks = Table(
+        "chunks", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("document_id", Integer, ForeignKey("documents.id")),
+        Column("texte", Text),
+        Column("position", Integer),
+        Column("chunk_metadata", JSON),
+        Column("embedding_vector", JSON)
+    )
+    chunks = chunk_table(types.SimpleNamespace(__table__=chunks))
+    engine = create_engine(f"sqlite:///{tmp_path / 'docqa.db'}")
+    metadata.create_all(engine)
+    
+    mapper = registry()
+    document_class, chunk_class = type("Document", (), {}), type("Chunk", (), {})
+    mapper.map_imperatively(document_class, documents)
+    mapper.map_imperatively(chunk_class, chunks)
+    monkeypatch.setattr("src.indexer_service.Document", document_class)
+    monkeypatch.setattr("src.indexer_service.Chunk", chunk_class)
+    monkeypatch.setattr("src.indexer_service.chunks_table", chunks)
+    monkeypatch.setattr("src.indexer_service.SessionLocal", sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    with engine.begin() as connection:
+        connection.execute(documents.insert(), [{"id": 1}, {"id": 2}])
+    
+    service = IndexerService()
+    service.chunker = LineChunker()
+    service.embedder = StubEmbedder()
+    service.faiss_index = FAISSIndex(index_path=str(tmp_path / "faiss"), auto_retrain=False)
+    service.faiss_index.load_index()
+    service.bm25_search = BM25Search(refresh_seconds=0)
+    return service
+
+REPORT = "Motif: douleur thoracique\nTraitement: aspirine 100 mg\nExamen clinique normal"
+
+class TestIndexerService:
+    def test_identical_resubmission_is_skipped(self, service):
+        first = service.index_document(1, REPORT, {"source": "upload"})
+        assert first["embedded_chunks"] == 3 and not first["unchanged"]
+        
+        service.embedder.texts.clear()
+        again = service.index_document(1, REPORT, {"source": "upload"})
+        assert again["unchanged"]
+        assert again["chunk_ids"] == first["chunk_ids"]
+        assert service.embedder.texts == []
+        
+        # Metadata is part of what indexing derives from a submission
+        relabelled = service.index_document(1, REPORT, {"source": "email"})
+        assert not relabelled["unchanged"]
+        assert relabelled["embedded_chunks"] == 0 and relabelled["reused_chunks"] == 3
+    
+    def test_edited_line_reembeds_only_its_chunk(self, service):
+        first = service.index_document(1, REPORT)
+        
+        service.embedder.texts.clear()
+        edited = service.index_document(1, REPORT.replace("aspirine 100 mg", "aspirine 75 mg"))
+        assert service.embedder.texts == ["Traitement: aspirine 75 mg"]
+        assert edited["embedded_chunks"] == 1 and edited["reused_chunks"] == 2
+        assert edited["chunk_ids"][0] == first["chunk_ids"][0] and edited["chunk_ids"][2] == first["chunk_ids"][2]
+        assert edited["chunk_ids"][1] not in first["chunk_ids"]
+        
+        assert set(service.faiss_index.chunk_ids_for_document(1).tolist()) == set(edited["chunk_ids"])
+        assert service.bm25_search.chunk_ids_for_document(1) == set(edited["chunk_ids"])
+        assert {r["chunk_id"] for r in service.bm25_search.search("aspirine 100")} <= {edited["chunk_ids"][1]}
+    
+    def test_document_missing_from_faiss_is_reindexed(self, service, monkeypatch):
+        add_vectors = service.faiss_index.add_vectors
+        
+        def failing_add(*args, **kwargs):
+            raise RuntimeError("disque plein")
+        
+        monkeypatch.setattr(service.faiss_index, "add_vectors", failing_add)
+        with pytest.raises(RuntimeError):
+            service.index_document(1, REPORT)
+        # The chunks and their hashes were committed before the FAISS add failed
+        assert not len(service.faiss_index.chunk_ids_for_document(1))
+        
+        monkeypatch.setattr(service.faiss_index, "add_vectors", add_vectors)
+        service.embedder.texts.clear()
+        retried = service.index_document(1, REPORT)
+        assert not retried["unchanged"]
+        assert retried["embedded_chunks"] == 0 and retried["reused_chunks"] == 3
+        assert set(service.faiss_index.chunk_ids_for_document(1).tolist()) == set(retried["chunk_ids"])
+        assert service.embedder.texts == []
+        
+        assert service.index_document(1, REPORT)["unchanged"]
+    
+    def test_failed_document_does_not_fail_its_batch(self, service, monkeypatch):
+        write_chunks = service._write_chunks
+        
+        def write_or_fail(db, plan):
+            if plan["document_id"] == 2:
+                raise ValueError("contrainte violée")
+            return write_chunks(db, plan)
+        
+        monkeypatch.setattr(service, "_write_chunks", write_or_fail)
+        outcomes = service.index_documents([
+            {"document_id": 1, "content": REPORT},
+            {"document_id": 2, "content": "Compte rendu opératoire"},
+            {"document_id": 3, "content": "Document inconnu"}
+        ])
+        
+        assert outcomes[0]["status"] == "success" and outcomes[0]["chunks_count"] == 3
+        assert isinstance(outcomes[1], ValueError) and isinstance(outcomes[2], ValueError)
+        assert set(service.faiss_index.chunk_ids_for_document(1).tolist()) == set(outcomes[0]["chunk_ids"])
+        assert not len(service.faiss_index.chunk_ids_for_document(2))
+        
+        monkeypatch.setattr(service, "_write_chunks", write_chunks)
+        assert not service.index_document(2, "Compte rendu opératoire")["unchanged"]
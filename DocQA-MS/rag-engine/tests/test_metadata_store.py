@@ -0,0 +1,66 @@
+import numpy as np
+from src.metadata_store import MetadataStore, COLUMNS
+
+class TestMetadataStore:
+    def test_batch_lookup(self):
+        store = MetadataStore()
+        store.add([10, 11, 12], [
+            {"document_id": 1, "section_type": "anamnese", "chunk_index": 0, "token_start": 0, "token_end": 512},
+            {"document_id": 1, "section_type": "conclusion", "chunk_index": 1},
+            {"document_id": 2, "section_type": "anamnese", "chunk_index": 0}
+        ])
+        store.add([5], [{"document_id": 3, "section_type": None, "chunk_index": 0}])
+        store.remove([11])
+        
+        results = store.get_batch([12, 11, 10, 5, 99])
+        assert results[0] == {"chunk_id": 12, "document_id": 2, "section_type": "anamnese", "chunk_index": 0}
+        assert results[1] == {}
+        assert results[2]["token_end"] == 512
+        assert results[3]["section_type"] is None
+        assert results[4] == {}
+        assert len(store) == 3
+        assert sorted(store.chunk_ids_for_document(1).tolist()) == [10]
+    
+    def test_save_and_mmap_load(self, tmp_path):
+        store = MetadataStore()
+        ids = np.arange(1000, dtype=np.int64)
+        store.add(ids, [{"document_id": int(i // 10), "section_type": f"s{i % 3}", "chunk_index": int(i % 10)} for i in ids])
+        store.remove(ids[:100])
+        store.save(tmp_path / "metadata.cols")
+        
+        loaded = MetadataStore.load(tmp_path / "metadata.cols")
+        assert isinstance(loaded.columns["chunk_id"], np.memmap)
+        assert len(loaded) == 900
+        assert loaded.get(500) == store.get(500)
+        assert loaded.get(50) == {}
+        
+        loaded.add([2000], [{"document_id": 7, "section_type": "s1", "chunk_index": 0}])
+        assert loaded.get(2000)["document_id"] == 7
+        assert loaded.get_stats()["bytes_per_chunk"] < 72
+    
+    def test_load_file_without_char_offsets(self, tmp_path, monkeypatch):
+        store = MetadataStore()
+        store.add([1, 2], [{"document_id": 1, "section_type": "a", "chunk_index": i, "token_start": 0, "token_end": 10} for i in range(2)])
+        columns = {name: dtype for name, dtype in COLUMNS.items() if not name.startswith("char_")}
+        monkeypatch.setattr("src.metadata_store.COLUMNS", columns)
+        store.save(tmp_path / "metadata.cols")
+        monkeypatch.undo()
+        
+        loaded = MetadataStore.load(tmp_path / "metadata.cols")
+        assert loaded.get(1) == {"chunk_id": 1, "document_id": 1, "section_type": "a", "chunk_index": 0, "token_start": 0, "token_end": 10}
+        loaded.add([3], [{"document_id": 2, "section_type": "a", "chunk_index": 0, "char_start": 120, "char_end": 480}])
+        assert loaded.get(3)["char_end"] == 480
+    
+    def test_selection(self):
+        store = MetadataStore()
+        store.add(range(40), [{"document_id": i // 10, "section_type": ["a", "b"][i % 2], "chunk_index": i % 10} for i in range(40)])
+        store.remove([2, 4])
+        
+        bitmap, chunk_ids, allowed = store.selection({"section_type": "a"})
+        assert chunk_ids is None and allowed == 18
+        bits = np.unpackbits(bitmap, bitorder="little")
+        assert np.flatnonzero(bits).tolist() == [i for i in range(40) if i % 2 == 0 and i not in (2, 4)]
+        
+        _, chunk_ids, allowed = store.selection({"document_ids": [0, 3], "section_type": "b"})
+        assert chunk_ids.tolist() == [1, 3, 5, 7, 9, 31, 33, 35, 37, 39]
+        assert allowed == 10
@@ -0,0 +1,46 @@
+from src.metrics import MetricsRegistry
+
+class TestMetrics:
+    def test_histogram_exposition(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("stage_seconds", "Stage time.", buckets=(0.01, 0.1, 1.0))
+        for value in (0.005, 0.01, 0.05, 0.5, 3.0):
+            histogram.observe(value, stage="embed")
+        histogram.observe(0.2, stage="chunk")
+        
+        lines = registry.render().splitlines()
+        assert lines[:2] == ["# HELP stage_seconds Stage time.", "# TYPE stage_seconds histogram"]
+        assert 'stage_seconds_bucket{stage="embed",le="0.01"} 2' in lines
+        assert 'stage_seconds_bucket{stage="embed",le="0.1"} 3' in lines
+        assert 'stage_seconds_bucket{stage="embed",le="+Inf"} 5' in lines
+        assert 'stage_seconds_count{stage="embed"} 5' in lines
+        assert 'stage_seconds_bucket{stage="chunk",le="1.0"} 1' in lines
+        sums = [line for line in lines if line.startswith('stage_seconds_sum{stage="embed"}')]
+        assert abs(float(sums[0].split()[-1]) - 3.565) < 1e-9
+    
+    def test_counters_and_gauges(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("queries_total", "Queries.")
+        counter.inc(mode="hybrid")
+        counter.inc(2, mode="hybrid")
+        counter.inc(mode='ve"ctor')
+        registry.gauge("queue_depth", "Queue depth.", lambda: {"search": 3, "ingest": 0}, label="executor")
+        registry.gauge("broker_messages", "Broker backlog.", lambda: 1 / 0)
+        registry.gauge("vectors", "Vectors.", lambda: 42)
+        
+        text = registry.render()
+        assert 'queries_total{mode="hybrid"} 3' in text
+        assert 'queries_total{mode="ve\\"ctor"} 1' in text
+        assert 'queue_depth{executor="ingest"} 0' in text
+        assert "broker_messages" not in text
+        assert "vectors 42\n" in text
+    
+    def test_timer_records_on_error(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("stage_seconds", "Stage time.")
+        try:
+            with histogram.time(stage="db_write"):
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        assert 'stage_seconds_count{stage="db_write"} 1' in registry.render()
@@ -0,0 +1,32 @@
+import threading
+import pytest
+import numpy as np
+from src.micro_batcher import MicroBatcher
+
+class TestMicroBatcher:
+    def test_concurrent_requests_share_a_batch(self):
+        release = threading.Event()
+        calls = []
+        
+        def encode(texts):
+            calls.append(list(texts))
+            release.wait(1)
+            return np.array([[len(t)] for t in texts], dtype='float32')
+        
+        batcher = MicroBatcher(encode, window_ms=50, max_batch_size=8)
+        first = batcher.submit("a")
+        others = [batcher.submit("b" * i) for i in range(2, 6)]
+        release.set()
+        
+        assert first.result(timeout=2)[0] == 1
+        assert [f.result(timeout=2)[0] for f in others] == [2, 3, 4, 5]
+        assert sum(len(c) for c in calls) == 5
+        assert batcher.get_stats()["largest_batch"] > 1
+    
+    def test_errors_are_propagated(self):
+        def encode(texts):
+            raise RuntimeError("boom")
+        
+        batcher = MicroBatcher(encode, window_ms=1)
+        with pytest.raises(RuntimeError):
+            batcher.submit("x").result(timeout=2)
@@ -0,0 +1,124 @@
+import json
+import types
+import collections
+from src.rabbitmq_consumer import RabbitMQConsumer, DocumentNotFoundError
+
+class FakeChannel:
+    """Delivers queued bodies while fewer than prefetch_count are unacked, and stops the consumer once all are delivered."""
+    
+    def __init__(self, consumer, bodies):
+        self.consumer = consumer
+        self.queue = collections.deque(bodies)
+        self.unacked = set()
+        self.acked = []
+        self.nacked = []
+        self.tag = 0
+    
+    def consume(self, queue, inactivity_timeout):
+        while True:
+            if self.queue and len(self.unacked) < self.consumer.prefetch_count:
+                self.tag += 1
+                self.unacked.add(self.tag)
+                yield types.SimpleNamespace(delivery_tag=self.tag), None, self.queue.popleft()
+            else:
+                if not self.queue:
+                    self.consumer.stop_consuming()
+                yield None, None, None
+    
+    def queue_declare(self, queue, passive=False):
+        return types.SimpleNamespace(method=types.SimpleNamespace(message_count=len(self.queue)))
+    
+    def basic_ack(self, delivery_tag):
+        self.unacked.discard(delivery_tag)
+        self.acked.append(delivery_tag)
+    
+    def basic_nack(self, delivery_tag, requeue):
+        self.unacked.discard(delivery_tag)
+        self.nacked.append((delivery_tag, requeue))
+    
+    def cancel(self):
+        return 0
+
+class FakeIndexer:
+    def __init__(self, missing=(), failing=()):
+        self.chunker = types.SimpleNamespace(chunk_size=100)
+        self.missing = set(missing)
+        self.failing = set(failing)
+        self.batches = []
+        self.deleted = []
+    
+    def index_documents(self, documents):
+        self.batches.append([document["document_id"] for document in documents])
+        return [
+            DocumentNotFoundError(f"Document {document['document_id']} non trouvé") if document["document_id"] in self.missing
+            else RuntimeError("FAISS indisponible") if document["document_id"] in self.failing
+            else {"status": "success", "document_id": document["document_id"]}
+            for document in documents
+        ]
+    
+    def delete_document(self, document_id):
+        self.deleted.append(document_id)
+
+def index_message(document_id, content="Compte rendu"):
+    return json.dumps({"document_id": document_id, "content": content, "metadata": {}})
+
+def consume(monkeypatch, bodies, indexer, **settings):
+    monkeypatch.setattr("src.rabbitmq_consumer.indexer_service", indexer)
+    consumer = RabbitMQConsumer(**settings)
+    consumer.channel = FakeChannel(consumer, bodies)
+    consumer._consume_batches()
+    return consumer, consumer.channel
+
+class TestRabbitMQConsumer:
+    def test_batches_close_and_messages_settle_per_document(self, monkeypatch):
+        indexer = FakeIndexer(missing={8}, failing={11})
+        bodies = [
+            index_message(1),
+            index_message(2),
+            # Same document again: the batch holding its first version is indexed first
+            index_message(1, "Compte rendu révisé"),
+            # Deletes close the batch before them
+            json.dumps({"action": "delete", "document_id": 5}),
+            "pas du json",
+            # About 12 estimated chunks, more than batch_max_chunks on its own
+            index_message(6, "x" * 4400),
+            index_message(7),
+            index_message(8),
+            index_message(9),
+            index_message(10),
+            # Still pending when the queue runs dry: indexed as the consumer stops
+            index_message(11)
+        ]
+        consumer, channel = consume(monkeypatch, bodies, indexer, prefetch_count=4, batch_max_chunks=10, batch_max_wait_ms=60000)
+        
+        assert indexer.batches == [[1, 2], [1], [6], [7, 8, 9, 10], [11]]
+        assert indexer.deleted == [5]
+        assert sorted(channel.acked) == [1, 2, 3, 4, 6, 7, 9, 10]
+        # Undecodable and missing-document messages are dropped, a failed index is retried
+        assert sorted(channel.nacked) == [(5, False), (8, False), (11, True)]
+        assert not channel.unacked
+        assert consumer.get_stats()["documents"] == 9
+        # Read from the channel once, after the first delivery
+        assert consumer.queue_depth() == len(bodies) - 1
+    
+    def test_batch_closes_after_max_wait(self, monkeypatch):
+        indexer = FakeIndexer()
+        consumer, channel = consume(
+            monkeypatch, [index_message(i) for i in range(1, 4)], indexer,
+            prefetch_count=8, batch_max_chunks=100, batch_max_wait_ms=0
+        )
+        
+        assert indexer.batches == [[1], [2], [3]]
+        assert sorted(channel.acked) == [1, 2, 3]
+    
+    def test_failed_batch_requeues_every_message(self, monkeypatch):
+        indexer = FakeIndexer()
+        
+        def failing_batch(documents):
+            raise RuntimeError("base de données indisponible")
+        
+        monkeypatch.setattr(indexer, "index_documents", failing_batch)
+        consumer, channel = consume(monkeypatch, [index_message(1), index_message(2)], indexer, prefetch_count=2)
+        
+        assert channel.acked == []
+        assert sorted(channel.nacked) == [(1, True), (2, True)]
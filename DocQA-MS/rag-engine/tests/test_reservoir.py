@@ -0,0 +1,15 @@
+import numpy as np
+from src.reservoir import ReservoirSample
+
+class TestReservoirSample:
+    def test_fills_then_samples_uniformly(self):
+        reservoir = ReservoirSample(capacity=1000, dimension=1, seed=0)
+        for start in range(0, 100000, 500):
+            reservoir.add(np.arange(start, start + 500, dtype=np.float32).reshape(-1, 1) / 100000)
+        
+        sample = reservoir.sample().ravel()
+        assert len(reservoir) == 1000
+        assert reservoir.seen == 100000
+        # A uniform sample of [0, 1) has mean ~0.5 and covers every decile
+        assert abs(sample.mean() - 0.5) < 0.05
+        assert len(np.unique((sample * 10).astype(int))) == 10
@@ -0,0 +1,135 @@
+import time
+import numpy as np
+from src.sharded_index import ShardedFAISSIndex
+
+def _corpus(num_vectors=400, dimension=32, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((num_vectors, dimension)).astype('float32')
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    metadata = [{"document_id": i // 10, "section_type": "general"} for i in range(num_vectors)]
+    return embeddings, metadata
+
+class TestShardedFAISSIndex:
+    def test_documents_stay_on_one_shard(self, tmp_path):
+        index = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=4, dimension=32)
+        index.load_index()
+        embeddings, metadata = _corpus()
+        index.add_vectors(embeddings, list(range(len(embeddings))), metadata)
+        
+        sizes = [shard.index.ntotal for shard in index.shards]
+        assert sum(sizes) == len(embeddings)
+        assert all(size > 0 for size in sizes)
+        for shard in index.shards:
+            documents = set(shard.metadata_store.columns["document_id"][:shard.metadata_store.size].tolist())
+            assert all(index.shard_of([d])[0] == index.shards.index(shard) for d in documents)
+    
+    def test_merged_search_matches_brute_force(self, tmp_path):
+        index = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=3, dimension=32)
+        index.load_index()
+        embeddings, metadata = _corpus()
+        index.add_vectors(embeddings, list(range(len(embeddings))), metadata)
+        
+        for query in embeddings[:20]:
+            expected = np.argsort(-(embeddings @ query), kind="stable")[:10]
+            results = index.search(query, k=10)
+            assert [r["chunk_id"] for r in results] == expected.tolist()
+        
+        filtered = index.search(embeddings[55], k=5, filters={"document_ids": [5, 17]})
+        assert len(filtered) == 5
+        assert filtered[0]["chunk_id"] == 55
+        assert all(r["metadata"]["document_id"] in (5, 17) for r in filtered)
+    
+    def test_delete_and_reload(self, tmp_path):
+        index = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=4, dimension=32)
+        index.load_index()
+        embeddings, metadata = _corpus()
+        index.add_vectors(embeddings, list(range(len(embeddings))), metadata)
+        index.save_index()
+        
+        reloaded = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=4, dimension=32)
+        reloaded.load_index()
+        assert not reloaded.needs_rebuild
+        assert reloaded.get_stats()["total_vectors"] == len(embeddings)
+        
+        owner = reloaded.shards[int(reloaded.shard_of([7])[0])]
+        others = [shard.index.ntotal for shard in reloaded.shards if shard is not owner]
+        assert reloaded.delete_document(7) == 10
+        assert [shard.index.ntotal for shard in reloaded.shards if shard is not owner] == others
+        assert all(r["metadata"]["document_id"] != 7 for r in reloaded.search(embeddings[75], k=20))
+    
+    def test_shard_count_change_requires_rebuild(self, tmp_path):
+        index = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=2, dimension=32)
+        index.load_index()
+        embeddings, metadata = _corpus()
+        index.add_vectors(embeddings, list(range(len(embeddings))), metadata)
+        index.save_index()
+        
+        resharded = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=3, dimension=32)
+        resharded.load_index()
+        assert resharded.needs_rebuild
+        
+        resharded.add_vectors(embeddings, list(range(len(embeddings))), metadata, save=False)
+        resharded.finish_rebuild()
+        assert not resharded.needs_rebuild
+        
+        reloaded = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=3, dimension=32)
+        reloaded.load_index()
+        assert not reloaded.needs_rebuild
+        assert reloaded.get_stats()["total_vectors"] == len(embeddings)
+    
+    def test_rebuild_discards_wal_of_replaced_layout(self, tmp_path):
+        index = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=2, dimension=32)
+        index.load_index()
+        embeddings, metadata = _corpus()
+        index.add_vectors(embeddings[:200], list(range(200)), metadata[:200])
+        index.save_index()
+        # Left in each shard's WAL, not yet checkpointed
+        index.add_vectors(embeddings[200:], list(range(200, len(embeddings))), metadata[200:])
+        
+        resharded = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=3, dimension=32)
+        resharded.load_index()
+        assert resharded.needs_rebuild
+        # The rebuilt corpus has no document on shard 0
+        kept = [i for i, m in enumerate(metadata) if resharded.shard_of([m["document_id"]])[0] != 0]
+        resharded.add_vectors(embeddings[kept], kept, [metadata[i] for i in kept], save=False)
+        resharded.finish_rebuild()
+        
+        reloaded = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=3, dimension=32)
+        reloaded.load_index()
+        assert reloaded.shards[0].index.ntotal == 0
+        assert reloaded.get_stats()["total_vectors"] == len(kept)
+    
+    def test_checkpoint_hook_runs_once_after_every_shard(self, tmp_path):
+        index = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=3, dimension=32)
+        index.load_index()
+        embeddings, metadata = _corpus()
+        index.add_vectors(embeddings, list(range(len(embeddings))), metadata)
+        seen = []
+        index.add_checkpoint_hook(lambda: seen.append([shard._read_info()["generation"] for shard in index.shards]))
+        
+        index.save_index()
+        # Every shard has published when the hook saves, so one save carries all their generations
+        assert seen == [index.published_generation]
+        assert all(generation % 2 == 0 for generation in seen[0])
+    
+    def test_checkpointer_catches_up_after_shard_checkpoint(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("src.sharded_index.FAISS_CHECKPOINT_INTERVAL_SECONDS", 0.01)
+        index = ShardedFAISSIndex(index_path=str(tmp_path), num_shards=3, dimension=32)
+        index.load_index()
+        embeddings, metadata = _corpus()
+        index.add_vectors(embeddings, list(range(len(embeddings))), metadata)
+        seen = []
+        index.add_checkpoint_hook(lambda: seen.append(index.published_generation))
+        
+        index.start_checkpointer()
+        try:
+            # As after a retrain: one shard publishes without the others
+            index.shards[1].save_index()
+            deadline = time.monotonic() + 5
+            while not seen and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            index.stop_checkpointer()
+        
+        assert seen == [index.published_generation]
+        assert all(shard.unsaved_writes == 0 for shard in index.shards)